@@ -55,5 +55,42 @@ class Base3D(BaseAgent):
         pixel = pixel_candidates[np.random.randint(pixel_candidates.size(0))].reshape(1, 2)
         return pixel
 
+    def check_in_hand_not_emtpy_dilation_batch(self, obs, batch_idx, pixels, hm_threshold):
+        """
+        Batched check_in_hand_not_emtpy_dilation, all patches are extracted in one getPatch call
+        :param obs: BxCxHxW observations
+        :param batch_idx: N indexes into obs, one per pixel
+        :param pixels: Nx2 pixels in action space
+        :return: N bool tensor
+        """
+        patch = self.getPatch(obs.to(self.device)[batch_idx.to(self.device)], pixels.to(self.device),
+                              torch.zeros(pixels.size(0)), is_in_action_range=True)
+        return self.dilater.check_in_hand_not_empty_dilation_batch(patch, patch.size(-1), hm_threshold)
+
+    def get_positive_pixel_candidates_batch(self, obs, hm_threshold):
+        """
+        Batched get_positive_pixel_candidates, dilating all observations in one conv
+        :return: Bx1xDxD positive pixels in action space
+        """
+        return self.dilater.dilate(obs[:, :1, self.inward_padding:-self.inward_padding,
+                                   self.inward_padding:-self.inward_padding], hm_threshold)
+
+    def select_random_actions_at_posi_pixels(self, obs, positive_pixels):
+        """
+        Batched select_random_action_at_posi_pixel
+        :param obs: BxCxHxW observations
+        :param positive_pixels: Bx1xDxD positive pixels of obs
+        :return: Bx2 pixels
+        """
+        n = positive_pixels.size(0)
+        d = positive_pixels.size(-1)
+        probs = positive_pixels.reshape(n, -1).clone()
+        no_candidate = probs.sum(1) <= 0
+        if no_candidate.sum() > 0:
+            probs[no_candidate] = (obs[no_candidate, 0, self.inward_padding:-self.inward_padding,
+                                   self.inward_padding:-self.inward_padding] >= 0).reshape(-1, d * d).float()
+        m = torch.multinomial(probs, 1).squeeze(1)
+        return torch.stack((m // d, m % d), dim=1)
+
     def _loadBatchToDevice(self, batch):
         super()._loadBatchToDevice(batch)
@@ -30,14 +30,41 @@ class DQN3DASR(Base3D):
 
     def getQ2Input(self, obs, center_pixel):
         patch = self.getPatch(obs, center_pixel, torch.zeros(center_pixel.size(0)))
-        patch[:, :1, :, :] = patch[:, :1, :, :] - self.getPatch_z(patch)
+        return self.shiftPatchZ(patch)
+
+    def shiftPatchZ(self, patch, group_sizes=None):
+        """
+        subtract the safe z from the depth channel of the patches
+        :param patch: BxCxHxW patches, made of batches of group_sizes stacked along the first dimension
+        :param group_sizes: the size of each stacked batch. The safe z of each batch is computed from its first patch,
+        like getQ2Input on that batch. None for a single batch
+        :return: the shifted patches
+        """
+        patch = patch.clone()
+        for group in (patch.split(group_sizes) if group_sizes is not None else [patch]):
+            group[:, :1, :, :] = group[:, :1, :, :] - self.getPatch_z(group)
         return patch
 
-    def forwardQ2(self, states, in_hand, obs, obs_encoding, pixels, target_net=False, to_cpu=False):
+    def getQ2RawPatch(self, obs, obs_encoding, pixels):
+        """
+        extract the q2 patches centered at pixels, before the safe z is subtracted
+        """
         if q2_model.find('_cas') != -1:  # in cascade q1 q2 networks, obs_encoding is feature_map_up1
-            patch = self.getQ2Input(obs_encoding.to(self.device), pixels.to(self.device))
-        else:
-            patch = self.getQ2Input(obs.to(self.device), pixels.to(self.device))
+            obs = obs_encoding
+        return self.getPatch(obs.to(self.device), pixels.to(self.device), torch.zeros(pixels.size(0)))
+
+    def forwardQ2(self, states, in_hand, obs, obs_encoding, pixels, target_net=False, to_cpu=False):
+        raw_patch = self.getQ2RawPatch(obs, obs_encoding, pixels)
+        return self.forwardQ2Patch(states, in_hand, obs_encoding, raw_patch, to_cpu=to_cpu)
+
+    def forwardQ2Patch(self, states, in_hand, obs_encoding, raw_patch, group_sizes=None, to_cpu=False):
+        """
+        forward pass the q2 network on patches extracted by getQ2RawPatch
+        :param raw_patch: BxCxHxW patches
+        :param group_sizes: see shiftPatchZ
+        """
+        patch = self.shiftPatchZ(raw_patch, group_sizes)
+        if q2_model.find('_cas') == -1:
             patch = self.encodeInHand(patch, in_hand.to(self.device))
 
         q2 = self.q2
@@ -64,6 +91,13 @@ class DQN3DASR(Base3D):
 
             return q2_output
 
+    @staticmethod
+    def _selectEncoding(obs_encoding, batch_idx):
+        """
+        index the obs_encoding returned by forwardFCN, which is not a tensor for non-cascade q1 networks
+        """
+        return obs_encoding[batch_idx] if torch.is_tensor(obs_encoding) else obs_encoding
+
     def decodeA2(self, a2_id):
         rz_id = a2_id.reshape(a2_id.size(0), 1)
         rz = self.rzs[rz_id].reshape(a2_id.size(0), 1)
@@ -106,37 +140,44 @@ class DQN3DASR(Base3D):
     def getBoltzmannActions(self, states, in_hand, obs, temperature=1, eps=0, return_patch=False):
         with torch.no_grad():
             q_value_maps, obs_encoding = self.forwardFCN(states, in_hand, obs, to_cpu=True)
-            pixels = []
+            batch_size = q_value_maps.size(0)
             rand = torch.tensor(np.random.uniform(0, 1, states.size(0)))
             rand_mask = rand < eps
+            positive_pixels = self.get_positive_pixel_candidates_batch(obs, hm_threshold).cpu()
+            pixels = torch.empty(batch_size, 2, dtype=torch.long)
 
-            for batch_idx in range(q_value_maps.size(0)):
-                if rand_mask[batch_idx]:
-                    pixel = self.select_random_action_at_posi_pixel(obs, batch_idx, hm_threshold)
-                else:
-                    for iteration in range(10):
-                        positive_pixels = self.get_positive_pixel_candidates(obs, batch_idx, hm_threshold)
-                        pixel = torch_utils.argSoftmax2d(
-                            q_value_maps[batch_idx].reshape(1, 1, q_value_maps.size(-1), q_value_maps.size(-1))
-                            * positive_pixels,
-                            temperature)
-                        # pixel = torch_utils.argSoftmax2d(
-                        #     q_value_maps[batch_idx].reshape(1, 1, q_value_maps.size(-1), q_value_maps.size(-1)),
-                        #     temperature)
-
-                        if self.check_in_hand_not_emtpy_dilation(obs, batch_idx, pixel, hm_threshold):
-                            break
-                    if iteration == 9:
-                        print('Action been selected not at positive pixel.')
-
-                pixels.append(pixel)
-            pixels = torch.cat(pixels)
+            if rand_mask.sum() > 0:
+                pixels[rand_mask] = self.select_random_actions_at_posi_pixels(obs[rand_mask].cpu(),
+                                                                              positive_pixels[rand_mask])
+
+            if (~rand_mask).sum() > 0:
+                # draw num_candidates pixels for every observation, and select the first one whose patch is not empty
+                num_candidates = 10
+                greedy_idx = torch.nonzero(~rand_mask).squeeze(1)
+                candidates = torch_utils.argSoftmax2d(q_value_maps[greedy_idx].unsqueeze(1)
+                                                      * positive_pixels[greedy_idx],
+                                                      temperature, num_samples=num_candidates, replacement=True)
+                candidates = candidates.reshape(-1, num_candidates, 2)
+                # most first candidates pass, so only the observations whose first candidate fails check the rest
+                not_empty = torch.zeros(candidates.size(0), num_candidates, dtype=torch.bool)
+                not_empty[:, 0] = self.check_in_hand_not_emtpy_dilation_batch(obs, greedy_idx, candidates[:, 0],
+                                                                              hm_threshold).cpu()
+                retry = torch.nonzero(~not_empty[:, 0]).squeeze(1)
+                if retry.size(0) > 0:
+                    not_empty[retry, 1:] = self.check_in_hand_not_emtpy_dilation_batch(
+                        obs, greedy_idx[retry].repeat_interleave(num_candidates - 1),
+                        candidates[retry, 1:].reshape(-1, 2), hm_threshold).cpu().reshape(-1, num_candidates - 1)
+                has_not_empty = not_empty.any(1)
+                if not has_not_empty.all():
+                    print('Action been selected not at positive pixel.')
+                selected = torch.where(has_not_empty, not_empty.float().argmax(1),
+                                       torch.full_like(has_not_empty, num_candidates - 1, dtype=torch.long))
+                pixels[greedy_idx] = candidates[torch.arange(candidates.size(0)), selected]
 
             q2_output = self.forwardQ2(states, in_hand, obs, obs_encoding, pixels, to_cpu=True)
             a2_id = torch_utils.argSoftmax1d(q2_output, temperature)
             if rand_mask.sum() > 0:
-                rand_a2 = torch.randint_like(torch.empty(rand_mask.sum()), 0, self.a2_size)
-                a2_id[rand_mask] = rand_a2.long()
+                a2_id[rand_mask] = torch.randint(0, self.a2_size, (int(rand_mask.sum()), 1))
 
         if return_patch:
             patch = self.getPatch(obs.to(self.device), pixels.to(self.device), torch.zeros(pixels.size(0)))
@@ -159,24 +200,46 @@ class DQN3DASR(Base3D):
 
         q1_output, obs_encoding = self.forwardFCN(states, obs[1], obs[0])
         q1_pred = q1_output[torch.arange(0, batch_size), pixel[:, 0], pixel[:, 1]]
-        q2_output = self.forwardQ2(states, obs[1], obs[0], obs_encoding, pixel)
+        q2_raw_patch = self.getQ2RawPatch(obs[0], obs_encoding, pixel)
+        q2_output = self.forwardQ2Patch(states, obs[1], obs_encoding, q2_raw_patch)
         q2_pred = q2_output[torch.arange(batch_size), a2_idx[:, 0]]
 
         self.loss_calc_dict['q_target'] = q_target
         self.loss_calc_dict['q1_output'] = q1_output
         self.loss_calc_dict['q2_output'] = q2_output
 
-        # q1_failure_target: the target for q1 when grasp failed
         success_mask = rewards.long() > 0
         failure_mask = rewards.clone() < 1
         q1_success_target = q_target[success_mask]
-        if failure_mask.sum() != 0:
+        failure_idx = torch.nonzero(failure_mask).squeeze(1)
+        num_failure = failure_idx.size(0)
+
+        # q2 targets for the failure grasps (L1') and for the BoltzmannN samples of q1 (L1"), in one q2 forward.
+        # The BoltzmannN samples are stacked sample-major: the i-th group holds the i-th sample of every transition
+        BoltzmannN = int(q2_train_q1[9:])
+        q1_BoltzmannN_idx, q1_BoltzmannN_1d_idx = torch_utils.argSoftmax2d(q1_output, 1, num_samples=BoltzmannN,
+                                                                           return_1d_idx=True)
+        q1_BoltzmannN_idx = q1_BoltzmannN_idx.reshape(batch_size, BoltzmannN, 2).transpose(0, 1).reshape(-1, 2)
+        with torch.no_grad():
+            # the obs repeated sample-major like the pixels, so that all the patches are cropped in one getPatch
+            BoltzmannN_batch_idx = torch.arange(batch_size, device=states.device).repeat(BoltzmannN)
+            q2_BoltzmannN_raw_patch = self.getQ2RawPatch(obs[0][BoltzmannN_batch_idx],
+                                                         self._selectEncoding(obs_encoding, BoltzmannN_batch_idx),
+                                                         q1_BoltzmannN_idx)
+            target_batch_idx = torch.cat((failure_idx, BoltzmannN_batch_idx))
+            # the patches of the failure grasps are the ones already extracted for q2_pred
+            q2_target_output = self.forwardQ2Patch(states[target_batch_idx], obs[1][target_batch_idx],
+                                                   self._selectEncoding(obs_encoding, target_batch_idx),
+                                                   torch.cat((q2_raw_patch[failure_idx], q2_BoltzmannN_raw_patch)),
+                                                   group_sizes=[num_failure] * (num_failure > 0)
+                                                               + [batch_size] * BoltzmannN)
+
+        # q1_failure_target: the target for q1 when grasp failed
+        if num_failure != 0:
             with torch.no_grad():
-                obs_failure_encoding = obs_encoding if not obs_encoding else obs_encoding[failure_mask]
-                non_action_max_q2 = self.forwardQ2(states[failure_mask], obs[1][failure_mask], obs[0][failure_mask],
-                                                   obs_failure_encoding, pixel[failure_mask])
+                non_action_max_q2 = q2_target_output[:num_failure]
                 failure_a2_idx = a2_idx[failure_mask, 0]
-                non_action_max_q2[torch.arange(failure_mask.sum()), failure_a2_idx] = 0
+                non_action_max_q2[torch.arange(num_failure), failure_a2_idx] = 0
                 q1_failure_target = non_action_max_q2.max(-1)[0].clamp(0, 1)
         else:
             q1_failure_target = torch.tensor([]).to(q_target.device)
@@ -193,25 +256,10 @@ class DQN3DASR(Base3D):
 
         # L1"
         # off-policy loss that minimizes the gap between q1 and q2
-        BoltzmannN = int(q2_train_q1[9:])
-        q1_BoltzmannN_idx, q1_BoltzmannN_1d_idx = torch_utils.argSoftmax2d(q1_output, 1, num_samples=BoltzmannN,
-                                                                           return_1d_idx=True)
-        q1_BoltzmannN_idx = q1_BoltzmannN_idx.reshape(batch_size, BoltzmannN, 2)
-        q1_BoltzmannN_value = []
-        q1_BoltzmannN_target = []
-        with torch.no_grad():
-            for Boltzmann_i in range(0, BoltzmannN):
-                q2_BoltzmannN_prime = self.forwardQ2(states, obs[1], obs[0], obs_encoding,
-                                                     q1_BoltzmannN_idx[:, Boltzmann_i, :])
-                q1_BoltzmannN_target.append(q2_BoltzmannN_prime.max(1)[0].reshape(batch_size, -1))
-        for Boltzmann_i in range(0, BoltzmannN):
-            q1_BoltzmannN_value.append(q1_output.reshape(batch_size, -1)[torch.arange(batch_size),
-                                                                         q1_BoltzmannN_1d_idx[:, Boltzmann_i]]
-                                       .reshape(batch_size, -1))
-        q1_BoltzmannN_value = torch.cat(q1_BoltzmannN_value, dim=1).clamp(0, 1)
-        q1_BoltzmannN_target = torch.cat(q1_BoltzmannN_target, dim=1).clamp(0, 1)
-        q1_td_loss += F.smooth_l1_loss(q1_BoltzmannN_value.reshape(batch_size, -1),
-                                       q1_BoltzmannN_target.reshape(batch_size, -1))
+        q1_BoltzmannN_value = q1_output.reshape(batch_size, -1).gather(1, q1_BoltzmannN_1d_idx).clamp(0, 1)
+        q1_BoltzmannN_target = q2_target_output[num_failure:].max(1)[0].reshape(BoltzmannN, batch_size).t()\
+            .clamp(0, 1)
+        q1_td_loss += F.smooth_l1_loss(q1_BoltzmannN_value, q1_BoltzmannN_target)
 
         # L2
         q2_td_loss = F.smooth_l1_loss(q2_pred, q_target)
@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from utils.parameters import action_pixel_range, action_space_size
+from storage.buffer import TransitionBatch
 
 
 class BaseAgent:
@@ -34,6 +35,8 @@ class BaseAgent:
 
         self.patch_div_factor = 1
         self.patch_mul_factor = 300
+        # device -> (rzs, rotation matrices of rzs), see _getRotationMats
+        self._rzs_rot_mats = {}
 
         self.loss_calc_dict = {}
 
@@ -101,7 +104,7 @@ class BaseAgent:
     def update(self, batch):
         """
         perform an update step
-        :param batch: batch data, list of transitions
+        :param batch: batch data, list of transitions or TransitionBatch
         :return: loss, td_error
         """
         raise NotImplementedError
@@ -153,28 +156,66 @@ class BaseAgent:
         :param rz: B
         :return: image patch
         """
-        img_size = obs.size(2)
-        transition = (center_pixel - obs.size(2) / 2).float().flip(1)
-        transition_scaled = transition / obs.size(2) * 2
+        img_h, img_w = obs.size(2), obs.size(3)
+        if self._isIntegerCrop(center_pixel, rz, img_h, img_w):
+            return self._cropPatch(obs, center_pixel)
 
-        affine_mats = []
-        for rot in rz:  # 0 rotation can be optimized
-            affine_mat = np.asarray([[np.cos(rot), np.sin(rot)],
-                                     [-np.sin(rot), np.cos(rot)]])
-            affine_mat.shape = (2, 2, 1)
-            affine_mat = torch.from_numpy(affine_mat.astype('float64')).permute(2, 0, 1).float().to(self.device)
-            affine_mats.append(affine_mat)
-        affine_mat = torch.cat(affine_mats)
-        if obs.is_cuda:
-            affine_mat = affine_mat.to(self.device)
-        affine_mat = torch.cat((affine_mat, transition_scaled.unsqueeze(2).float()), dim=2)
-        flow_grid = F.affine_grid(affine_mat, obs.size(), align_corners=False)
-        transformed = F.grid_sample(obs, flow_grid, mode='bilinear', padding_mode='border', align_corners=False)
-        patch = transformed[:, :,
-                int(img_size / 2 - self.patch_size / 2):int(img_size / 2 + self.patch_size / 2),
-                int(img_size / 2 - self.patch_size / 2):int(img_size / 2 + self.patch_size / 2)]
+        transition = (center_pixel.to(obs.device) - obs.size(2) / 2).float().flip(1)
+        transition_scaled = transition / obs.size(2) * 2
+        # only the output grid of the patch is sampled. The patch is the center crop of the full size output grid,
+        # whose normalized coordinates are the ones of the patch sized grid scaled by patch_size / image_size
+        scale = torch.tensor([self.patch_size / img_w, self.patch_size / img_h], device=obs.device)
+        affine_mat = torch.cat((self._getRotationMats(rz, obs.device) * scale, transition_scaled.unsqueeze(2)), dim=2)
+        flow_grid = F.affine_grid(affine_mat, (obs.size(0), obs.size(1), self.patch_size, self.patch_size),
+                                  align_corners=False)
+        patch = F.grid_sample(obs, flow_grid, mode='bilinear', padding_mode='border', align_corners=False)
         return patch
 
+    def _isIntegerCrop(self, center_pixel, rz, img_h, img_w):
+        """
+        whether getPatch is a pure integer crop, i.e., no rotation and the sampling grid falls on the pixel centers
+        """
+        if center_pixel.is_floating_point() or img_h % 2 or img_w % 2 or self.patch_size % 2:
+            return False
+        if torch.is_tensor(rz):
+            return not rz.bool().any()
+        return not np.any(rz)
+
+    def _cropPatch(self, obs, center_pixel):
+        """
+        getPatch with rz = 0 and integer center_pixel. The bilinear sampling is exact at the pixel centers and the
+        border padding is a clamp of the indexes
+        """
+        offsets = torch.arange(self.patch_size, device=obs.device) - self.patch_size // 2
+        center_pixel = center_pixel.to(obs.device)
+        rows = (center_pixel[:, 0:1] + offsets).clamp(0, obs.size(2) - 1)
+        cols = (center_pixel[:, 1:2] + offsets).clamp(0, obs.size(3) - 1)
+        flat_idx = (rows.unsqueeze(2) * obs.size(3) + cols.unsqueeze(1)).reshape(obs.size(0), 1, -1)
+        patch = obs.reshape(obs.size(0), obs.size(1), -1).gather(2, flat_idx.expand(-1, obs.size(1), -1))
+        return patch.reshape(obs.size(0), obs.size(1), self.patch_size, self.patch_size)
+
+    def _getRotationMats(self, rz, device):
+        """
+        get the Bx2x2 rotation part of the getPatch affine matrices. Rotations on the self.rzs grid are looked up from
+        a per device cache, the others are computed in one op
+        """
+        rz = torch.as_tensor(rz).reshape(-1).to(device)
+        rzs = getattr(self, 'rzs', None)
+        if rzs is not None and rz.size(0) > 0:
+            if device not in self._rzs_rot_mats:
+                self._rzs_rot_mats[device] = (rzs.to(device), self._computeRotationMats(rzs).to(device))
+            cached_rzs, cached_mats = self._rzs_rot_mats[device]
+            match = rz.float().unsqueeze(1) == cached_rzs.unsqueeze(0)
+            if match.any(1).all():
+                return cached_mats[match.long().argmax(1)]
+        return self._computeRotationMats(rz)
+
+    @staticmethod
+    def _computeRotationMats(rz):
+        rz = rz.double()
+        cos, sin = torch.cos(rz), torch.sin(rz)
+        return torch.stack((torch.stack((cos, sin), dim=1), torch.stack((-sin, cos), dim=1)), dim=1).float()
+
     def normalizePatch(self, patch):
         """
         normalize the input patch by first dividing self.patch_div_factor the multiplying self.patch_mul_factor
@@ -189,9 +230,11 @@ class BaseAgent:
         """
         load the input batch in list of transitions into tensors, and save them in self.loss_calc_dict. obs and in_hand
         are saved as tuple in obs
-        :param batch: batch data, list of transitions
+        :param batch: batch data, list of transitions or TransitionBatch
         :return: batch_size, states, obs, action_idx, rewards, next_states, next_obs, non_final_masks, step_lefts, is_experts
         """
+        if isinstance(batch, TransitionBatch):
+            return self._loadTensorBatchToDevice(batch)
         states = []
         images = []
         in_hands = []
@@ -250,6 +293,47 @@ class BaseAgent:
         return states_tensor, (image_tensor, in_hand_tensor), xy_tensor, rewards_tensor, next_states_tensor, \
                (next_obs_tensor, next_in_hands_tensor), non_final_masks, step_lefts_tensor, is_experts_tensor
 
+    def _loadTensorBatchToDevice(self, batch):
+        """
+        load the input TransitionBatch, whose fields are already stacked, into self.loss_calc_dict
+        :param batch: TransitionBatch
+        :return: batch_size, states, obs, action_idx, rewards, next_states, next_obs, non_final_masks, step_lefts, is_experts
+        """
+        batch_size = batch.state.size(0)
+        states_tensor = batch.state.reshape(batch_size).long().to(self.device)
+        image_tensor = batch.obs.to(self.device)
+        if len(image_tensor.shape) == 3:
+            image_tensor = image_tensor.unsqueeze(1)
+        in_hand_tensor = batch.in_hand.to(self.device)
+        if len(in_hand_tensor.shape) == 3:
+            in_hand_tensor = in_hand_tensor.unsqueeze(1)
+        xy_tensor = batch.action.to(self.device)
+        rewards_tensor = batch.reward.reshape(batch_size).to(self.device)
+        next_states_tensor = batch.next_state.reshape(batch_size).long().to(self.device)
+        next_obs_tensor = batch.next_obs.to(self.device)
+        if len(next_obs_tensor.shape) == 3:
+            next_obs_tensor = next_obs_tensor.unsqueeze(1)
+        next_in_hands_tensor = batch.next_in_hand.to(self.device)
+        if len(next_in_hands_tensor.shape) == 3:
+            next_in_hands_tensor = next_in_hands_tensor.unsqueeze(1)
+        non_final_masks = (batch.done.reshape(batch_size).int() ^ 1).float().to(self.device)
+        step_lefts_tensor = batch.step_left.reshape(batch_size).to(self.device)
+        is_experts_tensor = batch.expert.reshape(batch_size).bool().to(self.device)
+
+        self.loss_calc_dict['batch_size'] = batch_size
+        self.loss_calc_dict['states'] = states_tensor
+        self.loss_calc_dict['obs'] = (image_tensor, in_hand_tensor)
+        self.loss_calc_dict['action_idx'] = xy_tensor
+        self.loss_calc_dict['rewards'] = rewards_tensor
+        self.loss_calc_dict['next_states'] = next_states_tensor
+        self.loss_calc_dict['next_obs'] = (next_obs_tensor, next_in_hands_tensor)
+        self.loss_calc_dict['non_final_masks'] = non_final_masks
+        self.loss_calc_dict['step_lefts'] = step_lefts_tensor
+        self.loss_calc_dict['is_experts'] = is_experts_tensor
+
+        return states_tensor, (image_tensor, in_hand_tensor), xy_tensor, rewards_tensor, next_states_tensor, \
+               (next_obs_tensor, next_in_hands_tensor), non_final_masks, step_lefts_tensor, is_experts_tensor
+
     def _loadLossCalcDict(self):
         """
         get the loaded batch data in self.loss_calc_dict
@@ -34,7 +34,7 @@ def getEnvFn(simulator, env_type):
         raise ValueError('Invalid simulator passed to factory. Valid simulators are: \'numpy\', \'pybullet\'.')
 
 
-def createEnvs(num_processes, simulator, env_type, env_config, planner_config={}):
+def createEnvs(num_processes, simulator, env_type, env_config, planner_config={}, shared_obs_slots=0):
     '''
   Wrapper function to create either a single env the the main process or some
   number of envs each in their own seperate process.
@@ -42,7 +42,8 @@ def createEnvs(num_processes, simulator, env_type, env_config, planner_config={}
     if num_processes == 0:
         return createSingleProcessEnv(simulator, env_type, env_config, planner_config)
     else:
-        return createMultiprocessEnvs(num_processes, simulator, env_type, env_config, planner_config)
+        return createMultiprocessEnvs(num_processes, simulator, env_type, env_config, planner_config,
+                                      shared_obs_slots)
 
 
 def createSingleProcessEnv(simulator, env_type, env_config, planner_config={}):
@@ -76,7 +77,7 @@ def createSingleProcessEnv(simulator, env_type, env_config, planner_config={}):
     return SingleRunner(env, planner)
 
 
-def createMultiprocessEnvs(num_processes, simulator, env_type, env_config, planner_config={}):
+def createMultiprocessEnvs(num_processes, simulator, env_type, env_config, planner_config={}, shared_obs_slots=0):
     '''
   Create a number of environments on different processes to run in parralel
 
@@ -86,6 +87,7 @@ def createMultiprocessEnvs(num_processes, simulator, env_type, env_config, plann
     - env_type: String indicating the type of environment to create
     - env_config: Dict containing intialization arguments for the env
     - planner_config: Dict containing intialization arguments for the planner
+    - shared_obs_slots: Number of slots of the MultiRunner shared observation ring, 0 to use the pipes
 
   Returns: MultiRunner containing all environments
   '''
@@ -115,4 +117,4 @@ def createMultiprocessEnvs(num_processes, simulator, env_type, env_config, plann
         #       more refactoring of the multi process stuff then I want to do atm
         planners = [None for i in range(num_processes)]
 
-    return MultiRunner(envs, planners)
+    return MultiRunner(envs, planners, shared_obs_slots)
@@ -246,11 +246,93 @@ class BaseEnv(object):
            p[1] > self.workspace[1][0] - 0.1 and p[1] < self.workspace[1][1] + 0.1 and \
            p[2] > self.workspace[2][0] and p[2] < self.workspace[2][1]
 
+  def _snapToPosCandidate(self, positions):
+    '''
+    Move positions to the closest position candidates
+    Args:
+      - positions: N x 2 array of (x, y) positions, updated in place
+    Returns: positions
+    '''
+    for i in range(2):
+      candidate = np.asarray(self.pos_candidate[i])
+      positions[:, i] = candidate[np.abs(candidate.reshape(1, -1) - positions[:, i:i+1]).argmin(1)]
+    return positions
+
+  def _isFarFromPositions(self, points, positions, min_distance):
+    '''
+    Checks which points are further than min_distance from all the given positions
+    Args:
+      - points: N x 2 array of (x, y) points
+      - positions: List of (x, y) positions
+      - min_distance: Minimum distance
+    Returns: N boolean array
+    '''
+    if len(positions) == 0:
+      return np.ones(len(points), dtype=bool)
+    positions = np.asarray(positions)
+    dx = points[:, 0:1] - positions[:, 0].reshape(1, -1)
+    dy = points[:, 1:2] - positions[:, 1].reshape(1, -1)
+    return (dx ** 2 + dy ** 2 > min_distance ** 2).all(1)
+
+  def _acceptValidPositions(self, sample, min_distance, existing_positions, num_shapes, max_tries, chunk_size=32):
+    '''
+    Greedily accept random candidate positions as if they were tried one at a time: each shape takes the first valid
+    candidate, within max_tries candidates. Candidates are drawn and checked against all the positions at once, in
+    chunks of chunk_size.
+    Args:
+      - sample: Function drawing n candidates, returning an n x 2 array of (x, y) positions and an n boolean array of
+                the candidates within the border padding
+      - min_distance: Minimum distance to the existing and accepted positions
+      - existing_positions: List of (x, y) positions
+      - num_shapes: Number of positions to accept
+      - max_tries: Number of candidates tried per shape
+      - chunk_size: Number of candidates drawn at once
+    Returns: List of accepted [x, y] positions, shorter than num_shapes if a shape ran out of tries
+    '''
+    positions = list(existing_positions)
+    accepted = list()
+    for i in range(num_shapes):
+      tries = 0
+      while tries < max_tries:
+        n = min(chunk_size, max_tries - tries)
+        candidates, valid = sample(n)
+        valid = np.flatnonzero(valid & self._isFarFromPositions(candidates, positions, min_distance))
+        if len(valid) > 0:
+          position = candidates[valid[0]].tolist()
+          accepted.append(position)
+          positions.append(position)
+          break
+        tries += n
+      else:
+        break
+    return accepted
+
+  def _getValidGridPositions(self, grid, min_distance, existing_positions, num_shapes):
+    '''
+    Fallback of the random candidates for dense scenes. Each position is picked at random among the points of a grid
+    further than min_distance from the existing and previously picked positions.
+    Args:
+      - grid: N x 2 array of (x, y) grid points
+      - min_distance: Minimum distance to the existing and picked positions
+      - existing_positions: List of (x, y) positions
+      - num_shapes: Number of positions to pick
+    Returns: List of picked [x, y] positions, shorter than num_shapes if the grid is full
+    '''
+    valid = self._isFarFromPositions(grid, existing_positions, min_distance)
+    positions = list()
+    for i in range(num_shapes):
+      free = np.flatnonzero(valid)
+      if len(free) == 0:
+        break
+      j = free[npr.randint(len(free))]
+      positions.append(grid[j].tolist())
+      valid &= (grid[:, 0] - grid[j, 0]) ** 2 + (grid[:, 1] - grid[j, 1]) ** 2 > min_distance ** 2
+    return positions
+
   def getInHandImage(self, heightmap, x, y, z, rot, next_heightmap):
     (rx, ry, rz) = rot
-    # Pad heightmaps for grasps near the edges of the workspace
-    heightmap = np.pad(heightmap, int(self.in_hand_size / 2), 'constant', constant_values=0.0)
-    next_heightmap = np.pad(next_heightmap, int(self.in_hand_size / 2), 'constant', constant_values=0.0)
+    # Crop coordinates are in the heightmaps padded by in_hand_size/2 for grasps near the edges of the workspace
+    pad = int(self.in_hand_size / 2)
 
     x, y = self._getPixelsFromPos(x, y)
     x = np.clip(x, self.in_hand_size / 2, self.heightmap_size-1-self.in_hand_size/2)
@@ -265,9 +347,9 @@ class BaseEnv(object):
     y_max = int(y + self.in_hand_size / 2)
 
     # Crop both heightmaps
-    crop = heightmap[x_min:x_max, y_min:y_max]
+    crop = self._cropHeightmap(heightmap, x_min - pad, x_max - pad, y_min - pad, y_max - pad)
     if self.in_hand_mode.find('sub') > -1:
-      next_crop = next_heightmap[x_min:x_max, y_min:y_max]
+      next_crop = self._cropHeightmap(next_heightmap, x_min - pad, x_max - pad, y_min - pad, y_max - pad)
 
       # Adjust the in-hand image to remove background objects
       next_max = np.max(next_crop)
@@ -277,27 +359,97 @@ class BaseEnv(object):
       return self.getInHandOccupancyGridProj(crop, z, rot)
     else:
       # end_effector rotate counter clockwise along z, so in hand img rotate clockwise
-      crop = sk_transform.rotate(crop, np.rad2deg(-rz))
+      crop = self._rotateInHandImage(crop, rz)
       return crop.reshape((1, self.in_hand_size, self.in_hand_size))
 
+  def _cropHeightmap(self, heightmap, x_min, x_max, y_min, y_max):
+    '''
+    Crop heightmap[x_min:x_max, y_min:y_max] into a new array. The part of the crop out of the heightmap is 0, as
+    if the heightmap was zero padded, without padding the full heightmap.
+    Args:
+      - heightmap: The heightmap to crop
+      - x_min, x_max, y_min, y_max: Corners of the crop, may be out of the heightmap
+    Returns: (x_max - x_min) x (y_max - y_min) crop
+    '''
+    crop = np.zeros((x_max - x_min, y_max - y_min), dtype=heightmap.dtype)
+    x0, x1 = max(x_min, 0), min(x_max, heightmap.shape[0])
+    y0, y1 = max(y_min, 0), min(y_max, heightmap.shape[1])
+    if x0 < x1 and y0 < y1:
+      crop[x0 - x_min:x1 - x_min, y0 - y_min:y1 - y_min] = heightmap[x0:x1, y0:y1]
+    return crop
+
+  def _getInHandRotationRemap(self, rz):
+    '''
+    Get the bilinear remap of sk_transform.rotate(crop, np.rad2deg(-rz)) for in_hand_size crops. The remap only
+    depends on the angle, it is cached per angle.
+    Args:
+      - rz: Rotation of the end effector
+    Returns: (index, dr, dc). index is the 4 x N flat index of the top left, top right, bottom left and bottom right
+             neighbours of each output pixel, pointing at an extra 0 pixel for neighbours out of the crop. dr and dc
+             are the row and column interpolation weights.
+    '''
+    if not hasattr(self, 'in_hand_remaps'):
+      self.in_hand_remaps = {}
+    key = float(rz)
+    if key in self.in_hand_remaps:
+      return self.in_hand_remaps[key]
+
+    size = self.in_hand_size
+    # same transform as sk_transform.rotate, from output to input pixel coordinates
+    center = np.array((size, size)) / 2.0 - 0.5
+    tform = sk_transform.SimilarityTransform(translation=-center) + \
+            sk_transform.SimilarityTransform(rotation=np.deg2rad(np.rad2deg(-key))) + \
+            sk_transform.SimilarityTransform(translation=center)
+    m = tform.params
+    rows, cols = np.mgrid[0:size, 0:size].reshape(2, -1)
+    c = m[0, 0] * cols + m[0, 1] * rows + m[0, 2]
+    r = m[1, 0] * cols + m[1, 1] * rows + m[1, 2]
+
+    min_r, min_c, max_r, max_c = np.floor(r), np.floor(c), np.ceil(r), np.ceil(c)
+    index = []
+    for nr, nc in ((min_r, min_c), (min_r, max_c), (max_r, min_c), (max_r, max_c)):
+      inside = (nr >= 0) & (nr < size) & (nc >= 0) & (nc < size)
+      index.append(np.where(inside, nr * size + nc, size * size).astype(int))
+    remap = (np.stack(index), r - min_r, c - min_c)
+    self.in_hand_remaps[key] = remap
+    return remap
+
+  def _rotateInHandImage(self, crop, rz):
+    '''
+    Rotate an in_hand_size crop by -rz as sk_transform.rotate(crop, np.rad2deg(-rz)), i.e., bilinear interpolation
+    with 0 outside of the crop, using the cached remap of the angle.
+    Args:
+      - crop: in_hand_size x in_hand_size crop
+      - rz: Rotation of the end effector
+    Returns: Rotated crop
+    '''
+    index, dr, dc = self._getInHandRotationRemap(rz)
+    pixels = np.append(crop.astype(np.float64).reshape(-1), 0.)[index]
+    top = (1 - dc) * pixels[0] + dc * pixels[1]
+    bottom = (1 - dc) * pixels[2] + dc * pixels[3]
+    rotated = (1 - dr) * top + dr * bottom
+    # sk_transform.rotate clips the output to the input range
+    rotated = np.clip(rotated, min(crop.min(), 0), max(crop.max(), 0))
+    return rotated.reshape(crop.shape)
+
   def getInHandOccupancyGridProj(self, crop, z, rot):
     rx, ry, rz = rot
     # crop = zoom(crop, 2)
     crop = np.round(crop, 5)
     size = self.in_hand_size
 
-    zs = np.array([z+(-size/2+i)*(self.heightmap_resolution) for i in range(size)])
-    zs = zs.reshape((1, 1, -1))
-    zs = zs.repeat(size, 0).repeat(size, 1)
+    zs = z + (-size/2 + np.arange(size)) * self.heightmap_resolution
+    R = transformations.euler_matrix(rx, ry, rz)[:3, :3].T
+    if R[2, 2] == 1 and not R[2, :2].any() and not R[:2, 2].any():
+      return self._getInHandColumnProj(crop, zs, R[:2, :2])
+
     # zs[zs<-(self.heightmap_resolution)] = 100
-    c = crop.reshape(size, size, 1).repeat(size, 2)
-    ori_occupancy = c > zs
+    ori_occupancy = crop.reshape(size, size, 1) > zs.reshape(1, 1, size)
 
     # transform into points
     point = np.argwhere(ori_occupancy)
     # center
     ori_point = point - size/2
-    R = transformations.euler_matrix(rx, ry, rz)[:3, :3].T
     point = R.dot(ori_point.T)
     point = point + size/2
     point = np.round(point).astype(int)
@@ -317,6 +469,45 @@ class BaseEnv(object):
     # fig.show()
     return projection
 
+  def _getInHandColumnProj(self, crop, zs, R):
+    '''
+    getInHandOccupancyGridProj for a rotation around z only, without the size^3 occupancy grid. Every (x, y) column
+    of the occupancy grid is then occupied over a range of z: the columns are rotated as points of the xy plane,
+    the 2x2x2 median filter is evaluated on the column ranges and the projections are summed from the ranges.
+    Args:
+      - crop: Rounded in hand crop
+      - zs: Height of each z slice of the occupancy grid
+      - R: 2x2 rotation of the xy plane
+    Returns: size x size x 3 projections
+    '''
+    size = self.in_hand_size
+    # column (x, y) is occupied for z in [0, height), z = 0 is dropped by the rotation filter
+    height = np.searchsorted(zs, crop.reshape(-1), side='left').reshape(size, size)
+    ori_point = np.argwhere(height > 0)
+    point = np.round(R.dot((ori_point - size/2).T) + size/2).astype(int)
+    valid = np.logical_and(0 < point, point < size).all(0)
+    # the rotated columns are the union, i.e. the highest, of the columns rotated onto them
+    columns = np.zeros((size, size), dtype=int)
+    np.maximum.at(columns, (point[0, valid], point[1, valid]), height[ori_point[valid, 0], ori_point[valid, 1]])
+
+    # median over the 2x2x2 window at offsets -1 and 0 with reflected borders, i.e. at least 4 occupied voxels
+    padded = np.pad(columns, ((1, 0), (1, 0)), mode='edge')
+    h = np.sort(np.stack((padded[:-1, :-1], padded[:-1, 1:], padded[1:, :-1], padded[1:, 1:])), axis=0)
+    # z = 1 needs all 4 columns occupied at z = 1. z >= 2 is occupied below the first z with less than 4 voxels
+    low = np.where(h[0] >= 2, 1, 2)
+    high = np.minimum(np.maximum(np.maximum(h[2], np.minimum(h[3], h[1] + 1)), h[0] + 1), size)
+    high = np.maximum(high, low)
+
+    # occupied z ranges of the columns, summed along x and along y as difference arrays
+    x, y = np.indices((size, size)) * (size + 1)
+    n = size * (size + 1)
+    proj_x = np.bincount((y + low).reshape(-1), minlength=n) - np.bincount((y + high).reshape(-1), minlength=n)
+    proj_y = np.bincount((x + low).reshape(-1), minlength=n) - np.bincount((x + high).reshape(-1), minlength=n)
+    proj_x = np.cumsum(proj_x.reshape(size, size + 1), 1)[:, :size]
+    proj_y = np.cumsum(proj_y.reshape(size, size + 1), 1)[:, :size]
+    projection = np.stack((proj_x, proj_y, high - low)).astype(float)
+    return np.rollaxis(projection, 0, 3)
+
   def getEmptyInHand(self):
     if self.in_hand_mode.find('proj') > -1:
       return np.zeros((3, self.in_hand_size, self.in_hand_size))
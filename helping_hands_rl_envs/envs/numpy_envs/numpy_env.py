@@ -103,6 +103,8 @@ class NumpyEnv(BaseEnv):
 
   def takeAction(self, action):
     motion_primative, x, y, z, rot = self._decodeAction(action)
+    # objects only rotate around z
+    rot = rot[2]
 
     if motion_primative == constants.PICK_PRIMATIVE:
       self.held_object = self._pick(x, y, z, rot)
@@ -234,36 +236,27 @@ class NumpyEnv(BaseEnv):
     return self._isHolding(), in_hand_img, self.heightmap.reshape([self.heightmap_size, self.heightmap_size, 1])
 
   def _getValidPositions(self, padding, min_distance, existing_positions, num_shapes):
+    '''
+    Sample (x, y) pixel positions within the workspace minus padding/2, further than min_distance from the existing
+    positions and from each other, with up to 1000 random candidates per shape and the pixel grid as fallback for
+    dense scenes.
+    '''
+    low = np.array([self.workspace[0][0], self.workspace[1][0]]) + padding / 2
+    high = np.array([self.workspace[0][1], self.workspace[1][1]]) - padding / 2
+    def sample(n):
+      candidates = ((high - low) * npr.random_sample((n, 2)) + low).astype(int)
+      if self.pos_candidate is not None:
+        self._snapToPosCandidate(candidates)
+      return candidates, np.ones(n, dtype=bool)
     while True:
-      existing_positions_copy = deepcopy(existing_positions)
-      valid_positions = []
-      for i in range(num_shapes):
-        # Generate random drop config
-        x_extents = self.workspace[0][1] - self.workspace[0][0]
-        y_extents = self.workspace[1][1] - self.workspace[1][0]
-
-        is_position_valid = False
-        for j in range(1000):
-          if is_position_valid:
-            break
-          position = [int((x_extents - padding) * npr.random_sample() + self.workspace[0][0] + padding / 2),
-                      int((y_extents - padding) * npr.random_sample() + self.workspace[1][0] + padding / 2)]
-          if self.pos_candidate is not None:
-            position[0] = self.pos_candidate[0][np.abs(self.pos_candidate[0] - position[0]).argmin()]
-            position[1] = self.pos_candidate[1][np.abs(self.pos_candidate[1] - position[1]).argmin()]
-
-          if existing_positions_copy:
-            # is_position_valid = np.all(
-            #   np.sum(np.abs(np.array(positions)[:, :2] - np.array(position)[:2]), axis=1) > min_distance)
-            distances = np.array(list(map(lambda p: np.linalg.norm(np.array(p) - position), existing_positions_copy)))
-            is_position_valid = np.all(distances > min_distance)
-          else:
-            is_position_valid = True
-        if is_position_valid:
-          existing_positions_copy.append(position)
-          valid_positions.append(position)
-        else:
-          break
+      valid_positions = self._acceptValidPositions(sample, min_distance, existing_positions, num_shapes, 1000)
+      if len(valid_positions) < num_shapes:
+        grid = np.stack(np.meshgrid(np.arange(int(low[0]), int(np.ceil(high[0]))),
+                                    np.arange(int(low[1]), int(np.ceil(high[1]))), indexing='ij'), -1).reshape(-1, 2)
+        if self.pos_candidate is not None:
+          grid = np.unique(self._snapToPosCandidate(grid), axis=0)
+        valid_positions += self._getValidGridPositions(grid, min_distance, list(existing_positions) + valid_positions,
+                                                       num_shapes - len(valid_positions))
       if len(valid_positions) == num_shapes:
         return valid_positions
 
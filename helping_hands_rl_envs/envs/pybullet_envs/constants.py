@@ -17,6 +17,30 @@ DEFAULT_CONFIG = {
   'object_scale_range': (0.60, 0.70),
   'max_steps' : 10,
   'obs_size' : 128,
+  # The heightmap is rendered at obs_size * render_scale. An integer > 1 supersamples and max pools the heightmap, < 1
+  # renders a lower resolution heightmap and upsamples it, which is faster but coarser
+  'render_scale' : 1,
+  # If True, only re-render the tiles of the heightmap covered by the bodies which moved since the last heightmap, and
+  # render the whole heightmap when the tiles cover more than incremental_heightmap_max_area of it
+  'incremental_heightmap' : False,
+  'incremental_heightmap_max_area' : 0.5,
+  # If True, wait(iteration) steps the simulation in chunks of wait_chunk steps, and stops before iteration steps once
+  # the linear (m/s) and angular (rad/s) velocities of all objects are below wait_linear_velocity and
+  # wait_angular_velocity
+  'adaptive_wait' : False,
+  'wait_chunk' : 10,
+  'wait_linear_velocity' : 0.005,
+  'wait_angular_velocity' : 0.05,
+  # If True, the clutter envs spawn all objects stacked in a column at reset without simulating in between, and settle
+  # them at once. Best with adaptive_wait
+  'batch_spawn' : False,
+  # Number of settled scenes the clutter envs keep to reset from, 0 to build every scene. A scene is a small record of
+  # the objects, and is dropped after scene_pool_max_reuse resets so new scenes keep coming in
+  'scene_pool_size' : 0,
+  'scene_pool_max_reuse' : 4,
+  # Path of a scene corpus generated by scripts/generate_scenes.py for the clutter envs to reset from, None to build
+  # every scene
+  'scene_corpus' : None,
   'fast_mode' : True,
   'render' : False,
   'physics_mode' : 'fast',
@@ -41,5 +65,8 @@ DEFAULT_CONFIG = {
   # gripper command before moving to pre pose. Adjusting after lifting will create more chance for a grasp, but while
   # moving to pre pose the gripper will shift around. Adjusting before lifting will make the gripper more stable while
   # moving to the pre pose, but will reduce the chance for a grasp, especially in the cluttered scene.
-  'adjust_gripper_after_lift': False
+  'adjust_gripper_after_lift': False,
+  # 'dynamic' or 'kinematic'. The kinematic pick teleports the arm through free space, and only simulates the descend,
+  # the grasp and a short lift to check the grasp
+  'pick_motion': 'dynamic'
 }
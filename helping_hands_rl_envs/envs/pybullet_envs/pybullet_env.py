@@ -92,6 +92,22 @@ class PyBulletEnv(BaseEnv):
     target_pos = [self.workspace[0].mean(), self.workspace[1].mean(), 0]
     cam_up_vector = [-1, 0, 0]
     self.sensor = Sensor(cam_pos, cam_up_vector, target_pos, ws_size, cam_pos[2] - 1, cam_pos[2])
+    # size of the rendered depth image of the heightmap
+    self.heightmap_render_size = int(round(self.heightmap_size * config['render_scale']))
+    # Only re-render the pixels of the bodies which moved since the last heightmap
+    self.incremental_heightmap = config['incremental_heightmap']
+    self.incremental_heightmap_max_area = config['incremental_heightmap_max_area']
+    # linear depth image of the last heightmap, and the AABBs of the (body, link) in it
+    self.depth_cache = None
+    self.aabb_cache = {}
+
+    # Stop waiting early once all objects are at rest
+    self.adaptive_wait = config['adaptive_wait']
+    self.wait_chunk = config['wait_chunk']
+    self.wait_linear_velocity = config['wait_linear_velocity']
+    self.wait_angular_velocity = config['wait_angular_velocity']
+    # number of wait calls, and the number of simulation steps they were given and ran
+    self.wait_stats = {'calls': 0, 'max_steps': 0, 'steps': 0}
 
     # Rest pose for arm
     rot = pb.getQuaternionFromEuler([0, np.pi, 0])
@@ -120,6 +136,7 @@ class PyBulletEnv(BaseEnv):
     self.half_rotation = config['half_rotation']
 
     self.robot.adjust_gripper_after_lift = config['adjust_gripper_after_lift']
+    self.robot.pick_motion = config['pick_motion']
 
     self.episode_count = -1
     self.table_id = None
@@ -133,6 +150,7 @@ class PyBulletEnv(BaseEnv):
   def initialize(self):
     ''''''
     pb.resetSimulation()
+    pb_obj_generation.clearShapeCache()
     pb.setPhysicsEngineParameter(numSubSteps=0,
                                  numSolverIterations=self.num_solver_iterations,
                                  useSplitImpulse=1,
@@ -316,9 +334,39 @@ class PyBulletEnv(BaseEnv):
     return True
 
   def wait(self, iteration):
+    '''
+    Step the simulation iteration times. With adaptive_wait, step in chunks of wait_chunk steps and stop once the
+    objects are at rest, see _isSettled.
+
+    Returns: The number of simulation steps
+    '''
     # if not self.simulate_grasp and self._isHolding():
     #   return
-    [pb.stepSimulation() for _ in range(iteration)]
+    if not self.adaptive_wait:
+      [pb.stepSimulation() for _ in range(iteration)]
+      steps = iteration
+    else:
+      steps = 0
+      while steps < iteration:
+        chunk = min(self.wait_chunk, iteration - steps)
+        [pb.stepSimulation() for _ in range(chunk)]
+        steps += chunk
+        if self._isSettled():
+          break
+    self.wait_stats['calls'] += 1
+    self.wait_stats['max_steps'] += iteration
+    self.wait_stats['steps'] += steps
+    return steps
+
+  def _isSettled(self):
+    '''
+    Check if the linear and angular velocities of all objects are below wait_linear_velocity and wait_angular_velocity
+    '''
+    for obj in self.objects:
+      linear, angular = pb.getBaseVelocity(obj.object_id)
+      if np.linalg.norm(linear) > self.wait_linear_velocity or np.linalg.norm(angular) > self.wait_angular_velocity:
+        return False
+    return True
 
   # TODO: This does not work w/cylinders
   def didBlockFall(self):
@@ -368,50 +416,136 @@ class PyBulletEnv(BaseEnv):
     return self._isHolding(), in_hand_img, self.heightmap.reshape([1, self.heightmap_size, self.heightmap_size])
 
   def _getHeightmap(self):
-    return self.sensor.getHeightmap(self.heightmap_size)
+    if self.incremental_heightmap:
+      return self._getIncrementalHeightmap()
+    return self.sensor.getHeightmap(self.heightmap_size, render_size=self.heightmap_render_size)
 
-  def _getValidPositions(self, border_padding, min_distance, existing_positions, num_shapes, sample_range=None):
-    existing_positions_copy = copy.deepcopy(existing_positions)
-    sample_range = copy.deepcopy(sample_range)
-    valid_positions = list()
-    for i in range(num_shapes):
-      # Generate random drop config
-      x_extents = self.getValidSpace()[0][1] - self.getValidSpace()[0][0]
-      y_extents = self.getValidSpace()[1][1] - self.getValidSpace()[1][0]
-
-      is_position_valid = False
-      for j in range(100):
-        if is_position_valid:
+  def _getIncrementalHeightmap(self):
+    '''
+    Render the heightmap by only re-rendering the tiles of the cached depth image covered by the bodies which moved
+    since the last heightmap. The whole image is rendered after a reset, or when the tiles cover more than
+    incremental_heightmap_max_area of it.
+    '''
+    size = self.heightmap_render_size
+    aabbs = self._getSceneAABBs()
+    tiles = None
+    if self.heightmap is not None and self.depth_cache is not None:
+      tiles = self._getDirtyTiles(aabbs)
+    if tiles is None:
+      self.depth_cache = self.sensor.depthToLinear(self.sensor.getDepthImage(size), (size, size))
+    else:
+      for rows, cols in tiles:
+        tile = self.depth_cache[rows[0]:rows[1], cols[0]:cols[1]]
+        self.sensor.depthToLinear(self.sensor.getDepthImage(size, rows, cols), tile.shape, out=tile)
+    self.aabb_cache = aabbs
+    heightmap = self.depth_cache.max() - self.depth_cache
+    if size == self.heightmap_size:
+      return heightmap
+    return self.sensor.resampleHeightmap(heightmap, self.heightmap_size)
+
+  def _getSceneAABBs(self):
+    '''
+    Get the AABBs of the base and the links of all bodies.
+
+    Returns: Dict of (body id, link index) -> 2x3 array of the min and max corners
+    '''
+    aabbs = {}
+    for i in range(pb.getNumBodies()):
+      body = pb.getBodyUniqueId(i)
+      for link in range(-1, pb.getNumJoints(body)):
+        aabbs[(body, link)] = np.array(pb.getAABB(body, link))
+    return aabbs
+
+  def _getDirtyTiles(self, aabbs):
+    '''
+    Get the tiles of the depth image to re-render, from the AABBs which moved by more than a tenth of a pixel since
+    self.aabb_cache or were added or removed. AABBs which moved less keep their cached value, so slow drifts are
+    still caught.
+
+    Args:
+      - aabbs: _getSceneAABBs of the current scene. Updated with the cached AABBs of the bodies which did not move
+
+    Returns: List of disjoint ((start, end) rows, (start, end) columns), or None to render the whole image
+    '''
+    size = self.heightmap_render_size
+    tolerance = 0.1 * self.heightmap_resolution
+    tiles = []
+    for key in set(aabbs) | set(self.aabb_cache):
+      new, old = aabbs.get(key), self.aabb_cache.get(key)
+      if new is not None and old is not None and np.abs(new - old).max() <= tolerance:
+        aabbs[key] = old
+        continue
+      for aabb in (old, new):
+        tile = None if aabb is None else self.sensor.getPixelBox(size, aabb)
+        if tile is not None:
+          tiles.append(tile)
+    tiles = self._mergeTiles(tiles)
+    area = sum((rows[1] - rows[0]) * (cols[1] - cols[0]) for rows, cols in tiles)
+    if area > self.incremental_heightmap_max_area * size * size:
+      return None
+    return tiles
+
+  @staticmethod
+  def _mergeTiles(tiles):
+    '''
+    Merge overlapping tiles into their bounding tile until all tiles are disjoint
+    '''
+    merged = True
+    while merged:
+      merged = False
+      for i in range(len(tiles)):
+        for j in range(i + 1, len(tiles)):
+          (ri, ci), (rj, cj) = tiles[i], tiles[j]
+          if ri[0] < rj[1] and rj[0] < ri[1] and ci[0] < cj[1] and cj[0] < ci[1]:
+            tiles[i] = ((min(ri[0], rj[0]), max(ri[1], rj[1])), (min(ci[0], cj[0]), max(ci[1], cj[1])))
+            del tiles[j]
+            merged = True
+            break
+        if merged:
           break
-        if sample_range:
-          sample_range[0][0] = max(sample_range[0][0], self.getValidSpace()[0][0]+border_padding/2)
-          sample_range[0][1] = min(sample_range[0][1], self.getValidSpace()[0][1]-border_padding/2)
-          sample_range[1][0] = max(sample_range[1][0], self.getValidSpace()[1][0]+border_padding/2)
-          sample_range[1][1] = min(sample_range[1][1], self.getValidSpace()[1][1]-border_padding/2)
-          position = [(sample_range[0][1] - sample_range[0][0]) * npr.random_sample() + sample_range[0][0],
-                      (sample_range[1][1] - sample_range[1][0]) * npr.random_sample() + sample_range[1][0]]
-        else:
-          position = [(x_extents - border_padding) * npr.random_sample() + self.getValidSpace()[0][0] + border_padding / 2,
-                      (y_extents - border_padding) * npr.random_sample() + self.getValidSpace()[1][0] +  border_padding / 2]
-
-        if self.pos_candidate is not None:
-          position[0] = self.pos_candidate[0][np.abs(self.pos_candidate[0] - position[0]).argmin()]
-          position[1] = self.pos_candidate[1][np.abs(self.pos_candidate[1] - position[1]).argmin()]
-          if not (self.getValidSpace()[0][0]+border_padding/2 < position[0] < self.getValidSpace()[0][1]-border_padding/2 and
-                  self.getValidSpace()[1][0]+border_padding/2 < position[1] < self.getValidSpace()[1][1]-border_padding/2):
-            continue
-
-        if existing_positions_copy:
-          distances = np.array(list(map(lambda p: np.linalg.norm(np.array(p)-position), existing_positions_copy)))
-          is_position_valid = np.all(distances > min_distance)
-          # is_position_valid = np.all(np.sum(np.abs(np.array(positions) - np.array(position[:-1])), axis=1) > min_distance)
-        else:
-          is_position_valid = True
-      if is_position_valid:
-        existing_positions_copy.append(position)
-        valid_positions.append(position)
+    return tiles
+
+  def _getValidPositions(self, border_padding, min_distance, existing_positions, num_shapes, sample_range=None):
+    '''
+    Sample (x, y) positions within the valid space minus border_padding/2, further than min_distance from the existing
+    positions and from each other, with up to 100 random candidates per shape. A grid of heightmap resolution over the
+    sample range is used as fallback for dense scenes.
+    Args:
+      - border_padding: Padding to the border of the valid space
+      - min_distance: Minimum distance between positions
+      - existing_positions: List of existing (x, y) positions
+      - num_shapes: Number of positions to sample
+      - sample_range: [[x_min, x_max], [y_min, y_max]] to sample in, within the padded valid space
+    Returns: List of [x, y] positions
+    '''
+    valid_space = self.getValidSpace()
+    low = np.array([valid_space[0][0], valid_space[1][0]]) + border_padding / 2
+    high = np.array([valid_space[0][1], valid_space[1][1]]) - border_padding / 2
+    sample_low, sample_high = low, high
+    if sample_range:
+      sample_low = np.maximum([sample_range[0][0], sample_range[1][0]], low)
+      sample_high = np.minimum([sample_range[0][1], sample_range[1][1]], high)
+
+    def sample(n):
+      candidates = (sample_high - sample_low) * npr.random_sample((n, 2)) + sample_low
+      if self.pos_candidate is None:
+        return candidates, np.ones(n, dtype=bool)
+      self._snapToPosCandidate(candidates)
+      return candidates, np.logical_and(low < candidates, candidates < high).all(1)
+    valid_positions = self._acceptValidPositions(sample, min_distance, existing_positions, num_shapes, 100)
+
+    if len(valid_positions) < num_shapes:
+      if self.pos_candidate is not None:
+        grid = np.stack(np.meshgrid(self.pos_candidate[0], self.pos_candidate[1], indexing='ij'), -1).reshape(-1, 2)
+        # the candidates within the valid space and the sample range
+        grid = grid[np.logical_and.reduce((low < grid, grid < high, sample_low <= grid, grid <= sample_high)).all(1)]
       else:
-        break
+        xs = np.arange(sample_low[0], sample_high[0], self.heightmap_resolution)
+        ys = np.arange(sample_low[1], sample_high[1], self.heightmap_resolution)
+        grid = np.stack(np.meshgrid(xs, ys, indexing='ij'), -1).reshape(-1, 2)
+      valid_positions += self._getValidGridPositions(grid, min_distance, list(existing_positions) + valid_positions,
+                                                     num_shapes - len(valid_positions))
+
     if len(valid_positions) == num_shapes:
       return valid_positions
     else:
@@ -458,8 +592,11 @@ class PyBulletEnv(BaseEnv):
     return [o.getXYPosition() for o in self.objects]
 
   def _generateShapes(self, shape_type=0, num_shapes=1, scale=None, pos=None, rot=None,
-                           min_distance=None, padding=None, random_orientation=False, z_scale=1, model_id=1):
-    ''''''
+                           min_distance=None, padding=None, random_orientation=False, z_scale=1, model_id=1,
+                           settle=True):
+    '''
+    Generate shapes. If settle, simulate 50 steps afterwards for them to land
+    '''
     # if padding is not set, use the default padding
     if padding is None:
       padding = self._getDefaultBoarderPadding(shape_type)
@@ -541,7 +678,8 @@ class PyBulletEnv(BaseEnv):
     for h in shape_handles:
       self.object_types[h] = shape_type
 
-    self.wait(50)
+    if settle:
+      self.wait(50)
     return shape_handles
 
   def getObjects(self):
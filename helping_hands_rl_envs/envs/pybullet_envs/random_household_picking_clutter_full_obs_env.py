@@ -9,6 +9,9 @@ from helping_hands_rl_envs.simulators import constants
 from helping_hands_rl_envs.simulators.constants import NoValidPositionException
 from helping_hands_rl_envs.simulators.pybullet.equipments.tray import Tray
 from helping_hands_rl_envs.simulators.pybullet.equipments.tray_2slopes import Tray2
+from helping_hands_rl_envs.simulators.pybullet.objects.grasp_net_obj import GraspNetObject
+import helping_hands_rl_envs.simulators.pybullet.utils.object_generation as pb_obj_generation
+from helping_hands_rl_envs.simulators.pybullet.utils.scene_corpus import SceneCorpus
 from scipy.ndimage.interpolation import rotate
 import pybullet as pb
 import os
@@ -55,6 +58,17 @@ class RandomHouseholdPickingClutterFullObsEnv(PyBulletEnv):
         self.bin_size = config['bin_size']
         self.gripper_depth = 0.04
         self.gripper_clearance = 0.01
+        # rz -> index of the local region pixels in the rotated gripper footprint, see _getRotationIndex
+        self.rotation_index_cache = {}
+        # spawn all objects stacked in a column at reset, and settle them once
+        self.batch_spawn = config['batch_spawn']
+        # pool of [settled scene, number of resets from it]. Once the pool is full, resets restore a random scene of it
+        # instead of building a new one, and a scene is dropped after scene_pool_max_reuse resets
+        self.scene_pool_size = config['scene_pool_size']
+        self.scene_pool_max_reuse = config['scene_pool_max_reuse']
+        self.scene_pool = []
+        # scenes generated offline to reset from instead of building new scenes, see scripts/generate_scenes.py
+        self.scene_corpus = SceneCorpus(config['scene_corpus']) if config['scene_corpus'] else None
 
     def initialize(self):
         super().initialize()
@@ -110,30 +124,62 @@ class RandomHouseholdPickingClutterFullObsEnv(PyBulletEnv):
         :param rz:
         :return: safe z
         """
-        row_pixel, col_pixel = self._getPixelsFromPos(x, y)
-        # local_region is as large as ih_img
-        local_region = self.heightmap[int(row_pixel - self.in_hand_size / 2): int(row_pixel + self.in_hand_size / 2),
-                                      int(col_pixel - self.in_hand_size / 2): int(col_pixel + self.in_hand_size / 2)]
-        local_region = rotate(local_region, angle=-rz * 180 / np.pi, reshape=False)
-        patch = local_region[int(self.in_hand_size / 2 - 16):int(self.in_hand_size / 2 + 16),
-                             int(self.in_hand_size / 2 - 4):int(self.in_hand_size / 2 + 4)]
-        if z is None:
-            edge = patch.copy()
-            edge[5:-5] = 0
-            # safe_z_pos = max(np.mean(patch.flatten()[(-patch).flatten().argsort()[2:12]]) - self.gripper_depth,
-            #                  np.mean(edge.flatten()[(-edge).flatten().argsort()[:6]]) - 0.005)
-            safe_z_pos = np.mean(patch.flatten()[(-patch).flatten().argsort()[2:12]]) - self.gripper_depth
-            safe_z_pos += self.workspace[2, 0]
+        return self.getPatch_zs([x], [y], [rz], None if z is None else [z])[0]
+
+    def getPatch_zs(self, xs, ys, rzs, zs=None):
+        """
+        get the safe z of many actions at once. The gripper footprint of each action is gathered from the heightmap
+        with the rotation index of its rz, and the safe z is based on the mean of its 3rd to 12th highest pixels
+        :param xs: x of each action
+        :param ys: y of each action
+        :param rzs: rz of each action
+        :param zs: z offsets of each action from the patch height, None to place the gripper at gripper_depth
+        :return: safe z of each action
+        """
+        half = int(self.in_hand_size / 2)
+        rows = np.round((np.asarray(xs, dtype=float) - self.workspace[0][0]) / self.heightmap_resolution)
+        cols = np.round((np.asarray(ys, dtype=float) - self.workspace[1][0]) / self.heightmap_resolution)
+        rows = np.clip(rows, half, self.heightmap_size - half - 1).astype(int) - half
+        cols = np.clip(cols, half, self.heightmap_size - half - 1).astype(int) - half
+        # flat heightmap index of each pixel of each footprint, with a trailing 0 for the pixels out of the region
+        heightmap = np.append(self.heightmap.reshape(-1), 0)
+        index = np.stack([self._getRotationIndex(rz) for rz in rzs])
+        outside = index < 0
+        index = (rows[:, None] + index // self.in_hand_size) * self.heightmap_size + cols[:, None] + \
+                index % self.in_hand_size
+        index[outside] = heightmap.shape[0] - 1
+        patch = heightmap[index]
+
+        # mean of the 3rd to 12th highest pixels
+        top_12 = np.partition(patch, -12, axis=1)[:, -12:]
+        top_2 = np.partition(top_12, -2, axis=1)[:, -2:]
+        patch_z = (top_12.sum(1) - top_2.sum(1)) / 10
+        if zs is None:
+            safe_z_pos = patch_z - self.gripper_depth + self.workspace[2, 0]
         else:
-            safe_z_pos = np.mean(patch.flatten()[(-patch).flatten().argsort()[2:12]]) + z
+            safe_z_pos = patch_z + np.asarray(zs, dtype=float)
 
         # use clearance to prevent gripper colliding with ground
-        safe_z_pos = max(safe_z_pos, self.workspace[2, 0] + self.gripper_clearance)
-        safe_z_pos = min(safe_z_pos, self.workspace[2, 1])
-        assert self.workspace[2][0] <= safe_z_pos <= self.workspace[2][1]
+        safe_z_pos = np.maximum(safe_z_pos, self.workspace[2, 0] + self.gripper_clearance)
+        safe_z_pos = np.minimum(safe_z_pos, self.workspace[2, 1])
+        assert np.all((self.workspace[2][0] <= safe_z_pos) & (safe_z_pos <= self.workspace[2][1]))
 
         return safe_z_pos
 
+    def _getRotationIndex(self, rz):
+        """
+        get the nearest neighbor rotation of the gripper footprint by rz, as the index of the pixels of the
+        in_hand_size local region rotated into the 32x8 footprint, -1 for the pixels rotated in from outside of it
+        """
+        rz = float(rz)
+        if rz not in self.rotation_index_cache:
+            size = self.in_hand_size
+            index = np.arange(size * size, dtype=float).reshape(size, size)
+            index = rotate(index, angle=-rz * 180 / np.pi, reshape=False, order=0, mode='constant', cval=-1)
+            index = index[int(size / 2 - 16):int(size / 2 + 16), int(size / 2 - 4):int(size / 2 + 4)]
+            self.rotation_index_cache[rz] = index.astype(int).reshape(-1)
+        return self.rotation_index_cache[rz]
+
     def _checkPerfectGrasp(self, x, y, z, rot, objects):
         return True
 
@@ -186,10 +232,16 @@ class RandomHouseholdPickingClutterFullObsEnv(PyBulletEnv):
 
     def reset(self):
         ''''''
+        if self.scene_corpus is not None:
+            return self.resetToScene(np.random.randint(len(self.scene_corpus)))
+        if self.scene_pool_size > 0 and len(self.scene_pool) >= self.scene_pool_size:
+            return self._resetFromScenePool()
         while True:
             self.resetPybulletEnv()
             try:
-                if not self.exhibit_env_obj:
+                if not self.exhibit_env_obj and self.batch_spawn:
+                    self._spawnObjectsBatch()
+                elif not self.exhibit_env_obj:
                     for i in range(self.num_obj):
                         x = (np.random.rand() - 0.5) * 0.1
                         x += self.workspace[0].mean()
@@ -265,8 +317,91 @@ class RandomHouseholdPickingClutterFullObsEnv(PyBulletEnv):
         self.wait(200)
         self.obj_grasped = 0
         # self.num_in_tray_obj = self.num_obj
+        if self.scene_pool_size > 0:
+            self.scene_pool.append([self.getScene(), 0])
+        return self._getObservation()
+
+    def _resetFromScenePool(self):
+        """
+        Reset to a random scene of the scene pool, and drop it from the pool once it was used scene_pool_max_reuse times
+        """
+        i = np.random.randint(len(self.scene_pool))
+        scene = self.scene_pool[i][0]
+        self.scene_pool[i][1] += 1
+        if self.scene_pool[i][1] >= self.scene_pool_max_reuse:
+            del self.scene_pool[i]
+        self.loadScene(scene)
+        self.obj_grasped = 0
+        return self._getObservation()
+
+    def resetToScene(self, index):
+        """
+        Reset to the scene index of the scene corpus
+        """
+        self.loadScene(self.scene_corpus[index])
+        self.obj_grasped = 0
         return self._getObservation()
 
+    def generateScene(self, seed):
+        """
+        Build a new scene from a seed
+        :return: the scene, see getScene
+        """
+        np.random.seed(seed)
+        self.reset()
+        return self.getScene()
+
+    def getScene(self):
+        """
+        Record the objects of the scene
+        :return: list of (object index, mesh scale, color, position, orientation) of the GraspNet objects
+        """
+        scene = []
+        for obj in self.objects:
+            if isinstance(obj, GraspNetObject):
+                pos, rot = obj.getPose()
+                scene.append((obj.index, obj.obj_scale, obj.color, pos, rot))
+        return scene
+
+    def loadScene(self, scene):
+        """
+        Reset the simulation and create the objects of a scene recorded by getScene at rest at their recorded poses
+        """
+        self.resetPybulletEnv()
+        for index, obj_scale, color, pos, rot in scene:
+            obj = pb_obj_generation.generateGraspNetObject(pos, rot, 1, index, obj_scale=obj_scale, color=color)
+            if self.physic_mode == 'slow':
+                pb.changeDynamics(obj.object_id, -1, linearDamping=0.04, angularDamping=0.04, restitution=0,
+                                  contactStiffness=3000, contactDamping=100)
+            pb.changeDynamics(obj.object_id, -1, lateralFriction=0.6)
+            self.objects.append(obj)
+            self.object_types[obj] = constants.GRASP_NET_OBJ
+
+    def _spawnObjectsBatch(self, gap=0.01):
+        """
+        Spawn the objects without simulating in between. Each object is lifted right above the previous one, so they
+        do not intersect, and all objects are settled with a single wait as long as the sequential drops.
+        :param gap: vertical gap between the objects
+        """
+        bottom_z = self.object_init_z
+        for i in range(self.num_obj):
+            x = (np.random.rand() - 0.5) * 0.1
+            x += self.workspace[0].mean()
+            y = (np.random.rand() - 0.5) * 0.1
+            y += self.workspace[1].mean()
+            obj = self._generateShapes(constants.GRASP_NET_OBJ, 1,
+                                       random_orientation=self.random_orientation,
+                                       pos=[[x, y, bottom_z]], padding=self.min_boarder_padding,
+                                       min_distance=self.min_object_distance, model_id=-1, settle=False)[0]
+            pb.changeDynamics(obj.object_id, -1, lateralFriction=0.6)
+            aabb = obj.getBoundingBox()
+            position, orientation = pb.getBasePositionAndOrientation(obj.object_id)
+            lift = bottom_z - aabb[0][2]
+            pb.resetBasePositionAndOrientation(obj.object_id, [position[0], position[1], position[2] + lift],
+                                               orientation)
+            bottom_z = aabb[1][2] + lift + gap
+        self.wait(60 * self.num_obj)
+
     def isObjInBox(self, obj_pos, tray_pos, tray_size):
         tray_range = self.tray_range(tray_pos, tray_size)
         return tray_range[0][0] < obj_pos[0] < tray_range[0][1] and tray_range[1][0] < obj_pos[1] < tray_range[1][1]
@@ -1,5 +1,7 @@
+import time
 import numpy as np
-from multiprocessing import Process, Pipe
+from multiprocessing import Process, Pipe, shared_memory, resource_tracker
+from multiprocessing.connection import wait
 import os
 import git
 import helping_hands_rl_envs
@@ -21,6 +23,9 @@ def worker(remote, parent_remote, env_fn, planner_fn=None):
         planner = planner_fn(env)
     else:
         planner = None
+    # SharedObsRing and the index of this env in it, set by 'attach_shared_obs'
+    shared_obs = None
+    env_id = None
 
     try:
         while True:
@@ -35,6 +40,24 @@ def worker(remote, parent_remote, env_fn, planner_fn=None):
                     # get observation after reset (res index 0), the rest stays the same
                     res = (env.reset(), *res[1:])
                 remote.send(res)
+            elif cmd in ('step_shared', 'step_auto_reset_shared'):
+                action, slot = data
+                res = env.step(action)
+                if cmd == 'step_auto_reset_shared' and res[2]:
+                    res = (env.reset(), *res[1:])
+                # only the state goes through the pipe, the images are written into the shared ring
+                remote.send((shared_obs.write(slot, env_id, res[0]), *res[1:]))
+            elif cmd == 'step_any':
+                action, auto_reset = data
+                res = env.step(action)
+                # the steps left are queried here as the pipe is busy until the result of this step is received
+                steps_left = planner.getStepsLeft() if planner else None
+                if auto_reset and res[2]:
+                    res = (env.reset(), *res[1:])
+                remote.send((res, steps_left))
+            elif cmd == 'attach_shared_obs':
+                spec, env_id = data
+                shared_obs = SharedObsRing(*spec)
             elif cmd == 'reset':
                 obs = env.reset()
                 remote.send(obs)
@@ -50,6 +73,10 @@ def worker(remote, parent_remote, env_fn, planner_fn=None):
                 remote.send(env.getObjectPositions())
             elif cmd == 'get_object_poses':
                 remote.send(env.getObjectPoses())
+            elif cmd == 'generate_scene':
+                remote.send(env.generateScene(data))
+            elif cmd == 'reset_to_scene':
+                remote.send(env.resetToScene(data))
             elif cmd == 'set_pos_candidate':
                 env.setPosCandidate(data)
             elif cmd == 'did_block_fall':
@@ -106,6 +133,8 @@ def worker(remote, parent_remote, env_fn, planner_fn=None):
                 else:
                     remote.send(True)
             elif cmd == 'close':
+                if shared_obs is not None:
+                    shared_obs.close()
                 remote.close()
                 break
             else:
@@ -114,17 +143,104 @@ def worker(remote, parent_remote, env_fn, planner_fn=None):
         print('MultiRunner worker: caught keyboard interrupt')
 
 
+class SharedObsRing(object):
+    '''
+  Ring of observation slots in shared memory. Holds a float32 array of shape
+  (num_slots, num_envs, ...) for the in hand images and one for the heightmaps.
+  Workers write their observations of a step into a slot and only send the
+  state over the pipe.
+
+  Args:
+    - num_slots: Number of steps kept before a slot is overwritten
+    - num_envs: Number of environments
+    - hand_obs_shape: Shape of the in hand image of one env
+    - obs_shape: Shape of the heightmap of one env
+    - names: Names of the shared memory blocks to attach to, None to create them
+  '''
+
+    def __init__(self, num_slots, num_envs, hand_obs_shape, obs_shape, names=None):
+        self.num_slots = num_slots
+        self.num_envs = num_envs
+        self.shapes = (tuple(hand_obs_shape), tuple(obs_shape))
+        self.owner = names is None
+
+        self.shms = []
+        arrays = []
+        for i, shape in enumerate(self.shapes):
+            shape = (num_slots, num_envs, *shape)
+            if self.owner:
+                shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+            else:
+                shm = shared_memory.SharedMemory(name=names[i])
+                # the creating process frees the block. Otherwise the resource tracker of the attaching process
+                # unlinks it when that process exits
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            self.shms.append(shm)
+            arrays.append(np.ndarray(shape, dtype=np.float32, buffer=shm.buf))
+        self.hand_obs, self.obs = arrays
+
+    def getSpec(self):
+        '''
+    Get the arguments to attach to this ring from another process
+    '''
+        return self.num_slots, self.num_envs, self.shapes[0], self.shapes[1], [shm.name for shm in self.shms]
+
+    def write(self, slot, env_id, obs):
+        '''
+    Write the images of an env observation into the ring
+
+    Returns: The state of the observation
+    '''
+        state, hand_obs, obs = obs
+        self.hand_obs[slot, env_id] = hand_obs
+        self.obs[slot, env_id] = obs
+        return state
+
+    def read(self, slot):
+        '''
+    Get views of the in hand images and heightmaps of all envs in slot
+    '''
+        return self.hand_obs[slot], self.obs[slot]
+
+    def close(self):
+        '''
+    Release the shared memory, and free it if this ring created it
+    '''
+        self.hand_obs = self.obs = None
+        for shm in self.shms:
+            shm.close()
+            if self.owner:
+                shm.unlink()
+        self.shms = []
+
+
 class MultiRunner(object):
     '''
   Runner which runs mulitple environemnts in parallel in subprocesses
   and communicates with them via pipe
 
   Args:
+    - env_fns: Functions which create the environments
+    - planner_fns: Functions which create the planners
+    - shared_obs_slots: If > 0, the observations of step are transferred through
+      a SharedObsRing with this number of slots instead of the pipes. stepWait then
+      returns float32 views into the ring which are overwritten shared_obs_slots
+      steps later, so callers keeping observations around must copy them. Must be
+      0 or at least 2, as the current and the next observations of a transition
+      must not share a slot
   '''
 
-    def __init__(self, env_fns, planner_fns):
+    def __init__(self, env_fns, planner_fns, shared_obs_slots=0):
+        if shared_obs_slots == 1 or shared_obs_slots < 0:
+            raise ValueError('shared_obs_slots must be 0 or at least 2, got {}.'.format(shared_obs_slots))
         self.waiting = False
         self.closed = False
+        self.shared_obs_slots = shared_obs_slots
+        # created on the first reset, when the observation shapes are known
+        self.shared_obs = None
+        self.shared_obs_slot = 0
+        # ids of the envs stepped by stepAnyAsync whose results were not collected by wait yet
+        self.pending = set()
 
         num_envs = len(env_fns)
         self.remotes, self.worker_remotes = zip(*[Pipe() for _ in range(num_envs)])
@@ -159,11 +275,17 @@ class MultiRunner(object):
     Args:
       - actions: Numpy variable of environment actions
     '''
-        for remote, action in zip(self.remotes, actions):
-            if auto_reset:
-                remote.send(('step_auto_reset', action))
-            else:
-                remote.send(('step', action))
+        if self.shared_obs is not None:
+            self.shared_obs_slot = (self.shared_obs_slot + 1) % self.shared_obs.num_slots
+            cmd = 'step_auto_reset_shared' if auto_reset else 'step_shared'
+            for remote, action in zip(self.remotes, actions):
+                remote.send((cmd, (action, self.shared_obs_slot)))
+        else:
+            for remote, action in zip(self.remotes, actions):
+                if auto_reset:
+                    remote.send(('step_auto_reset', action))
+                else:
+                    remote.send(('step', action))
         self.waiting = True
 
     def stepWait(self):
@@ -186,11 +308,15 @@ class MultiRunner(object):
         else:
             obs, rewards, dones, metadata = res
 
-        states, hand_obs, obs = zip(*obs)
+        if self.shared_obs is not None:
+            states = obs
+            hand_obs, obs = self.shared_obs.read(self.shared_obs_slot)
+        else:
+            states, hand_obs, obs = zip(*obs)
+            hand_obs = np.stack(hand_obs)
+            obs = np.stack(obs)
 
         states = np.stack(states).astype(float)
-        hand_obs = np.stack(hand_obs)
-        obs = np.stack(obs)
         rewards = np.stack(rewards)
         dones = np.stack(dones).astype(np.float32)
 
@@ -199,6 +325,82 @@ class MultiRunner(object):
         else:
             return (states, hand_obs, obs), rewards, dones
 
+    def stepAny(self, actions, env_ids, min_ready=1, timeout=None, auto_reset=True):
+        '''
+    Step some environments and return whichever environments are done first.
+    See stepAnyAsync and wait.
+    '''
+        self.stepAnyAsync(actions, env_ids, auto_reset)
+        return self.wait(min_ready, timeout)
+
+    def stepAnyAsync(self, actions, env_ids, auto_reset=True):
+        '''
+    Step some environments without waiting for them. The environments must not
+    have a step pending. Their observations are sent over the pipes.
+
+    Args:
+      - actions: Numpy variable of environment actions, one per env in env_ids
+      - env_ids: Ids of the envs to step
+      - auto_reset: Reset the envs whose episode is done in the worker. The
+        observation after the reset is then returned instead of the last one
+    '''
+        for env_id, action in zip(env_ids, actions):
+            env_id = int(env_id)
+            if env_id in self.pending:
+                raise ValueError('Env {} is still stepping.'.format(env_id))
+            self.remotes[env_id].send(('step_any', (action, auto_reset)))
+            self.pending.add(env_id)
+
+    def wait(self, min_ready=1, timeout=None):
+        '''
+    Wait until at least min_ready environments stepped by stepAnyAsync are done,
+    or timeout seconds passed, and collect all the environments which are done.
+
+    Returns: (env_ids, obs, rewards, dones, steps_lefts), or (env_ids, obs, rewards,
+    dones, steps_lefts, metadata) if the envs return metadata
+      - env_ids: Numpy vector of the ids of the collected envs, sorted. The other
+        values are None if it is empty, i.e., timeout passed
+      - obs: Numpy vectors of states, in hand images and heightmaps
+      - steps_lefts: Numpy vector of steps left given by the planners, None without planners
+    '''
+        min_ready = min(min_ready, len(self.pending))
+        deadline = None if timeout is None else time.time() + timeout
+        remote_ids = {self.remotes[env_id]: env_id for env_id in self.pending}
+        results = {}
+        while remote_ids:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            ready = wait(list(remote_ids), remaining)
+            for remote in ready:
+                env_id = remote_ids.pop(remote)
+                results[env_id] = remote.recv()
+                self.pending.remove(env_id)
+            if len(results) >= min_ready or not ready:
+                break
+
+        env_ids = np.array(sorted(results), dtype=int)
+        if len(env_ids) == 0:
+            return env_ids, (None, None, None), None, None, None
+        res, steps_lefts = zip(*[results[env_id] for env_id in env_ids])
+        res = tuple(zip(*res))
+        if len(res) == 3:
+            metadata = None
+            obs, rewards, dones = res
+        else:
+            obs, rewards, dones, metadata = res
+
+        states, hand_obs, obs = zip(*obs)
+        states = np.stack(states).astype(float)
+        hand_obs = np.stack(hand_obs)
+        obs = np.stack(obs)
+        rewards = np.stack(rewards)
+        dones = np.stack(dones).astype(np.float32)
+        steps_lefts = None if steps_lefts[0] is None else np.stack(steps_lefts)
+
+        if metadata:
+            return env_ids, (states, hand_obs, obs), rewards, dones, steps_lefts, metadata
+        else:
+            return env_ids, (states, hand_obs, obs), rewards, dones, steps_lefts
+
     def reset(self):
         '''
     Reset each environment
@@ -215,8 +417,19 @@ class MultiRunner(object):
         hand_obs = np.stack(hand_obs)
         obs = np.stack(obs)
 
+        if self.shared_obs_slots > 0 and self.shared_obs is None:
+            self._createSharedObs(hand_obs.shape[1:], obs.shape[1:])
+
         return (states, hand_obs, obs)
 
+    def _createSharedObs(self, hand_obs_shape, obs_shape):
+        '''
+    Create the SharedObsRing and attach the workers to it
+    '''
+        self.shared_obs = SharedObsRing(self.shared_obs_slots, self.num_processes, hand_obs_shape, obs_shape)
+        for env_id, remote in enumerate(self.remotes):
+            remote.send(('attach_shared_obs', (self.shared_obs.getSpec(), env_id)))
+
     def reset_envs(self, env_nums):
         for env_num in env_nums:
             self.remotes[env_num].send(('reset', None))
@@ -244,8 +457,12 @@ class MultiRunner(object):
         self.closed = True
         if self.waiting:
             [remote.recv() for remote in self.remotes]
+        [self.remotes[env_id].recv() for env_id in self.pending]
+        self.pending.clear()
         [remote.send(('close', None)) for remote in self.remotes]
         [process.join() for process in self.processes]
+        if self.shared_obs is not None:
+            self.shared_obs.close()
 
     def save(self):
         '''
@@ -299,6 +516,41 @@ class MultiRunner(object):
         poses = [remote.recv() for remote in self.remotes]
         return np.array(poses)
 
+    def generateScenes(self, seeds):
+        '''
+    Build a new scene in the first len(seeds) environments
+
+    Args:
+      - seeds: Seed of the scene of each environment
+
+    Returns: List of scenes
+    '''
+        remotes = self.remotes[:len(seeds)]
+        for remote, seed in zip(remotes, seeds):
+            remote.send(('generate_scene', seed))
+        return [remote.recv() for remote in remotes]
+
+    def resetToScenes(self, indices):
+        '''
+    Reset each environment to a scene of its scene corpus
+
+    Args:
+      - indices: Scene index of each environment
+
+    Returns: Numpy vector of observations
+    '''
+        for remote, index in zip(self.remotes, indices):
+            remote.send(('reset_to_scene', index))
+
+        obs = [remote.recv() for remote in self.remotes]
+        states, hand_obs, obs = zip(*obs)
+
+        states = np.stack(states).astype(float)
+        hand_obs = np.stack(hand_obs)
+        obs = np.stack(obs)
+
+        return (states, hand_obs, obs)
+
     def getNextAction(self):
         '''
 
@@ -489,6 +741,22 @@ class SingleRunner(object):
     '''
         return self.env.getObjectPoses()
 
+    def generateScenes(self, seeds):
+        '''
+    Build a new scene from seeds[0]
+
+    Returns: List of the scene
+    '''
+        return [self.env.generateScene(seeds[0])]
+
+    def resetToScenes(self, indices):
+        '''
+    Reset the environment to the scene indices[0] of its scene corpus
+
+    Returns: Numpy vector of observations
+    '''
+        return self.env.resetToScene(indices[0])
+
     def getNextAction(self):
         '''
 
@@ -27,11 +27,8 @@ class Cube(NumpyObject):
       self.pos = list(map(int, pos))
       self.x_min, self.x_max = max(0, int(pos[0] - self.size / 2)), min(heightmap.shape[0], int(pos[0] + self.size / 2))
       self.y_min, self.y_max = max(0, int(pos[1] - self.size / 2)), min(heightmap.shape[1], int(pos[1] + self.size / 2))
-      self.mask = np.zeros_like(heightmap, dtype=np.int)
-      self.mask[self.y_min:self.y_max, self.x_min:self.x_max] = 1
-      self.mask = utils.rotateImage(self.mask, np.rad2deg(self.rot), (self.pos[1], self.pos[0]))
-      self.mask = (self.mask == 1)
-      base_h = heightmap[self.mask].max() if self.mask.sum() > 0 else 0
+      self.mask = self.getMask(heightmap)
+      base_h = heightmap[self.mask].max() if len(self.mask[0]) > 0 else 0
       self.pos[-1] = self.height + base_h
 
     self.chunk_before = heightmap[self.mask]
@@ -86,9 +83,17 @@ class Cube(NumpyObject):
     return False
 
   def getMask(self, heightmap):
-    mask = np.zeros_like(heightmap, dtype=np.int)
-    mask[self.y_min:self.y_max, self.x_min:self.x_max] = 1
-    mask = utils.rotateImage(mask, np.rad2deg(self.rot), (self.pos[1], self.pos[0]))
-    mask = (mask == 1)
-
-    return mask
+    '''
+    Get the pixels of the cube, rasterized over its bounding box. A pixel is in the cube if, rotated back into the frame
+    of the cube, it is within the pixel bounds of the unrotated cube.
+    Returns: (rows, cols) index arrays of the pixels
+    '''
+    x, y = self.pos[0], self.pos[1]
+    rows, cols = utils.getLocalPixels(x, y, int(np.ceil(self.size / np.sqrt(2))) + 1, heightmap.shape)
+    cos, sin = np.cos(self.rot), np.sin(self.rot)
+    c = x + (cos * (cols - x) - sin * (rows - y))
+    r = y + (sin * (cols - x) + cos * (rows - y))
+    mask = (np.trunc(x - self.size / 2) <= c) & (c < np.trunc(x + self.size / 2)) & \
+           (np.trunc(y - self.size / 2) <= r) & (r < np.trunc(y + self.size / 2))
+    rows, cols = np.broadcast_arrays(rows, cols)
+    return rows[mask], cols[mask]
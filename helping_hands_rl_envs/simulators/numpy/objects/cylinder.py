@@ -5,21 +5,22 @@ import numpy as np
 
 from helping_hands_rl_envs.simulators.numpy.objects.numpy_object import NumpyObject
 from helping_hands_rl_envs.simulators import constants
+from helping_hands_rl_envs.simulators.numpy import utils
 
 class Cylinder(NumpyObject):
   def __init__(self, pos, rot, size, heightmap):
-    super(Cylinder, self).__init__(constants.CYLINDER, pos, rot, size, heightmap)
+    super(Cylinder, self).__init__(constants.CYLINDER, pos, rot, size)
 
     self.radius = size/2
-    self.mask = self.getMask()
+    self.mask = self.getMask(heightmap)
     self.chunk_before = None
     self.on_top = True
 
   def addToHeightmap(self, heightmap, pos=None, rot=None):
     if pos is not None:
       self.pos = list(map(int, pos))
-      self.getMask()
-      base_h = heightmap[self.mask].max() if self.mask.sum() > 0 else 0
+      self.mask = self.getMask(heightmap)
+      base_h = heightmap[self.mask].max() if len(self.mask[0]) > 0 else 0
       self.pos[-1] = self.height + base_h
 
     self.chunk_before = heightmap[self.mask]
@@ -44,11 +45,13 @@ class Cylinder(NumpyObject):
       return True
     return False
 
-  def getMask(self):
-    y, x = np.ogrid[-self.pos[0]:self.heightmap_size-self.pos[0], -self.pos[1]:self.heightmap_size-self.pos[1]]
-    region = x*x + y*y <= self.radius*self.radius
-    mask = np.zeros((self.heightmap_size, self.heightmap_size), dtype=np.int)
-    mask[region.T] = 1
-    mask = (mask == 1)
-
-    return mask
+  def getMask(self, heightmap):
+    '''
+    Get the pixels within the radius of the cylinder, rasterized over its bounding box
+    Returns: (rows, cols) index arrays of the pixels
+    '''
+    x, y = self.pos[0], self.pos[1]
+    rows, cols = utils.getLocalPixels(x, y, int(np.ceil(self.size / np.sqrt(2))) + 1, heightmap.shape)
+    mask = (cols - x) ** 2 + (rows - y) ** 2 <= self.radius * self.radius
+    rows, cols = np.broadcast_arrays(rows, cols)
+    return rows[mask], cols[mask]
@@ -17,3 +17,14 @@ def rotateImage(img, angle, pivot):
   else:
     result = img_r[pad_y[0]: -pad_y[1], pad_x[0]: -pad_x[1]]
   return result
+
+def getLocalPixels(x, y, radius, shape):
+  '''
+  Get the pixels of the square of the given radius around the pixel position (x, y), clipped to the heightmap. x is
+  the column, y the row.
+
+  Returns: (rows, cols), k x 1 and 1 x l pixel coordinates which broadcast to the pixels of the square
+  '''
+  rows = np.arange(max(int(np.floor(y)) - radius, 0), min(int(np.floor(y)) + radius + 1, shape[0])).reshape(-1, 1)
+  cols = np.arange(max(int(np.floor(x)) - radius, 0), min(int(np.floor(x)) + radius + 1, shape[1])).reshape(1, -1)
+  return rows, cols
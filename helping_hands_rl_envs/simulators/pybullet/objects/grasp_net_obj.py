@@ -17,13 +17,95 @@ found_object_directories = sorted(glob.glob(obj_pattern))
 total_num_objects = len(found_object_directories)
 
 
+# index -> (size of the AABB at unit scale, AABB margin) of each object, see getAABBSize
+aabb_models = {}
+# (index, scale) -> (visual shape id, collision shape id) in the current simulation, see clearShapeCache
+shape_cache = {}
+
+
 def get_immediate_subdirectories(a_dir):
     return [name for name in os.listdir(a_dir)
             if os.path.isdir(os.path.join(a_dir, name))]
 
 
+def clearShapeCache():
+    """
+    Forget the cached shape ids. Needs to be called after pb.resetSimulation, which removes all shapes
+    """
+    shape_cache.clear()
+
+
+def getShapes(obj_filepath, index, scale):
+    """
+    Get the visual and collision shapes of an object at a scale, created on first use and then shared by its bodies.
+    The visual shape is white, the color is set per body
+    """
+    key = (index, scale)
+    if key not in shape_cache:
+        obj_visual = pb.createVisualShape(pb.GEOM_MESH,
+                                          fileName=obj_filepath + 'convex.obj',
+                                          meshScale=[scale, scale, scale])
+        obj_collision = pb.createCollisionShape(pb.GEOM_MESH,
+                                                fileName=obj_filepath + 'convex.obj',
+                                                meshScale=[scale, scale, scale])
+        shape_cache[key] = (obj_visual, obj_collision)
+    return shape_cache[key]
+
+
+def getAABBSize(obj_filepath, index, rot, scale):
+    """
+    Get the size of pb.getAABB of an object at a scale and an orientation, without creating it.
+    Bullet transforms the local AABB of a shape, padded by its margin, into the world frame. The size is therefore
+    abs(R) @ (scale * unit_size + margin), whose unit_size and margin are measured once per object from two bodies
+    at different scales.
+    """
+    if index not in aabb_models:
+        sizes = []
+        for s in (1., 0.5):
+            obj_visual, obj_collision = getShapes(obj_filepath, index, s)
+            object_id = pb.createMultiBody(baseMass=0.15,
+                                           baseCollisionShapeIndex=obj_collision,
+                                           baseVisualShapeIndex=obj_visual)
+            aabb = np.asarray(pb.getAABB(object_id))
+            pb.removeBody(object_id)
+            sizes.append(aabb[1] - aabb[0])
+        unit_size = (sizes[0] - sizes[1]) / 0.5
+        aabb_models[index] = (unit_size, sizes[0] - unit_size)
+    unit_size, margin = aabb_models[index]
+    rot_mat = np.abs(np.array(pb.getMatrixFromQuaternion(rot)).reshape(3, 3))
+    return rot_mat @ (scale * unit_size + margin)
+
+
+def fitScale(obj_filepath, index, rot, scale):
+    """
+    Find the mesh scale of an object which satisfies the size constraints at a scale and an orientation
+    """
+    obj_edge_max = 0.15 * scale  # the maximum edge size of an obj before scaling
+    obj_edge_min = 0.014 * scale  # the minimum edge size of an obj before scaling
+    obj_volume_max = 0.0006 * (scale ** 3)  # the maximum volume of an obj before scaling
+    obj_scale = scale
+
+    while True:
+        size = getAABBSize(obj_filepath, index, rot, obj_scale)
+
+        if np.partition(size, -2)[-2] > obj_edge_max:
+            obj_scale *= 0.8
+        elif size[0] * size[1] * size[2] > obj_volume_max:
+            obj_scale *= 0.85
+        elif size.min() < obj_edge_min:
+            obj_scale /= 0.95
+        else:
+            return obj_scale
+
+
 class GraspNetObject(PybulletObject):
-    def __init__(self, pos, rot, scale, index=-1):
+    def __init__(self, pos, rot, scale, index=-1, obj_scale=None, color=None):
+        """
+        :param scale: the scale of the size constraints the object is rescaled to
+        :param index: the index of the object, random if < 0
+        :param obj_scale: the mesh scale, e.g. of a recorded object, to skip the rescaling
+        :param color: the rgba color, random if None
+        """
 
         if index >= 0:
             obj_filepath = found_object_directories[index]
@@ -31,44 +113,23 @@ class GraspNetObject(PybulletObject):
             index = np.random.choice(np.arange(total_num_objects), 1)[0]
             obj_filepath = found_object_directories[index]
 
-        color = np.random.uniform(0.6, 1, (4,))
-        color[-1] = 1
+        if color is None:
+            color = np.random.uniform(0.6, 1, (4,))
+            color[-1] = 1
         self.center = [0, 0, 0]
-        obj_edge_max = 0.15 * scale  # the maximum edge size of an obj before scaling
-        obj_edge_min = 0.014 * scale  # the minimum edge size of an obj before scaling
-        obj_volume_max = 0.0006 * (scale ** 3)  # the maximum volume of an obj before scaling
-        obj_scale = scale
-
-        while True:
-            obj_visual = pb.createVisualShape(pb.GEOM_MESH,
-                                              fileName=obj_filepath + 'convex.obj',
-                                              rgbaColor=color,
-                                              meshScale=[obj_scale, obj_scale, obj_scale])
-            obj_collision = pb.createCollisionShape(pb.GEOM_MESH,
-                                                    fileName=obj_filepath + 'convex.obj',
-                                                    meshScale=[obj_scale, obj_scale, obj_scale])
-
-            object_id = pb.createMultiBody(baseMass=0.15,
-                                           baseCollisionShapeIndex=obj_collision,
-                                           baseVisualShapeIndex=obj_visual,
-                                           basePosition=pos,
-                                           baseOrientation=rot)
-
-            aabb = pb.getAABB(object_id)
-            aabb = np.asarray(aabb)
-            size = aabb[1] - aabb[0]
-
-            if np.partition(size, -2)[-2] > obj_edge_max:
-                obj_scale *= 0.8
-                pb.removeBody(object_id)
-            elif size[0] * size[1] * size[2] > obj_volume_max:
-                obj_scale *= 0.85
-                pb.removeBody(object_id)
-            elif size.min() < obj_edge_min:
-                obj_scale /= 0.95
-                pb.removeBody(object_id)
-            else:
-                break
+        if obj_scale is None:
+            obj_scale = fitScale(obj_filepath, index, rot, scale)
+        self.index = index
+        self.obj_scale = obj_scale
+        self.color = color
+
+        obj_visual, obj_collision = getShapes(obj_filepath, index, obj_scale)
+        object_id = pb.createMultiBody(baseMass=0.15,
+                                       baseCollisionShapeIndex=obj_collision,
+                                       baseVisualShapeIndex=obj_visual,
+                                       basePosition=pos,
+                                       baseOrientation=rot)
+        pb.changeVisualShape(object_id, -1, rgbaColor=color)
 
         pb.changeDynamics(object_id,
                           -1,
@@ -36,6 +36,11 @@ class RobotBase:
 
     self.position_gain = 0.02
     self.adjust_gripper_after_lift = False
+    # 'dynamic' or 'kinematic'. The kinematic pick teleports the arm to the pre-grasp pose and back home, and only
+    # simulates the descend, the grasp, and a lift by lift_check_offset followed by lift_check_steps to check the grasp
+    self.pick_motion = 'dynamic'
+    self.lift_check_offset = 0.03
+    self.lift_check_steps = 20
 
   def saveState(self):
     self.state = {
@@ -81,16 +86,27 @@ class RobotBase:
     pre_pos = copy.copy(pos)
     if top_down_approach:
       # approach the object top-down
+      approach = np.array([0., 0., 1.])
       pre_pos[2] += offset
     else:
       # approach the object along the z direction of the ee
       m = np.array(pb.getMatrixFromQuaternion(rot)).reshape(3, 3)
+      approach = m[:, 2]
       pre_pos += m[:, 2] * offset
 
     pre_rot = rot
 
+    # The kinematic pick only lifts by lift_check_offset to check the grasp, and teleports the rest of the way
+    kinematic = self.pick_motion == 'kinematic'
+    if kinematic:
+      lift_pos = np.array(pos) + approach * min(self.lift_check_offset, offset)
+      lift_steps = self.lift_check_steps
+    else:
+      lift_pos = pre_pos
+      lift_steps = 100
+
     # Move to pre-grasp pose and then grasp pose
-    self.moveTo(pre_pos, pre_rot, dynamic)
+    self.moveTo(pre_pos, pre_rot, dynamic and not kinematic)
     if simulate_grasp:
       self.moveTo(pos, rot, True, pos_th=1e-3, rot_th=1e-3)
 
@@ -102,21 +118,27 @@ class RobotBase:
       # Adjust gripper command after moving to pre pose. This will create more chance for a grasp, but while moving to
       # pre pose the gripper will shift around.
       if self.adjust_gripper_after_lift:
-        self.moveTo(pre_pos, pre_rot, True)
+        self.moveTo(lift_pos, pre_rot, True)
         self.adjustGripperCommand()
       # Adjust gripper command before moving to pre pose. This will make the gripper more stable while moving to the pre
       # pose, but will reduce the chance for a grasp, especially in the cluttered scene.
       else:
         self.adjustGripperCommand()
-        self.moveTo(pre_pos, pre_rot, True)
+        self.moveTo(lift_pos, pre_rot, True)
 
-      for i in range(100):
+      for i in range(lift_steps):
         pb.stepSimulation()
     else:
       self.moveTo(pos, rot, dynamic)
 
     self.holding_obj = self.getPickedObj(objects)
-    self.moveToJ(self.home_positions_joint, dynamic)
+    if kinematic:
+      # teleport the held object home together with the end effector, without the velocity it had during the lift
+      self._teleportArmWithObjJointPose(self.home_positions_joint)
+      if self.holding_obj:
+        pb.resetBaseVelocity(self.holding_obj.object_id, [0., 0., 0.], [0., 0., 0.])
+    else:
+      self.moveToJ(self.home_positions_joint, dynamic)
     self.checkGripperClosed()
 
   def place(self, pos, rot, offset, dynamic=True, simulate_grasp=True, top_down_approach=False):
@@ -0,0 +1,218 @@
+'''
+Point cloud reconstruction and heightmap projection on a runtime selected array backend.
+numpy and cupy share the numpy API, torch (cpu or cuda) is wrapped. cupy is only imported
+when it is selected, so the simulator can be used on nodes without it.
+'''
+import numpy as np
+
+class NumpyBackend(object):
+  '''
+  Array ops used by the projection for the numpy API. Also used for cupy with xp=cupy.
+  '''
+  name = 'numpy'
+
+  def __init__(self, xp=np):
+    self.xp = xp
+
+  def asarray(self, a):
+    return self.xp.asarray(a, dtype=self.xp.float64)
+
+  def asnumpy(self, a):
+    return np.asarray(a)
+
+  def ones(self, shape):
+    return self.xp.ones(shape)
+
+  def empty(self, shape):
+    return self.xp.empty(shape)
+
+  def full(self, n, value, like):
+    return self.xp.full(n, value, dtype=like.dtype)
+
+  def concatenate(self, arrays, axis=0):
+    return self.xp.concatenate(arrays, axis)
+
+  def inv(self, a):
+    return self.xp.linalg.inv(a)
+
+  def round(self, a):
+    return self.xp.round(a)
+
+  def toInt(self, a):
+    return a.astype(int)
+
+  def lexsort(self, secondary, primary):
+    return self.xp.lexsort(self.xp.stack((secondary, primary)))
+
+  def bincount(self, a):
+    return self.xp.bincount(a)
+
+  def cumsum(self, a):
+    return self.xp.cumsum(a)
+
+  def roll(self, a, shift):
+    return self.xp.roll(a, shift)
+
+class CupyBackend(NumpyBackend):
+  name = 'cupy'
+
+  def __init__(self):
+    import cupy
+    super(CupyBackend, self).__init__(cupy)
+
+  def asnumpy(self, a):
+    return self.xp.asnumpy(a)
+
+class TorchBackend(object):
+  '''
+  Array ops used by the projection for torch tensors on device.
+  '''
+  name = 'torch'
+
+  def __init__(self, device=None):
+    import torch
+    self.torch = torch
+    if device is None:
+      device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    self.device = torch.device(device)
+
+  def asarray(self, a):
+    return self.torch.as_tensor(a, dtype=self.torch.float64, device=self.device)
+
+  def asnumpy(self, a):
+    return a.cpu().numpy()
+
+  def ones(self, shape):
+    return self.torch.ones(shape, dtype=self.torch.float64, device=self.device)
+
+  def empty(self, shape):
+    return self.torch.empty(shape, dtype=self.torch.float64, device=self.device)
+
+  def full(self, n, value, like):
+    return self.torch.full((n,), value, dtype=like.dtype, device=self.device)
+
+  def concatenate(self, arrays, axis=0):
+    return self.torch.cat(arrays, axis)
+
+  def inv(self, a):
+    return self.torch.linalg.inv(a)
+
+  def round(self, a):
+    return self.torch.round(a)
+
+  def toInt(self, a):
+    return a.long()
+
+  def lexsort(self, secondary, primary):
+    # two stable sorts give the order of np.lexsort
+    ind = self.torch.sort(secondary, stable=True)[1]
+    return ind[self.torch.sort(primary[ind], stable=True)[1]]
+
+  def bincount(self, a):
+    return self.torch.bincount(a)
+
+  def cumsum(self, a):
+    return self.torch.cumsum(a, 0)
+
+  def roll(self, a, shift):
+    return self.torch.roll(a, shift)
+
+BACKENDS = {'numpy': NumpyBackend, 'cupy': CupyBackend, 'torch': TorchBackend}
+
+def getBackend(name=None, **kwargs):
+  '''
+  Get an array backend by name. None selects cupy when it is installed, otherwise numpy.
+
+  Args:
+    - name: 'numpy', 'cupy', 'torch' or None
+    - kwargs: Backend arguments, e.g. device for torch
+  '''
+  if name is None:
+    try:
+      return CupyBackend()
+    except ImportError:
+      return NumpyBackend()
+  if name not in BACKENDS:
+    raise ValueError('Invalid projection backend {}. Valid backends are: {}'.format(name, list(BACKENDS)))
+  return BACKENDS[name](**kwargs)
+
+def getPixelGrid(backend, tran_pix_world, size):
+  '''
+  Precompute the depth independent part of getPointCloud for a camera and an image size.
+  The homogeneous world position of a pixel is tran_pix_world @ (x, y, 2 * depth - 1, 1), i.e.,
+  base + coef * depth.
+
+  Args:
+    - tran_pix_world: 4x4 inverse of projection @ view, as a backend array
+
+  Returns: (base, coef), 4x(size * size) and 4x1 backend arrays
+  '''
+  pixel_pos = np.mgrid[0:size, 0:size]
+  pixel_pos = pixel_pos/(size/2) - 1
+  pixel_pos = np.moveaxis(pixel_pos, 1, 2)
+  pixel_pos[1] = -pixel_pos[1]
+  pixel_pos = backend.asarray(pixel_pos.reshape(2, -1))
+  base = tran_pix_world[:, :2] @ pixel_pos + (tran_pix_world[:, 3:4] - tran_pix_world[:, 2:3])
+  coef = 2 * tran_pix_world[:, 2:3]
+  return base, coef
+
+def getPointCloud(backend, depth_img, pixel_grid):
+  '''
+  Reconstruct the world coordinates of the pixels of an OpenGL depth buffer.
+  https://stackoverflow.com/questions/59128880/getting-world-coordinates-from-opengl-depth-buffer
+
+  Args:
+    - depth_img: size x size depth buffer
+    - pixel_grid: getPixelGrid of the camera and size
+
+  Returns: (size * size)x3 backend array of points
+  '''
+  base, coef = pixel_grid
+  position = base + coef * backend.asarray(depth_img).reshape(1, -1)
+  pc = position[:3] / position[3]
+  return pc.T
+
+def projectHeightmap(backend, points, tran_world_pix, size):
+  '''
+  Project a point cloud into a heightmap. A z-buffer keeps the nearest point of each pixel:
+  the points are lexsorted on the pixel index then on the depth, and the cumulative bin count
+  of the pixel indexes gives the first point of each pixel.
+
+  Args:
+    - points: Nx3 backend array of points
+    - tran_world_pix: 4x4 projection @ view, as a backend array
+
+  Returns: size x size numpy heightmap
+  '''
+  pts = backend.concatenate((points.T, backend.ones((1, points.shape[0]))), axis=0)
+  pts = tran_world_pix @ pts
+  pts[1] = -pts[1]
+  pts[0] = (pts[0] + 1) * size / 2
+  pts[1] = (pts[1] + 1) * size / 2
+
+  pts[0] = backend.round(pts[0])
+  pts[1] = backend.round(pts[1])
+  mask = (pts[0] >= 0) & (pts[0] < size) & (pts[1] > 0) & (pts[1] < size)
+  pts = pts[:, mask]
+  # dense pixel index
+  mix_xy = backend.toInt(pts[1]) * size + backend.toInt(pts[0])
+  # lexsort point cloud first on dense pixel index, then on z value
+  ind = backend.lexsort(pts[2], mix_xy)
+  # bin count the points that belongs to each pixel
+  bincount = backend.bincount(mix_xy)
+  # cumulative sum of the bin count. the result indicates the cumulative sum of number of points for all previous pixels
+  cumsum = backend.cumsum(bincount)
+  # rolling the cumsum gives the ind of the first point that belongs to each pixel.
+  # because of the lexsort, the first point has the smallest z value
+  cumsum = backend.roll(cumsum, 1)
+  cumsum[0] = bincount[0]
+  # pad for unobserved pixels
+  cumsum = backend.concatenate((cumsum, backend.full(size * size - cumsum.shape[0], -1, like=cumsum)))
+
+  depth = pts[2][ind][cumsum]
+  depth[cumsum == 0] = np.nan
+  depth = backend.asnumpy(depth.reshape(size, size))
+  mask = np.isnan(depth)
+  depth[mask] = np.interp(np.flatnonzero(mask), np.flatnonzero(~mask), depth[~mask])
+
+  return np.abs(depth - np.max(depth))
@@ -1,13 +1,17 @@
 import time
 import pybullet as pb
 import numpy as np
-import cupy as cp
 import matplotlib.pyplot as plt
 from helping_hands_rl_envs.simulators.pybullet.utils.sensor import Sensor
+from helping_hands_rl_envs.simulators.pybullet.utils import projection
 
 class Renderer(object):
-  def __init__(self, workspace):
+  def __init__(self, workspace, backend=None):
     self.workspace = workspace
+    # array backend of the point cloud and the projection, see projection.getBackend
+    self.backend = projection.getBackend(backend) if backend is None or isinstance(backend, str) else backend
+    # projection @ view of projectHeightmap, cached per camera
+    self.tran_world_pix = {}
 
     cam_forward_target_pos = [0.8, self.workspace[1].mean(), 0]
     cam_forward_up_vector = [0, 0, 1]
@@ -15,20 +19,20 @@ class Renderer(object):
     cam_1_forward_pos = [0, 0.5, 1]
     far_1 = np.linalg.norm(np.array(cam_1_forward_pos) - np.array(cam_forward_target_pos)) + 2
     self.sensor_1 = Sensor(cam_1_forward_pos, cam_forward_up_vector, cam_forward_target_pos,
-                           3.2, near=0.5, far=far_1)
+                           3.2, near=0.5, far=far_1, backend=self.backend)
 
     cam_2_forward_pos = [0, -0.5, 1]
     far_2 = np.linalg.norm(np.array(cam_2_forward_pos) - np.array(cam_forward_target_pos)) + 2
     self.sensor_2 = Sensor(cam_2_forward_pos, cam_forward_up_vector, cam_forward_target_pos,
-                           3.2, near=0.5, far=far_2)
+                           3.2, near=0.5, far=far_2, backend=self.backend)
 
     cam_3_pos = [self.workspace[0].mean(), self.workspace[1].mean(), 20]
     cam_3_target_pos = [self.workspace[0].mean(), self.workspace[1].mean(), 0]
     far_3 = np.linalg.norm(np.array(cam_3_pos) - np.array(cam_3_target_pos)) + 2
     self.sensor_3 = Sensor(cam_3_pos, [-1, 0, 0], cam_3_target_pos,
-                           self.workspace[0][1] - self.workspace[0][0], near=0.1, far=far_3)
+                           self.workspace[0][1] - self.workspace[0][0], near=0.1, far=far_3, backend=self.backend)
 
-    self.points = cp.empty((0, 3))
+    self.points = self.backend.empty((0, 3))
 
   def getNewPointCloud(self):
     points1 = self.sensor_1.getPointCloud(480, to_numpy=False)
@@ -67,68 +71,29 @@ class Renderer(object):
     return hm
 
   def addPoints(self, points):
-    self.points = cp.concatenate((self.points, points))
+    self.points = self.backend.concatenate((self.points, self.backend.asarray(points)))
 
   def clearPoints(self):
-    self.points = cp.empty((0, 3))
+    self.points = self.backend.empty((0, 3))
 
   def projectHeightmap(self, size, cam_pos, cam_up_vector, target_pos, target_size):
-    view_matrix = pb.computeViewMatrix(
-      cameraEyePosition=cam_pos,
-      cameraUpVector=cam_up_vector,
-      cameraTargetPosition=target_pos,
-    )
-    view_matrix = cp.asarray(view_matrix).reshape([4, 4], order='F')
-
-    augment = cp.ones((1, self.points.shape[0]))
-    # pts = cp.concatenate((cp.asarray(self.points).T, augment), axis=0)
-    pts = cp.concatenate((self.points.T, augment), axis=0)
-    projection_matrix = cp.array([
-      [1 / (target_size / 2), 0, 0, 0],
-      [0, 1 / (target_size / 2), 0, 0],
-      [0, 0, -1, 0],
-      [0, 0, 0, 1]
-    ])
-    tran_world_pix = cp.matmul(projection_matrix, view_matrix)
-    pts = cp.matmul(tran_world_pix, pts)
-    pts[1] = -pts[1]
-    pts[0] = (pts[0] + 1) * size / 2
-    pts[1] = (pts[1] + 1) * size / 2
-
-    # pts_floor = pts.copy()
-    # pts_floor[0], pts_floor[1] = cp.floor(pts_floor[0]), cp.floor(pts_floor[1])
-    # pts_ceil = pts.copy()
-    # pts_ceil[0], pts_ceil[1] = cp.ceil(pts_ceil[0]), cp.ceil(pts_ceil[1])
-    # pts = cp.concatenate((pts_floor, pts_ceil), 1)
-    # mask = (pts[0] >= 0) * (pts[0] < size) * (pts[1] >= 0) * (pts[1] < size)
-
-    pts[0] = cp.round_(pts[0])
-    pts[1] = cp.round_(pts[1])
-    mask = (pts[0] >= 0) * (pts[0] < size) * (pts[1] > 0) * (pts[1] < size)
-    pts = pts[:, mask]
-    # dense pixel index
-    mix_xy = (pts[1].astype(int) * size + pts[0].astype(int))
-    # lexsort point cloud first on dense pixel index, then on z value
-    ind = cp.lexsort(cp.stack((pts[2], mix_xy)))
-    # bin count the points that belongs to each pixel
-    bincount = cp.bincount(mix_xy)
-    # cumulative sum of the bin count. the result indicates the cumulative sum of number of points for all previous pixels
-    cumsum = cp.cumsum(bincount)
-    # rolling the cumsum gives the ind of the first point that belongs to each pixel.
-    # because of the lexsort, the first point has the smallest z value
-    cumsum = cp.roll(cumsum, 1)
-    cumsum[0] = bincount[0]
-    # pad for unobserved pixels
-    cumsum = cp.concatenate((cumsum, -1 * cp.ones(size * size - cumsum.shape[0]))).astype(int)
-
-    depth = pts[2][ind][cumsum]
-    depth[cumsum == 0] = cp.nan
-    depth = depth.reshape(size, size)
-    depth = cp.asnumpy(depth)
-    mask = np.isnan(depth)
-    depth[mask] = np.interp(np.flatnonzero(mask), np.flatnonzero(~mask), depth[~mask])
-
-    return np.abs(depth - np.max(depth))
+    key = (tuple(cam_pos), tuple(cam_up_vector), tuple(target_pos), target_size)
+    if key not in self.tran_world_pix:
+      view_matrix = pb.computeViewMatrix(
+        cameraEyePosition=cam_pos,
+        cameraUpVector=cam_up_vector,
+        cameraTargetPosition=target_pos,
+      )
+      view_matrix = np.asarray(view_matrix).reshape([4, 4], order='F')
+      projection_matrix = np.array([
+        [1 / (target_size / 2), 0, 0, 0],
+        [0, 1 / (target_size / 2), 0, 0],
+        [0, 0, -1, 0],
+        [0, 0, 0, 1]
+      ])
+      self.tran_world_pix[key] = self.backend.asarray(np.matmul(projection_matrix, view_matrix))
+
+    return projection.projectHeightmap(self.backend, self.points, self.tran_world_pix[key], size)
 
 
   # def projectHeightmap(self, size, cam_pos, cam_up_vector, target_pos, target_size):
@@ -0,0 +1,56 @@
+'''
+On disk corpus of settled scenes. A scene is a list of (object index, mesh scale, color, position, orientation) as
+recorded by RandomHouseholdPickingClutterFullObsEnv.getScene. The objects of all scenes are stored in flat arrays of
+a single npz file, with the offset of the first object of each scene as index.
+'''
+import numpy as np
+
+def saveSceneCorpus(path, scenes, seeds):
+  '''
+  Save scenes into a corpus file.
+
+  Args:
+    - path: npz file path
+    - scenes: List of scenes
+    - seeds: Seed each scene was generated with
+  '''
+  objects = [obj for scene in scenes for obj in scene]
+  offsets = np.cumsum([0] + [len(scene) for scene in scenes])
+  # write through a file object, which keeps the path without an added .npz extension
+  with open(path, 'wb') as f:
+    np.savez_compressed(f,
+                        offsets=offsets,
+                        seeds=np.asarray(seeds),
+                        index=np.array([obj[0] for obj in objects], dtype=np.int32).reshape(-1),
+                        obj_scale=np.array([obj[1] for obj in objects], dtype=np.float64).reshape(-1),
+                        color=np.array([obj[2] for obj in objects], dtype=np.float32).reshape(-1, 4),
+                        pos=np.array([obj[3] for obj in objects], dtype=np.float64).reshape(-1, 3),
+                        rot=np.array([obj[4] for obj in objects], dtype=np.float64).reshape(-1, 4))
+
+class SceneCorpus(object):
+  '''
+  Scenes of a corpus file, loaded into memory.
+  '''
+  def __init__(self, path):
+    with np.load(path) as data:
+      self.offsets = data['offsets']
+      self.seeds = data['seeds']
+      self.index = data['index']
+      self.obj_scale = data['obj_scale']
+      self.color = data['color']
+      self.pos = data['pos']
+      self.rot = data['rot']
+
+  def __len__(self):
+    return len(self.seeds)
+
+  def __getitem__(self, i):
+    '''
+    Get the scene i, as a list of (object index, mesh scale, color, position, orientation)
+    '''
+    objects = range(self.offsets[i], self.offsets[i + 1])
+    return [(int(self.index[j]), float(self.obj_scale[j]), self.color[j], list(self.pos[j]), list(self.rot[j]))
+            for j in objects]
+
+  def getSeed(self, i):
+    return int(self.seeds[i])
@@ -1,9 +1,9 @@
 import pybullet as pb
 import numpy as np
-import cupy as cp
+from helping_hands_rl_envs.simulators.pybullet.utils import projection
 
 class Sensor(object):
-  def __init__(self, cam_pos, cam_up_vector, target_pos, target_size, near, far):
+  def __init__(self, cam_pos, cam_up_vector, target_pos, target_size, near, far, backend=None):
     self.view_matrix = pb.computeViewMatrix(
       cameraEyePosition=cam_pos,
       cameraUpVector=cam_up_vector,
@@ -15,40 +15,164 @@ class Sensor(object):
     self.fov = np.degrees(2 * np.arctan((target_size / 2) / self.far))
     self.proj_matrix = pb.computeProjectionMatrixFOV(self.fov, 1, self.near, self.far)
 
-  def getHeightmap(self, size):
-    image_arr = pb.getCameraImage(width=size, height=size,
+    # array backend of getPointCloud, a backend or a name for projection.getBackend. Created on the first
+    # getPointCloud, so sensors which only render heightmaps do not initialize a gpu
+    self.backend = backend
+    self.tran_pix_world = None
+    # size -> projection.getPixelGrid
+    self.pixel_grids = {}
+    # render size -> size x size buffer of the rendered heightmap, reused by every resampled getHeightmap
+    self.render_buffers = {}
+
+  def getBackend(self):
+    '''
+    Get the array backend, and the inverse of projection @ view on it
+    '''
+    if self.backend is None or isinstance(self.backend, str):
+      self.backend = projection.getBackend(self.backend)
+    if self.tran_pix_world is None:
+      projection_matrix = np.asarray(self.proj_matrix).reshape([4, 4], order='F')
+      view_matrix = np.asarray(self.view_matrix).reshape([4, 4], order='F')
+      self.tran_pix_world = self.backend.inv(self.backend.asarray(np.matmul(projection_matrix, view_matrix)))
+    return self.backend
+
+  def getHeightmap(self, size, render_size=None):
+    '''
+    Render a size x size heightmap. The returned array is new, as envs keep it as their heightmap, but the rendered
+    heightmap of a different render_size is written into a buffer kept per render size.
+
+    Args:
+      - size: Heightmap size
+      - render_size: Size of the rendered depth image, None for size. A multiple of size is supersampled and max
+                     pooled, a smaller size is rendered at a lower resolution and upsampled with nearest neighbor.
+    '''
+    if render_size is None or render_size == size:
+      return self.depthToHeightmap(self.getDepthImage(size), size)
+    if render_size > size and render_size % size != 0:
+      raise ValueError('render_size {} is not a multiple of the heightmap size {}'.format(render_size, size))
+    if render_size not in self.render_buffers:
+      self.render_buffers[render_size] = np.empty((render_size, render_size))
+    heightmap = self.depthToHeightmap(self.getDepthImage(render_size), render_size, self.render_buffers[render_size])
+    return self.resampleHeightmap(heightmap, size)
+
+  def resampleHeightmap(self, heightmap, size):
+    '''
+    Resample a square heightmap to a new size x size heightmap, see getHeightmap
+    '''
+    out = np.empty((size, size))
+    render_size = heightmap.shape[0]
+    if render_size == size:
+      out[:] = heightmap
+    elif render_size > size:
+      k = render_size // size
+      np.max(heightmap.reshape(size, k, size, k), axis=(1, 3), out=out)
+    else:
+      idx = np.arange(size) * render_size // size
+      out[:] = heightmap[idx[:, None], idx[None, :]]
+    return out
+
+  def getDepthImage(self, size, rows=None, cols=None):
+    '''
+    Render the OpenGL depth buffer only, skipping the segmentation mask.
+
+    Args:
+      - size: Image size
+      - rows, cols: (start, end) pixel ranges to only render a tile of the size x size image, None for the whole image
+
+    Returns: Depth buffer with size * size values, or with the number of pixels of the tile
+    '''
+    if rows is None:
+      rows = cols = (0, size)
+    image_arr = pb.getCameraImage(width=cols[1] - cols[0], height=rows[1] - rows[0],
                                   viewMatrix=self.view_matrix,
-                                  projectionMatrix=self.proj_matrix,
-                                  renderer=pb.ER_TINY_RENDERER)
-    depth_img = np.array(image_arr[3])
-    depth = self.far * self.near / (self.far - (self.far - self.near) * depth_img)
+                                  projectionMatrix=self.getTileProjection(size, rows, cols),
+                                  renderer=pb.ER_TINY_RENDERER,
+                                  flags=pb.ER_NO_SEGMENTATION_MASK)
+    return image_arr[3]
+
+  def getTileProjection(self, size, rows, cols):
+    '''
+    Get the projection matrix whose frustum only covers the given pixels of the size x size image. The clip space of
+    the camera is scaled and shifted so that the tile spans the whole normalized device coordinates.
+
+    Args:
+      - rows, cols: (start, end) pixel ranges of the tile
+
+    Returns: Column major projection matrix, as pybullet matrices
+    '''
+    if rows == (0, size) and cols == (0, size):
+      return self.proj_matrix
+    # ndc of the tile borders. x goes right along the columns, y goes up against the rows
+    x0, x1 = 2 * cols[0] / size - 1, 2 * cols[1] / size - 1
+    y0, y1 = 1 - 2 * rows[1] / size, 1 - 2 * rows[0] / size
+    crop = np.array([[2 / (x1 - x0), 0, 0, -(x1 + x0) / (x1 - x0)],
+                     [0, 2 / (y1 - y0), 0, -(y1 + y0) / (y1 - y0)],
+                     [0, 0, 1, 0],
+                     [0, 0, 0, 1]])
+    projection_matrix = np.asarray(self.proj_matrix).reshape([4, 4], order='F')
+    return tuple((crop @ projection_matrix).flatten(order='F'))
+
+  def getPixelBox(self, size, aabb, margin=1):
+    '''
+    Get the pixels of the size x size image covered by an axis aligned bounding box.
+
+    Args:
+      - aabb: (min, max) world corners of the box
+      - margin: Number of pixels to pad the box with
+
+    Returns: (start, end) row and column ranges clipped to the image, or None if the box is out of the image
+    '''
+    corners = np.array(np.meshgrid(*zip(*aabb), indexing='ij')).reshape(3, -1)
+    corners = np.concatenate((corners, np.ones((1, corners.shape[1]))))
+    projection_matrix = np.asarray(self.proj_matrix).reshape([4, 4], order='F')
+    view_matrix = np.asarray(self.view_matrix).reshape([4, 4], order='F')
+    ndc = (projection_matrix @ view_matrix) @ corners
+    ndc = ndc[:2] / ndc[3]
+    cols = (ndc[0] + 1) * size / 2
+    rows = (1 - ndc[1]) * size / 2
+    r0, r1 = max(int(np.floor(rows.min())) - margin, 0), min(int(np.ceil(rows.max())) + margin, size)
+    c0, c1 = max(int(np.floor(cols.min())) - margin, 0), min(int(np.ceil(cols.max())) + margin, size)
+    if r0 >= r1 or c0 >= c1:
+      return None
+    return (r0, r1), (c0, c1)
+
+  def depthToLinear(self, depth_img, shape, out=None):
+    '''
+    Convert an OpenGL depth buffer into the distance to the camera plane, far * near / (far - (far - near) * depth_img),
+    in place in out.
+    '''
+    if out is None:
+      out = np.empty(shape)
+    np.multiply(np.asarray(depth_img).reshape(shape), -(self.far - self.near), out=out)
+    out += self.far
+    np.divide(self.far * self.near, out, out=out)
+    return out
+
+  def depthToHeightmap(self, depth_img, size, out=None):
+    '''
+    Convert a depth buffer into a heightmap in place in out, without temporary arrays.
+    Same as abs(depth - max(depth)) of the linear depth far * near / (far - (far - near) * depth_img).
+
+    Args:
+      - depth_img: Depth buffer with size * size values
+      - out: size x size float array to write the heightmap into, a new array if None
 
-    return np.abs(depth - np.max(depth)).reshape(size, size)
+    Returns: The heightmap
+    '''
+    out = self.depthToLinear(depth_img, (size, size), out)
+    np.subtract(out.max(), out, out=out)
+    return out
 
   def getPointCloud(self, size, to_numpy=True):
     image_arr = pb.getCameraImage(width=size, height=size,
                                   viewMatrix=self.view_matrix,
                                   projectionMatrix=self.proj_matrix,
                                   renderer=pb.ER_TINY_RENDERER)
-    depthImg = cp.asarray(image_arr[3])
-
-    # https://stackoverflow.com/questions/59128880/getting-world-coordinates-from-opengl-depth-buffer
-    projectionMatrix = cp.asarray(self.proj_matrix).reshape([4,4],order='F')
-    viewMatrix = cp.asarray(self.view_matrix).reshape([4,4],order='F')
-    tran_pix_world = cp.linalg.inv(cp.matmul(projectionMatrix, viewMatrix))
-    pixel_pos = cp.mgrid[0:size, 0:size]
-    pixel_pos = pixel_pos/(size/2) - 1
-    pixel_pos = cp.moveaxis(pixel_pos, 1, 2)
-    pixel_pos[1] = -pixel_pos[1]
-    zs = 2*depthImg.reshape(1, size, size) - 1
-    pixel_pos = cp.concatenate((pixel_pos, zs))
-    pixel_pos = pixel_pos.reshape(3, -1)
-    augment = cp.ones((1, pixel_pos.shape[1]))
-    pixel_pos = cp.concatenate((pixel_pos, augment), axis=0)
-    position = cp.matmul(tran_pix_world, pixel_pos)
-    pc = position / position[3]
-    points = pc.T[:, :3]
+    backend = self.getBackend()
+    if size not in self.pixel_grids:
+      self.pixel_grids[size] = projection.getPixelGrid(backend, self.tran_pix_world, size)
+    points = projection.getPointCloud(backend, image_arr[3], self.pixel_grids[size])
 
     if to_numpy:
-      points = cp.asnumpy(points)
-    return points
\ No newline at end of file
+      points = backend.asnumpy(points)
+    return points
@@ -0,0 +1,76 @@
+import sys
+import time
+import collections
+
+sys.path.append('./')
+sys.path.append('..')
+
+from utils.parameters import *
+from storage.buffer import QLearningBuffer, QLearningBufferTensor
+from utils.torch_utils import augmentData2Buffer, augmentData2BufferSequential
+
+ExpertTransition = collections.namedtuple('ExpertTransition',
+                                          'state obs action reward next_state next_obs done step_left expert')
+
+
+def randomTransition():
+    """
+    A transition with random heightmaps and a random action inside the action space
+    """
+    obs = (torch.rand(heightmap_size, heightmap_size) * 0.1, torch.zeros(patch_size, patch_size))
+    next_obs = (torch.rand(heightmap_size, heightmap_size) * 0.1, torch.zeros(patch_size, patch_size))
+    action = torch.tensor([np.random.randint(action_pixel_range), np.random.randint(action_pixel_range),
+                           np.random.randint(num_rotations)])
+    return ExpertTransition(torch.tensor(0.), obs, action, torch.tensor(0.), torch.tensor(0.), next_obs,
+                            torch.tensor(0.), torch.tensor(0.), torch.tensor(0))
+
+
+def benchmark(augment, transitions, rzs):
+    """
+    :return: the number of transitions augmented into the buffer per second
+    """
+    buffer = QLearningBuffer(len(transitions) * onpolicy_data_aug_n)
+    start = time.time()
+    for d in transitions:
+        augment(buffer, d, rzs, onpolicy_data_aug_n, onpolicy_data_aug_rotate, onpolicy_data_aug_flip)
+    return len(transitions) / (time.time() - start)
+
+
+def benchmarkBufferAug(aug_mode, transitions, rzs):
+    """
+    Time adding the transitions to a QLearningBufferTensor and sampling training_iters batches after each of them
+    :param aug_mode: 'insert' to add augmented copies with augmentData2Buffer, 'sample' to augment sampled batches
+    :return: the number of transitions per second, and the number of transitions stored in the buffer
+    """
+    aug_rzs = rzs if aug_mode == 'sample' else None
+    buffer = QLearningBufferTensor(len(transitions) * onpolicy_data_aug_n, aug_rzs=aug_rzs,
+                                   aug_flip=onpolicy_data_aug_flip)
+    start = time.time()
+    for d in transitions:
+        if aug_mode == 'sample':
+            buffer.add(d)
+        else:
+            augmentData2Buffer(buffer, d, rzs, onpolicy_data_aug_n, onpolicy_data_aug_rotate, onpolicy_data_aug_flip)
+        for _ in range(training_iters):
+            buffer.sample(sample_batch_size)
+    return len(transitions) / (time.time() - start), len(buffer)
+
+
+if __name__ == '__main__':
+    if seed is not None:
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+    num_transitions = 500
+    rzs = torch.from_numpy(np.linspace(0, (num_rotations - 1) * np.pi / num_rotations, num_rotations)).float()
+    transitions = [randomTransition() for _ in range(num_transitions)]
+
+    sequential = benchmark(augmentData2BufferSequential, transitions, rzs)
+    batched = benchmark(augmentData2Buffer, transitions, rzs)
+    print('augmenting {} transitions with onpolicy_data_aug_n={}'.format(num_transitions, onpolicy_data_aug_n))
+    print('sequential: {:.1f} transitions/s'.format(sequential))
+    print('batched: {:.1f} transitions/s ({:.2f}x)'.format(batched, batched / sequential))
+
+    for aug_mode in ['insert', 'sample']:
+        throughput, stored = benchmarkBufferAug(aug_mode, transitions, rzs)
+        print('buffer_aug={}: {:.1f} transitions/s with {} sampled batches each, {} transitions stored'.format(
+            aug_mode, throughput, training_iters, stored))
@@ -0,0 +1,58 @@
+import sys
+import time
+
+sys.path.append('./')
+sys.path.append('..')
+
+from utils.parameters import *
+from helping_hands_rl_envs import env_factory
+from helping_hands_rl_envs.simulators import constants
+
+
+def benchmark(runner, pick_motion, seeds):
+    """
+    Pick an object of the scene of each seed, with the same scene and pick for each pick_motion
+    :return: the grasp success of each pick, and the time per step in s
+    """
+    env, planner = runner.env, runner.planner
+    env.robot.pick_motion = pick_motion
+    successes = []
+    step_time = 0
+    for s in seeds:
+        env.generateScene(s)
+        rng = np.random.RandomState(s)
+        positions = env.getObjectPositions()
+        x, y, _ = positions[rng.randint(len(positions))]
+        action = planner.encodeAction(constants.PICK_PRIMATIVE, x, y, 0., rng.uniform(0., np.pi))
+        start = time.time()
+        env.step(action)
+        step_time += time.time() - start
+        successes.append(env.obj_grasped > 0)
+    return np.array(successes), step_time / len(seeds)
+
+
+if __name__ == '__main__':
+    num_trials = 200
+    min_tolerance = 0.05
+    env_config['render'] = False
+    env_config['scene_corpus'] = None
+    env_config['scene_pool_size'] = 0
+    runner = env_factory.createEnvs(0, simulator, env, env_config, planner_config)
+    seeds = list(range(num_trials))
+
+    dynamic, dynamic_time = benchmark(runner, 'dynamic', seeds)
+    kinematic, kinematic_time = benchmark(runner, 'kinematic', seeds)
+
+    # two standard errors of the difference of the success rates, at least min_tolerance as the sampled variance is 0
+    # when both modes always or never succeed
+    tolerance = max(2 * np.sqrt((dynamic.var() + kinematic.var()) / num_trials), min_tolerance)
+    within = abs(kinematic.mean() - dynamic.mean()) <= tolerance
+    print('{} picks on the same scenes of {}'.format(num_trials, env))
+    print('dynamic: success rate {:.3f}, {:.3f} s/step'.format(dynamic.mean(), dynamic_time))
+    print('kinematic: success rate {:.3f}, {:.3f} s/step ({:.2f}x)'.format(kinematic.mean(), kinematic_time,
+                                                                        dynamic_time / kinematic_time))
+    print('same outcome on {:.1%} of the picks, success rate difference {:.3f} {} tolerance {:.3f}'.format(
+        (dynamic == kinematic).mean(), kinematic.mean() - dynamic.mean(),
+        'within' if within else 'OUTSIDE', tolerance))
+    if not within:
+        sys.exit(1)
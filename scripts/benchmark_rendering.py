@@ -0,0 +1,64 @@
+import sys
+import time
+
+sys.path.append('./')
+sys.path.append('..')
+
+import pybullet as pb
+
+from utils.parameters import *
+from helping_hands_rl_envs import env_factory
+
+
+def fullRenderHeightmap(sensor, size):
+    """
+    The heightmap of a full camera image with rgb and segmentation, the rendering before render_scale
+    """
+    image_arr = pb.getCameraImage(width=size, height=size, viewMatrix=sensor.view_matrix,
+                                  projectionMatrix=sensor.proj_matrix, renderer=pb.ER_TINY_RENDERER)
+    return sensor.depthToHeightmap(image_arr[3], size)
+
+
+def benchmark(get_heightmap, num_repeats):
+    """
+    :return: the heightmap and the time per heightmap in ms
+    """
+    start = time.time()
+    for _ in range(num_repeats):
+        heightmap = get_heightmap()
+    return heightmap, (time.time() - start) / num_repeats * 1000
+
+
+if __name__ == '__main__':
+    num_scenes = 5
+    num_repeats = 20
+    render_scales = [1, 0.5, 0.75, 2]
+    env_config['render'] = False
+    envs = env_factory.createEnvs(0, simulator, env, env_config, planner_config)
+    sensor = envs.env.sensor
+    print('{} heightmaps of {} scenes of {}, heightmap_size={}'.format(num_repeats, num_scenes, env, heightmap_size))
+
+    times = {'full': []}
+    errors = {}
+    for scale in render_scales:
+        times[scale] = []
+        errors[scale] = []
+    for _ in range(num_scenes):
+        envs.reset()
+        reference, t = benchmark(lambda: fullRenderHeightmap(sensor, heightmap_size), num_repeats)
+        times['full'].append(t)
+        for scale in render_scales:
+            render_size = int(round(heightmap_size * scale))
+            heightmap, t = benchmark(lambda: sensor.getHeightmap(heightmap_size, render_size=render_size),
+                                     num_repeats)
+            times[scale].append(t)
+            errors[scale].append(np.abs(heightmap - reference))
+
+    print('rgb+depth+segmentation: {:.2f} ms'.format(np.mean(times['full'])))
+    for scale in render_scales:
+        error = np.stack(errors[scale])
+        print('depth only, render_scale={}: {:.2f} ms ({:.2f}x), mean abs error {:.2e} m, max abs error {:.2e} m, '
+              '{:.1%} pixels off by more than 5 mm'.format(scale, np.mean(times[scale]),
+                                                          np.mean(times['full']) / np.mean(times[scale]),
+                                                          error.mean(), error.max(), (error > 0.005).mean()))
+    envs.close()
@@ -0,0 +1,19 @@
+from utils.parameters import *
+from storage.buffer import QLearningBufferExpert, QLearningBufferTensor, QLearningBufferDedup
+
+
+def createBuffer(rzs):
+    """
+    Creates the replay buffer selected by buffer_type
+    :param rzs: a list of all a_theta value of the agent, used by buffer_aug='sample'
+    """
+    aug_rzs = rzs if buffer_aug == 'sample' else None
+    if buffer_type == 'tensor':
+        return QLearningBufferTensor(buffer_size, aug_rzs=aug_rzs, aug_flip=onpolicy_data_aug_flip)
+    elif buffer_type == 'dedup':
+        return QLearningBufferDedup(buffer_size, aug_rzs=aug_rzs, aug_flip=onpolicy_data_aug_flip)
+    elif buffer_type == 'list' and buffer_aug == 'insert' and not shared_obs_slots:
+        # the list buffer keeps references to the observations, which are overwritten in the shared observation ring
+        return QLearningBufferExpert(buffer_size)
+    else:
+        raise NotImplementedError
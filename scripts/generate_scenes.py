@@ -0,0 +1,47 @@
+import sys
+import time
+
+sys.path.append('./')
+sys.path.append('..')
+
+from tqdm import tqdm
+
+from utils.parameters import *
+from helping_hands_rl_envs import env_factory
+from helping_hands_rl_envs.simulators.pybullet.utils.scene_corpus import saveSceneCorpus
+
+
+def generateScenes(envs, seeds, batch_size):
+    """
+    Build a scene for each seed, batch_size scenes at a time
+    :return: the list of scenes
+    """
+    scenes = []
+    pbar = tqdm(total=len(seeds))
+    for i in range(0, len(seeds), batch_size):
+        batch_seeds = seeds[i:i + batch_size]
+        scenes.extend(envs.generateScenes(batch_seeds))
+        pbar.update(len(batch_seeds))
+    pbar.close()
+    return scenes
+
+
+if __name__ == '__main__':
+    if scene_corpus is None:
+        raise ValueError('Set the output file of the scenes with --scene_corpus')
+    # the envs must build every scene themselves
+    env_config['scene_corpus'] = None
+    env_config['scene_pool_size'] = 0
+    env_config['render'] = False
+    envs = env_factory.createEnvs(num_processes, simulator, env, env_config)
+    seed_base = 0 if seed is None else seed * num_scenes
+    seeds = list(range(seed_base, seed_base + num_scenes))
+
+    start = time.time()
+    scenes = generateScenes(envs, seeds, max(num_processes, 1))
+    saveSceneCorpus(scene_corpus, scenes, seeds)
+    if num_processes > 0:
+        # SingleRunner has no close
+        envs.close()
+    print('generated {} scenes of {} in {:.1f} s, saved to {}'.format(len(scenes), env, time.time() - start,
+                                                                     scene_corpus))
@@ -3,6 +3,9 @@ import sys
 import time
 import copy
 import collections
+import contextlib
+import threading
+import concurrent.futures
 from tqdm import tqdm
 
 sys.path.append('./')
@@ -11,12 +14,13 @@ sys.path.append('PATH_TO_Help_Hans_rl_envs')
 # example PATH_TO_Help_Hans_rl_envs: sys.path.append('/home/my computer/helping_hands_rl_envs')
 
 from scripts.create_agent import createAgent
+from scripts.create_buffer import createBuffer
 from utils.visualization_utils import plot_action
 from utils.parameters import *
-from storage.buffer import QLearningBufferExpert
 from utils.logger import Logger
 from utils.env_wrapper import EnvWrapper
 from utils.torch_utils import augmentData2Buffer
+from utils.parallel_utils import TransitionQueue, LatestValue, LockedLogger
 np.seterr(invalid='ignore')
 
 ExpertTransition = collections.namedtuple('ExpertTransition',
@@ -38,14 +42,16 @@ def getCurrentObs(in_hand, obs):
     return obss
 
 
-def train_step(agent, replay_buffer, logger):
+def train_step(agent, replay_buffer, logger, logger_lock=None):
     """
     Training an SGD step
+    :param logger_lock: lock held while updating the logger, when the logger is shared with an actor thread
     """
     batch = replay_buffer.sample(sample_batch_size, onpolicydata=sample_onpolicydata, onlyfailure=onlyfailure)
     loss, td_error = agent.update(batch)
-    logger.trainingBookkeeping(loss, td_error.mean().item())
-    logger.num_training_steps += 1
+    with logger_lock if logger_lock is not None else contextlib.nullcontext():
+        logger.trainingBookkeeping(loss, td_error.mean().item())
+        logger.num_training_steps += 1
 
 
 def evaluate(envs, agent, logger):
@@ -101,14 +107,227 @@ def saveModelAndInfo(logger, agent):
     logger.saveEvalRewards()
 
 
+def collectSync(envs, agent, replay_buffer, logger, states, in_hands, obs, eps):
+    """
+    Collect transitions by stepping all envs synchronously
+    :param states, in_hands, obs: the current observations of all envs
+    :return: states, in_hands, obs of all envs after the step
+    """
+    is_expert = 0
+    q_value_maps, actions_star_idx, actions_star, in_hand_obs = \
+        agent.getBoltzmannActions(states, in_hands, obs, temperature=train_tau, eps=eps, return_patch=True)
+
+    buffer_obs = getCurrentObs(in_hands, obs)
+    actions_star = torch.cat((actions_star, states.unsqueeze(1)), dim=1)
+    envs.stepAsync(actions_star, auto_reset=False)
+
+    states_, in_hands_, obs_, rewards, dones = envs.stepWait()
+    steps_lefts = envs.getStepLeft()
+
+    done_idxes = torch.nonzero(dones).squeeze(1)
+    if done_idxes.shape[0] != 0:
+        reset_states_, reset_in_hands_, reset_obs_ = envs.reset_envs(done_idxes)
+        for j, idx in enumerate(done_idxes):
+            states_[idx] = reset_states_[j]
+            in_hands_[idx] = reset_in_hands_[j]
+            obs_[idx] = reset_obs_[j]
+
+    # if render:
+    if render and not rewards.item():
+        plot_action(obs, agent, actions_star, actions_star_idx, q_value_maps, num_rotations,
+                    patch_size, rewards, in_hand_obs, action_sequence)
+
+    buffer_obs_ = getCurrentObs(in_hands_, obs_)
+
+    if not fixed_buffer:
+        for i in range(num_processes):
+            data = ExpertTransition(states[i], buffer_obs[i], actions_star_idx[i], rewards[i], states_[i],
+                                        buffer_obs_[i], dones[i], steps_lefts[i], torch.tensor(is_expert))
+            if buffer_aug == 'sample':
+                replay_buffer.add(data)
+            else:
+                augmentData2Buffer(replay_buffer, data, agent.rzs,
+                                   onpolicy_data_aug_n, onpolicy_data_aug_rotate, onpolicy_data_aug_flip)
+
+    logger.stepBookkeeping(rewards.numpy(), steps_lefts.numpy(), dones.numpy())
+
+    return copy.copy(states_), copy.copy(in_hands_), copy.copy(obs_)
+
+
+def collectRolling(envs, agent, replay_buffer, logger, states, in_hands, obs, ready_ids, pending, eps):
+    """
+    Collect transitions from a rolling batch of envs: act in the envs of ready_ids, then wait for at least
+    step_min_ready envs to finish their step, without waiting for the slowest env
+    :param states, in_hands, obs: the current observations of all envs
+    :param ready_ids: the ids of the envs waiting for an action
+    :param pending: the (state, obs, action_idx) of the pending step of each env, updated in place
+    :return: states, in_hands, obs of all envs, the ready_ids for the next call
+    """
+    if ready_ids.size(0) > 0:
+        _, actions_star_idx, actions_star = agent.getBoltzmannActions(states[ready_ids], in_hands[ready_ids],
+                                                                      obs[ready_ids], temperature=train_tau, eps=eps)
+        buffer_obs = getCurrentObs(in_hands[ready_ids], obs[ready_ids])
+        for j, idx in enumerate(ready_ids.tolist()):
+            pending[idx] = (states[idx], buffer_obs[j], actions_star_idx[j])
+        actions_star = torch.cat((actions_star, states[ready_ids].unsqueeze(1)), dim=1)
+        envs.stepAnyAsync(actions_star, ready_ids)
+
+    # the worker resets done envs, like reset_envs in the synchronous loop the next obs is the one after the reset
+    ready_ids, states_, in_hands_, obs_, rewards, dones, steps_lefts = envs.wait(step_min_ready)
+    if ready_ids.size(0) > 0 and steps_lefts is None:
+        # the runner has no planners
+        steps_lefts = torch.zeros_like(rewards)
+    buffer_obs_ = getCurrentObs(in_hands_, obs_)
+    collected = [pending.pop(idx) for idx in ready_ids.tolist()]
+    if not fixed_buffer:
+        for j, (state, buffer_ob, action_idx) in enumerate(collected):
+            data = ExpertTransition(state, buffer_ob, action_idx, rewards[j], states_[j], buffer_obs_[j], dones[j],
+                                    steps_lefts[j], torch.tensor(0))
+            if buffer_aug == 'sample':
+                replay_buffer.add(data)
+            else:
+                augmentData2Buffer(replay_buffer, data, agent.rzs,
+                                   onpolicy_data_aug_n, onpolicy_data_aug_rotate, onpolicy_data_aug_flip)
+    logger.stepBookkeeping(rewards.numpy(), steps_lefts.numpy(), dones.numpy(), env_ids=ready_ids.numpy())
+
+    # out of place, the pending transitions keep views of the previous observations
+    states = states.index_copy(0, ready_ids, states_)
+    in_hands = in_hands.index_copy(0, ready_ids, in_hands_)
+    obs = obs.index_copy(0, ready_ids, obs_)
+    return states, in_hands, obs, ready_ids
+
+
+class Collector:
+    """
+    Steps the envs with collectRolling if step_min_ready is set, otherwise with collectSync, and keeps the current
+    observations of the envs between the steps
+    """
+    def __init__(self, envs, states, in_hands, obs):
+        self.envs = envs
+        self.states = states
+        self.in_hands = in_hands
+        self.obs = obs
+        self.ready_ids = torch.arange(num_processes)
+        self.pending = {}
+
+    def collect(self, agent, replay_buffer, logger, eps):
+        """
+        :return: the number of env steps collected
+        """
+        if step_min_ready:
+            self.states, self.in_hands, self.obs, self.ready_ids = \
+                collectRolling(self.envs, agent, replay_buffer, logger, self.states, self.in_hands, self.obs,
+                               self.ready_ids, self.pending, eps)
+            return self.ready_ids.size(0)
+        self.states, self.in_hands, self.obs = collectSync(self.envs, agent, replay_buffer, logger, self.states,
+                                                           self.in_hands, self.obs, eps)
+        return num_processes
+
+    def finish(self):
+        """
+        collect the pending steps of collectRolling, the envs must be idle to be saved
+        """
+        if step_min_ready:
+            self.envs.wait(num_processes)
+
+
+def updateProgressBar(pbar, logger, eps, timer_start):
+    """
+    :return: the time of the update, the timer_start of the next update
+    """
+    timer_final = time.time()
+    description = 'Steps:{}; Reward:{:.03f}; Eval Reward:{:.03f}; Explore:{:.03f}; Loss:{:.03f}; Time:{:.03f}'.format(
+        logger.num_steps, logger.getCurrentAvgReward(learning_curve_avg_window),
+        logger.eval_rewards[-1] if len(logger.eval_rewards) > 0 else 0,
+        eps, float(logger.getCurrentLoss()), timer_final - timer_start)
+    pbar.set_description(description)
+    pbar.update(logger.num_episodes - pbar.n)
+    return timer_final
+
+
+def trainActorLearner(collector, eval_envs, agent, replay_buffer, logger, pbar):
+    """
+    Actor-learner training. An actor thread steps the envs with a copy of the agent, whose weights are refreshed from
+    the learner every actor_sync_freq SGD steps, and hands the augmented transitions over to the learner. The learner
+    runs the SGD steps on this thread at utd_ratio SGD steps per env step, the actor runs at most one batch of env
+    steps ahead of it. The logger is shared by both threads, the actor only updates it holding logger_lock
+    """
+    actor_agent = copy.deepcopy(agent)
+    logger_lock = threading.Lock()
+    actor_logger = LockedLogger(logger, logger_lock)
+    transitions = TransitionQueue(replay_buffer)
+    weights = LatestValue()
+    # evaluations and saves requested by the actor, they use the learner agent so they run on this thread
+    tasks = collections.deque()
+    stop = threading.Event()
+    ratio = utd_ratio if utd_ratio > 0 else training_iters / num_processes
+    num_trainable_steps = 0
+    num_sgd_steps = 0
+
+    def act():
+        nonlocal num_trainable_steps
+        while logger.num_episodes < max_episode and not stop.is_set():
+            snapshot = weights.get()
+            if snapshot is not None:
+                for network, state_dict in zip(actor_agent.networks, snapshot):
+                    network.load_state_dict(state_dict)
+            while ratio * (num_trainable_steps - num_processes) > num_sgd_steps and not stop.is_set():
+                time.sleep(0.001)
+
+            eps = init_eps if logger.num_episodes < step_eps else final_eps
+            num_new_steps = collector.collect(actor_agent, transitions, actor_logger, eps)
+            with logger_lock:
+                logger.num_steps += num_new_steps
+            if logger.num_episodes >= training_offset:
+                num_trainable_steps += num_new_steps
+
+            if logger.num_training_steps > 0 and logger.num_episodes % eval_freq == eval_freq - 1:
+                tasks.append(lambda: evaluate(eval_envs, agent, logger))
+            if (logger.num_episodes + 1) % (max_episode // num_saves) == 0:
+                tasks.append(lambda: saveModelAndInfo(logger, agent))
+
+    timer_start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        actor = executor.submit(act)
+        try:
+            while not actor.done() or len(transitions) > 0 or len(tasks) > 0 \
+                    or num_sgd_steps < ratio * num_trainable_steps:
+                transitions.flush()
+                while len(tasks) > 0:
+                    with logger_lock:
+                        tasks.popleft()()
+                if num_sgd_steps < ratio * num_trainable_steps:
+                    SGD_start = time.time()
+                    train_step(agent, replay_buffer, logger, logger_lock)
+                    with logger_lock:
+                        logger.SGD_time.append(time.time() - SGD_start)
+                    num_sgd_steps += 1
+                    if num_sgd_steps % actor_sync_freq == 0:
+                        weights.set([{k: v.detach().clone() for k, v in network.state_dict().items()}
+                                     for network in agent.networks])
+                else:
+                    time.sleep(0.001)
+                if not no_bar and pbar.n != logger.num_episodes:
+                    with logger_lock:
+                        timer_start = updateProgressBar(pbar, logger, final_eps if logger.num_episodes >= step_eps
+                                                        else init_eps, timer_start)
+        finally:
+            stop.set()
+        # raises the exception of the actor, if any
+        actor.result()
+
+
 def train():
     if seed is not None:
         set_seed(seed)
+    if actor_learner and shared_obs_slots:
+        # the queued transitions hold views of the shared observation ring until the learner adds them to the buffer
+        raise ValueError('actor_learner does not support shared_obs_slots')
 
     # setup the environment
-    envs = EnvWrapper(num_processes, simulator, env, env_config, planner_config)
+    envs = EnvWrapper(num_processes, simulator, env, env_config, planner_config, shared_obs_slots)
     env_config['render'] = False
-    eval_envs = EnvWrapper(eval_num_processes, simulator, env, env_config, planner_config)
+    eval_envs = EnvWrapper(eval_num_processes, simulator, env, env_config, planner_config, shared_obs_slots)
 
     # setup the agent
     agent = createAgent()
@@ -129,84 +348,52 @@ def train():
     logger.saveParameters(hyper_parameters)
 
     # setup buffer
-    replay_buffer = QLearningBufferExpert(buffer_size)
+    replay_buffer = createBuffer(agent.rzs)
 
     states, in_hands, obs = envs.reset()
 
     if load_sub:
         logger.loadCheckPoint(os.path.join(log_dir, load_sub, 'checkpoint'), envs, agent, replay_buffer)
 
+    pbar = None
     if not no_bar:
         pbar = tqdm(total=max_episode)
         pbar.set_description('Episodes:0; Reward:0.0; Explore:0.0; Loss:0.0; Time:0.0')
-    timer_start = time.time()
-
-    # the training loop
-    while logger.num_episodes < max_episode:
-        eps = init_eps if logger.num_episodes < step_eps else final_eps
-        is_expert = 0
-        q_value_maps, actions_star_idx, actions_star, in_hand_obs = \
-            agent.getBoltzmannActions(states, in_hands, obs, temperature=train_tau, eps=eps, return_patch=True)
-
-        buffer_obs = getCurrentObs(in_hands, obs)
-        actions_star = torch.cat((actions_star, states.unsqueeze(1)), dim=1)
-        envs.stepAsync(actions_star, auto_reset=False)
-
-        states_, in_hands_, obs_, rewards, dones = envs.stepWait()
-        steps_lefts = envs.getStepLeft()
-
-        done_idxes = torch.nonzero(dones).squeeze(1)
-        if done_idxes.shape[0] != 0:
-            reset_states_, reset_in_hands_, reset_obs_ = envs.reset_envs(done_idxes)
-            for j, idx in enumerate(done_idxes):
-                states_[idx] = reset_states_[j]
-                in_hands_[idx] = reset_in_hands_[j]
-                obs_[idx] = reset_obs_[j]
-
-        # if render:
-        if render and not rewards.item():
-            plot_action(obs, agent, actions_star, actions_star_idx, q_value_maps, num_rotations,
-                        patch_size, rewards, in_hand_obs, action_sequence)
-
-        buffer_obs_ = getCurrentObs(in_hands_, obs_)
-
-        if not fixed_buffer:
-            for i in range(num_processes):
-                data = ExpertTransition(states[i], buffer_obs[i], actions_star_idx[i], rewards[i], states_[i],
-                                            buffer_obs_[i], dones[i], steps_lefts[i], torch.tensor(is_expert))
-                augmentData2Buffer(replay_buffer, data, agent.rzs,
-                                   onpolicy_data_aug_n, onpolicy_data_aug_rotate, onpolicy_data_aug_flip)
-
-        logger.stepBookkeeping(rewards.numpy(), steps_lefts.numpy(), dones.numpy())
-
-        if logger.num_episodes >= training_offset:
-            for training_iter in range(training_iters):
-                SGD_start = time.time()
-                train_step(agent, replay_buffer, logger)
-                logger.SGD_time.append(time.time() - SGD_start)
-
-        states = copy.copy(states_)
-        obs = copy.copy(obs_)
-        in_hands = copy.copy(in_hands_)
-
-        if not no_bar:
-            timer_final = time.time()
-            description = 'Steps:{}; Reward:{:.03f}; Eval Reward:{:.03f}; Explore:{:.03f}; Loss:{:.03f}; Time:{:.03f}'.format(
-                logger.num_steps, logger.getCurrentAvgReward(learning_curve_avg_window),
-                logger.eval_rewards[-1] if len(logger.eval_rewards) > 0 else 0,
-                eps, float(logger.getCurrentLoss()), timer_final - timer_start)
-            pbar.set_description(description)
-            timer_start = timer_final
-            pbar.update(logger.num_episodes - pbar.n)
-        logger.num_steps += num_processes
-
-        if logger.num_training_steps > 0 and logger.num_episodes % eval_freq == eval_freq - 1:
-            evaluate(eval_envs, agent, logger)
-
-        if (logger.num_episodes + 1) % (max_episode // num_saves) == 0:
-            saveModelAndInfo(logger, agent)
+    collector = Collector(envs, states, in_hands, obs)
+
+    if actor_learner:
+        trainActorLearner(collector, eval_envs, agent, replay_buffer, logger, pbar)
+    else:
+        timer_start = time.time()
+        train_credit = 0
+        # the training loop
+        while logger.num_episodes < max_episode:
+            eps = init_eps if logger.num_episodes < step_eps else final_eps
+            num_new_steps = collector.collect(agent, replay_buffer, logger, eps)
+
+            # training_iters SGD steps per num_processes env steps, also when a rolling batch collected fewer steps
+            train_credit += training_iters * num_new_steps / num_processes
+            if logger.num_episodes >= training_offset:
+                while train_credit >= 1:
+                    SGD_start = time.time()
+                    train_step(agent, replay_buffer, logger)
+                    logger.SGD_time.append(time.time() - SGD_start)
+                    train_credit -= 1
+            else:
+                train_credit = 0
+
+            if not no_bar:
+                timer_start = updateProgressBar(pbar, logger, eps, timer_start)
+            logger.num_steps += num_new_steps
+
+            if logger.num_training_steps > 0 and logger.num_episodes % eval_freq == eval_freq - 1:
+                evaluate(eval_envs, agent, logger)
+
+            if (logger.num_episodes + 1) % (max_episode // num_saves) == 0:
+                saveModelAndInfo(logger, agent)
 
     saveModelAndInfo(logger, agent)
+    collector.finish()
     logger.saveCheckPoint(args, envs, agent, replay_buffer)
     envs.close()
 
@@ -10,6 +10,7 @@ from utils.visualization_utils import plot_action
 sys.path.append('./')
 sys.path.append('..')
 from scripts.create_agent import createAgent
+from scripts.create_buffer import createBuffer
 from utils.parameters import *
 from storage.buffer import QLearningBufferExpert, QLearningBuffer
 import rospy
@@ -94,7 +95,7 @@ def train():
     logger.saveParameters(hyper_parameters)
     plot_logger = logger if is_test else None
 
-    replay_buffer = QLearningBufferExpert(buffer_size)
+    replay_buffer = createBuffer(agent.rzs)
 
     envs.ur5.moveToHome()
     states, in_hands, obs = envs.reset()
@@ -131,8 +132,11 @@ def train():
             for i in range(num_processes):
                 data = ExpertTransition(states[i], buffer_obs[i], actions_star_idx[i], rewards[i], states_[i],
                                             buffer_obs_[i], dones[i], steps_lefts[i], torch.tensor(is_expert))
-                augmentData2Buffer(replay_buffer, data, agent.rzs,
-                                   onpolicy_data_aug_n, onpolicy_data_aug_rotate, onpolicy_data_aug_flip)
+                if buffer_aug == 'sample':
+                    replay_buffer.add(data)
+                else:
+                    augmentData2Buffer(replay_buffer, data, agent.rzs,
+                                       onpolicy_data_aug_n, onpolicy_data_aug_rotate, onpolicy_data_aug_flip)
         logger.stepBookkeeping(rewards.numpy(), steps_lefts.numpy(), dones.numpy())
 
         if logger.num_steps >= training_offset:
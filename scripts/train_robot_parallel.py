@@ -12,8 +12,9 @@ from utils.visualization_utils import plot_action
 sys.path.append('./')
 sys.path.append('..')
 from scripts.create_agent import createAgent
+from scripts.create_buffer import createBuffer
 from utils.parameters import *
-from storage.buffer import QLearningBufferExpert
+
 import rospy
 from src.envs.dual_bin_front_rear import DualBinFrontRear
 from utils.logger import Logger
@@ -184,8 +185,11 @@ class AgentWrapper:
                 is_expert = False
                 data = ExpertTransition(states[i], buffer_obs[i], self.actions_star_idx[i], reward[i], states[i],
                                         buffer_obs[i], dones[i], steps_lefts[i], torch.tensor(is_expert))
-                augmentData2Buffer(replay_buffer, data, agent.rzs,
-                                   onpolicy_data_aug_n, onpolicy_data_aug_rotate, onpolicy_data_aug_flip)
+                if buffer_aug == 'sample':
+                    replay_buffer.add(data)
+                else:
+                    augmentData2Buffer(replay_buffer, data, agent.rzs,
+                                       onpolicy_data_aug_n, onpolicy_data_aug_rotate, onpolicy_data_aug_flip)
 
             logger.stepBookkeeping(reward.numpy(), steps_lefts.numpy(), dones.numpy())
             # print('transition augmented')
@@ -248,7 +252,7 @@ if __name__ == '__main__':
     # setup the parallel agent
     p_agent = AgentWrapper()
     p_agent.eps = init_eps
-    replay_buffer = QLearningBufferExpert(buffer_size)
+    replay_buffer = createBuffer(agent.rzs)
 
     # logging
     simulator_str = copy.copy(simulator)
@@ -1,6 +1,9 @@
+import collections
 import numpy as np
 import numpy.random as npr
+import torch
 from copy import deepcopy
+from utils.torch_utils import warpImages, getBoundingTransforms, augmentActions
 
 
 class QLearningBuffer:
@@ -85,3 +88,327 @@ class QLearningBufferExpert(QLearningBuffer):
     def loadFromState(self, save_state):
         super().loadFromState(save_state)
         self._expert_idx = save_state['expert_idx']
+
+
+ExpertTransition = collections.namedtuple('ExpertTransition',
+                                          'state obs action reward next_state next_obs done step_left expert')
+# A sampled batch from QLearningBufferTensor. Each field is a tensor whose first dimension is the batch dimension
+TransitionBatch = collections.namedtuple('TransitionBatch',
+                                         'state obs in_hand action reward next_state next_obs next_in_hand done '
+                                         'step_left expert')
+
+
+class QLearningBufferTensor:
+    """
+    Columnar replay buffer. Every field of the transitions is stored in a tensor preallocated to the size of the
+    buffer (allocated on the first add, when the shapes are known), and sample returns a TransitionBatch of contiguous
+    tensors gathered with one index_select per column. Like QLearningBufferExpert, expert transitions are never
+    overwritten.
+    With aug_rzs, the buffer stores raw transitions and every sampled batch is augmented with a fresh random rigid
+    transform and flip per transition, instead of adding augmented copies with augmentData2Buffer
+    """
+    def __init__(self, size, aug_rzs=None, aug_flip=True):
+        """
+        :param size: the maximum number of transitions
+        :param aug_rzs: a list of all a_theta value. Enables augmentation at sample time when not None
+        :param aug_flip: flip the transitions augmented at sample time or not
+        """
+        self._aug_rzs = aug_rzs
+        self._aug_flip = aug_flip
+        self._clear(size)
+
+    def _clear(self, size):
+        self._columns = None
+        self._max_size = size
+        self._next_idx = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, key):
+        c = {k: v[key] for k, v in self._columns.items()}
+        return ExpertTransition(c['state'], (c['obs'], c['in_hand']), c['action'], c['reward'], c['next_state'],
+                                (c['next_obs'], c['next_in_hand']), c['done'], c['step_left'], c['expert'])
+
+    @staticmethod
+    def _flatten(data):
+        """
+        flatten a ExpertTransition into a dictionary of tensors, one entry per column
+        :param data: ExpertTransition
+        :return: dictionary of column name to tensor
+        """
+        flattened = {'state': data.state, 'obs': data.obs[0], 'in_hand': data.obs[1], 'action': data.action,
+                     'reward': data.reward, 'next_state': data.next_state, 'next_obs': data.next_obs[0],
+                     'next_in_hand': data.next_obs[1], 'done': data.done, 'step_left': data.step_left,
+                     'expert': data.expert}
+        return {k: torch.as_tensor(v) for k, v in flattened.items()}
+
+    def _allocate(self, flattened):
+        self._columns = {k: torch.empty((self._max_size,) + tuple(v.shape), dtype=v.dtype)
+                         for k, v in flattened.items()}
+        self._columns['expert'] = torch.zeros(self._max_size, dtype=torch.bool)
+
+    def add(self, data):
+        self._write(self._flatten(data))
+
+    def _write(self, flattened):
+        """
+        write a flattened transition at self._next_idx, then advance self._next_idx to the next non-expert slot
+        :param flattened: dictionary of column name to tensor
+        """
+        if self._columns is None:
+            self._allocate(flattened)
+        idx = self._next_idx
+        for k, v in flattened.items():
+            self._columns[k][idx] = v
+        self._len = max(self._len, idx + 1)
+        self._next_idx = (self._next_idx + 1) % self._max_size
+        if self._len == self._max_size:
+            while self._columns['expert'][self._next_idx]:
+                self._next_idx = (self._next_idx + 1) % self._max_size
+
+    def sample(self, batch_size, onpolicydata=False, onlyfailure=0):
+        batch_indexes = npr.choice(self._len, batch_size)
+        if onlyfailure > 0 and self._columns['reward'][self._len - 1].item() == 0:
+            # the transitions at the end of the storage, like QLearningBuffer
+            batch_indexes[-onlyfailure:] = np.arange(self._len - onlyfailure, self._len) % self._len
+        batch = self._gather(torch.from_numpy(batch_indexes))
+        if self._aug_rzs is not None:
+            batch = self._augment(batch)
+        return batch
+
+    def _augment(self, batch):
+        """
+        augment each transition in the batch with a random rigid transform and flip, like augmentData2Buffer
+        :param batch: TransitionBatch
+        :return: augmented TransitionBatch
+        """
+        num_rz = len(self._aug_rzs)
+        dtheta = self._aug_rzs[1] - self._aug_rzs[0]
+        theta_dis_n = int(2 * np.pi / dtheta)
+        batch_size = batch.obs.size(0)
+        transforms, thetas, pixels = getBoundingTransforms(batch.obs.shape[-2:], batch.action[:, :2].numpy(), 1,
+                                                           theta_dis_n=theta_dis_n)
+        flips = npr.random(batch_size) > 0.5 if self._aug_flip else np.zeros(batch_size, dtype=bool)
+        actions = augmentActions(batch.action, thetas[:, 0], pixels[:, 0], flips, num_rz, dtheta)
+        # obs and next_obs are warped as two channels of one image
+        obs = warpImages(torch.stack((batch.obs, batch.next_obs), dim=1), transforms[:, 0, :2])
+        flips = torch.from_numpy(flips)
+        obs[flips] = obs[flips].flip(2)
+        return batch._replace(obs=obs[:, 0], next_obs=obs[:, 1], action=actions)
+
+    def _gather(self, indexes):
+        """
+        :param indexes: 1d long tensor of transition indexes
+        :return: TransitionBatch
+        """
+        return TransitionBatch(**{k: v.index_select(0, indexes) for k, v in self._columns.items()})
+
+    def getSaveState(self):
+        return {
+            'columns': {k: v[:self._len].clone() for k, v in self._columns.items()}
+            if self._columns is not None else None,
+            'max_size': self._max_size,
+            'next_idx': self._next_idx,
+        }
+
+    def loadFromState(self, save_state):
+        self._clear(save_state['max_size'])
+        if 'storage' in save_state:
+            # checkpoint of a list buffer. Re-add the transitions from the oldest to the newest, so that the next adds
+            # overwrite the oldest ones
+            storage, next_idx = save_state['storage'], save_state['next_idx']
+            for data in storage[next_idx:] + storage[:next_idx]:
+                self.add(data)
+            return
+        columns = save_state['columns']
+        if columns is None:
+            return
+        self._len = columns['expert'].size(0)
+        self._columns = {k: torch.empty((self._max_size,) + tuple(v.shape[1:]), dtype=v.dtype)
+                         for k, v in columns.items()}
+        for k, v in columns.items():
+            self._columns[k][:self._len] = v
+        self._next_idx = save_state['next_idx']
+
+
+class FrameStore:
+    """
+    Stores each unique frame (e.g. a heightmap) once. Identical frames are found by hashing their content, and frames
+    are reference counted so that a slot is reused once no transition refers to it
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.frames = None
+        self.high = 0  # number of slots that have ever been used
+        self._refs = np.zeros(capacity, dtype=np.int64)
+        self._free = list(range(capacity - 1, -1, -1))
+        self._keys = {}
+        self._key_of = {}
+
+    def __len__(self):
+        return self.capacity - len(self._free)
+
+    @staticmethod
+    def _key(frame):
+        return hash(frame.contiguous().numpy().tobytes())
+
+    def add(self, frame):
+        """
+        add a reference to frame, storing it if no identical frame is stored
+        :param frame: tensor
+        :return: the index of the frame
+        """
+        frame = torch.as_tensor(frame).cpu()
+        if self.frames is None:
+            self.frames = torch.empty((min(1024, self.capacity),) + tuple(frame.shape), dtype=frame.dtype)
+        frame = frame.to(self.frames.dtype)
+        key = self._key(frame)
+        idx = self._keys.get(key)
+        if idx is not None and torch.equal(self.frames[idx], frame):
+            self._refs[idx] += 1
+            return idx
+        idx = self._free.pop()
+        if idx >= self.frames.size(0):
+            self._grow(idx + 1)
+        self.frames[idx] = frame
+        self._refs[idx] = 1
+        if key not in self._keys:
+            self._keys[key] = idx
+            self._key_of[idx] = key
+        self.high = max(self.high, idx + 1)
+        return idx
+
+    def _grow(self, min_size):
+        """
+        double the allocated frames until at least min_size frames fit. Only the slots in use count towards memory,
+        rather than the full capacity
+        """
+        size = max(self.frames.size(0), 1)
+        while size < min_size:
+            size *= 2
+        frames = torch.empty((min(size, self.capacity),) + tuple(self.frames.shape[1:]), dtype=self.frames.dtype)
+        frames[:self.high] = self.frames[:self.high]
+        self.frames = frames
+
+    def release(self, idx):
+        """
+        remove a reference to the frame at idx, freeing the slot if it was the last one
+        """
+        self._refs[idx] -= 1
+        if self._refs[idx] == 0:
+            key = self._key_of.pop(idx, None)
+            if key is not None:
+                del self._keys[key]
+            self._free.append(idx)
+
+    def getSaveState(self):
+        return {
+            'capacity': self.capacity,
+            'frames': self.frames[:self.high].clone() if self.frames is not None else None,
+            'refs': self._refs[:self.high].copy()
+        }
+
+    def loadFromState(self, save_state):
+        self.__init__(save_state['capacity'])
+        if save_state['frames'] is None:
+            return
+        self.high = save_state['frames'].size(0)
+        self.frames = save_state['frames'].clone()
+        self._refs[:self.high] = save_state['refs']
+        self._free = [idx for idx in range(self.capacity - 1, -1, -1) if self._refs[idx] == 0]
+        for idx in np.nonzero(self._refs)[0]:
+            key = self._key(self.frames[idx])
+            if key not in self._keys:
+                self._keys[key] = idx
+                self._key_of[idx] = key
+
+
+class QLearningBufferDedup(QLearningBufferTensor):
+    """
+    Columnar replay buffer that stores each unique obs and in_hand image once in a FrameStore. Transitions keep the
+    frame indices together with the affine transform and flip of their data augmentation, which are applied to the
+    sampled batch in sample
+    """
+    # augmentData2Buffer passes the augmentation to add instead of warping the obs
+    defer_warp = True
+
+    def __init__(self, size, aug_rzs=None, aug_flip=True, frame_capacity=None):
+        """
+        :param size: the maximum number of transitions
+        :param aug_rzs: a list of all a_theta value. Enables augmentation at sample time when not None
+        :param aug_flip: flip the transitions augmented at sample time or not
+        :param frame_capacity: the maximum number of unique frames of each kind. Each transition refers to at most
+        two, so the default 2 * size can never run out
+        """
+        self._frame_capacity = frame_capacity
+        super().__init__(size, aug_rzs, aug_flip)
+
+    def _clear(self, size):
+        super()._clear(size)
+        frame_capacity = 2 * size if self._frame_capacity is None else self._frame_capacity
+        self._obs_store = FrameStore(frame_capacity)
+        self._in_hand_store = FrameStore(frame_capacity)
+
+    def add(self, data, transform=None, flip=False):
+        """
+        :param data: ExpertTransition, with the raw obs and the augmented action
+        :param transform: 2x3 affine transform in pixel coordinates applied to obs and next_obs, None for identity
+        :param flip: flip obs and next_obs along the first axis after the transform
+        """
+        if transform is None:
+            transform = np.eye(3)[:2]
+        if self._next_idx < self._len:
+            # release the frames of the overwritten transition first, so that 2 * size frames are always enough
+            self._releaseFrames(self._next_idx)
+        flattened = {'state': data.state, 'action': data.action, 'reward': data.reward,
+                     'next_state': data.next_state, 'done': data.done, 'step_left': data.step_left,
+                     'expert': data.expert}
+        flattened = {k: torch.as_tensor(v) for k, v in flattened.items()}
+        flattened['obs'] = torch.tensor(self._obs_store.add(data.obs[0]))
+        flattened['in_hand'] = torch.tensor(self._in_hand_store.add(data.obs[1]))
+        flattened['next_obs'] = torch.tensor(self._obs_store.add(data.next_obs[0]))
+        flattened['next_in_hand'] = torch.tensor(self._in_hand_store.add(data.next_obs[1]))
+        flattened['transform'] = torch.as_tensor(transform, dtype=torch.float32)
+        flattened['flip'] = torch.tensor(bool(flip))
+        self._write(flattened)
+
+    def _releaseFrames(self, idx):
+        self._obs_store.release(self._columns['obs'][idx].item())
+        self._in_hand_store.release(self._columns['in_hand'][idx].item())
+        self._obs_store.release(self._columns['next_obs'][idx].item())
+        self._in_hand_store.release(self._columns['next_in_hand'][idx].item())
+
+    def __getitem__(self, key):
+        batch = self._gather(torch.tensor([key]))
+        return ExpertTransition(batch.state[0], (batch.obs[0], batch.in_hand[0]), batch.action[0], batch.reward[0],
+                                batch.next_state[0], (batch.next_obs[0], batch.next_in_hand[0]), batch.done[0],
+                                batch.step_left[0], batch.expert[0])
+
+    def _gather(self, indexes):
+        columns = {k: v.index_select(0, indexes) for k, v in self._columns.items()}
+        transforms = columns.pop('transform')
+        flips = columns.pop('flip')
+        # obs and next_obs are warped as two channels of one image
+        obs = torch.stack((self._obs_store.frames.index_select(0, columns['obs']),
+                           self._obs_store.frames.index_select(0, columns['next_obs'])), dim=1)
+        if not torch.equal(transforms, torch.eye(3)[:2].expand_as(transforms)):
+            obs = warpImages(obs, transforms)
+        obs[flips] = obs[flips].flip(2)
+        columns['obs'], columns['next_obs'] = obs[:, 0], obs[:, 1]
+        columns['in_hand'] = self._in_hand_store.frames.index_select(0, columns['in_hand'])
+        columns['next_in_hand'] = self._in_hand_store.frames.index_select(0, columns['next_in_hand'])
+        return TransitionBatch(**columns)
+
+    def getSaveState(self):
+        save_state = super().getSaveState()
+        save_state['obs_store'] = self._obs_store.getSaveState()
+        save_state['in_hand_store'] = self._in_hand_store.getSaveState()
+        return save_state
+
+    def loadFromState(self, save_state):
+        super().loadFromState(save_state)
+        if 'storage' not in save_state:
+            self._obs_store.loadFromState(save_state['obs_store'])
+            self._in_hand_store.loadFromState(save_state['in_hand_store'])
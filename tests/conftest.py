@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the repo packages, like the scripts do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,99 @@
+'''
+The local bounding box masks of the numpy objects against the full heightmap masks they replace.
+'''
+import numpy as np
+import pytest
+from scipy.ndimage import binary_dilation
+
+from helping_hands_rl_envs.simulators.numpy import utils
+from helping_hands_rl_envs.simulators.numpy.objects.cube import Cube
+from helping_hands_rl_envs.simulators.numpy.objects.cylinder import Cylinder
+
+HEIGHTMAP_SIZE = 128
+
+def fullCubeMask(pos, rot, size, shape):
+  '''
+  Cube.getMask before the local masks: the unrotated cube rotated over the full heightmap
+  '''
+  x_min, x_max = max(0, int(pos[0] - size / 2)), min(shape[0], int(pos[0] + size / 2))
+  y_min, y_max = max(0, int(pos[1] - size / 2)), min(shape[1], int(pos[1] + size / 2))
+  mask = np.zeros(shape, dtype=int)
+  mask[y_min:y_max, x_min:x_max] = 1
+  mask = utils.rotateImage(mask, np.rad2deg(rot), (pos[1], pos[0]))
+  return mask == 1
+
+def fullCylinderMask(pos, size, shape):
+  '''
+  Cylinder.getMask before the local masks
+  '''
+  y, x = np.ogrid[-pos[0]:shape[0] - pos[0], -pos[1]:shape[1] - pos[1]]
+  region = x * x + y * y <= (size / 2) * (size / 2)
+  mask = np.zeros(shape, dtype=int)
+  mask[region.T] = 1
+  return mask == 1
+
+def toFullMask(mask, shape):
+  full = np.zeros(shape, dtype=bool)
+  full[mask] = True
+  assert full.sum() == len(mask[0]), 'the mask has duplicated pixels'
+  return full
+
+def samplePoses(num, rotate, margin=0):
+  rng = np.random.default_rng(num + int(rotate))
+  for _ in range(num):
+    size = int(rng.integers(10, 20))
+    pos = [int(rng.integers(margin, HEIGHTMAP_SIZE - margin)), int(rng.integers(margin, HEIGHTMAP_SIZE - margin)), 5]
+    rot = rng.uniform(0, np.pi) if rotate else 0.
+    yield pos, rot, size
+
+def testCylinderMask():
+  shape = (HEIGHTMAP_SIZE, HEIGHTMAP_SIZE)
+  for pos, rot, size in samplePoses(200, False):
+    cylinder = Cylinder(list(pos), rot, size, np.zeros(shape))
+    np.testing.assert_array_equal(toFullMask(cylinder.mask, shape), fullCylinderMask(pos, size, shape))
+
+def testAxisAlignedCubeMask():
+  shape = (HEIGHTMAP_SIZE, HEIGHTMAP_SIZE)
+  # the border cases of the full mask are not symmetric, keep the cubes within the heightmap
+  for pos, rot, size in samplePoses(200, False, margin=12):
+    cube = Cube(list(pos), rot, size, np.zeros(shape))
+    np.testing.assert_array_equal(toFullMask(cube.mask, shape), fullCubeMask(pos, rot, size, shape))
+
+def testRotatedCubeMask():
+  '''
+  The spline rotation of the full mask and the exact rasterization disagree on the edge pixels only, at most a one
+  pixel shift of two sides of the cube
+  '''
+  shape = (HEIGHTMAP_SIZE, HEIGHTMAP_SIZE)
+  for pos, rot, size in samplePoses(200, True, margin=20):
+    cube = Cube(list(pos), rot, size, np.zeros(shape))
+    new = toFullMask(cube.mask, shape)
+    old = fullCubeMask(pos, rot, size, shape)
+    diff = new ^ old
+    assert diff.sum() <= 2.5 * size
+    assert not (diff & ~binary_dilation(new, iterations=2)).any()
+    assert not (diff & ~binary_dilation(old, iterations=2)).any()
+
+@pytest.mark.parametrize('object_class', [Cube, Cylinder])
+def testMaskOutOfHeightmap(object_class):
+  '''
+  Objects over the border of the heightmap only cover the pixels within it
+  '''
+  shape = (HEIGHTMAP_SIZE, HEIGHTMAP_SIZE)
+  for pos in ([0, 0, 5], [HEIGHTMAP_SIZE - 1, 60, 5], [60, HEIGHTMAP_SIZE + 3, 5]):
+    obj = object_class(list(pos), np.pi / 5, 14, np.zeros(shape))
+    rows, cols = obj.mask
+    assert ((rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])).all()
+    toFullMask(obj.mask, shape)
+
+def testAddAndRemove():
+  heightmap = np.zeros((HEIGHTMAP_SIZE, HEIGHTMAP_SIZE))
+  cube = Cube([40, 50, 8], 0.3, 14, heightmap)
+  cube.addToHeightmap(heightmap)
+  cylinder = Cylinder([45, 55, 8], 0., 12, heightmap)
+  cylinder.addToHeightmap(heightmap, [45, 55, 8])
+  assert heightmap.max() == 16
+  cylinder.removeFromHeightmap(heightmap)
+  np.testing.assert_array_equal(heightmap[cube.mask], 8)
+  cube.removeFromHeightmap(heightmap)
+  assert not heightmap.any()
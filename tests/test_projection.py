@@ -0,0 +1,150 @@
+'''
+Parity of the projection backends with the original cupy point cloud reconstruction and
+lexsort/bincount z-buffer of Sensor and Renderer, run on numpy.
+'''
+import numpy as np
+import pytest
+
+from helping_hands_rl_envs.simulators.pybullet.utils import projection
+
+def getBackends():
+  backends = [projection.getBackend('numpy'), projection.getBackend('torch', device='cpu')]
+  try:
+    backends.append(projection.getBackend('cupy'))
+  except ImportError:
+    pass
+  return backends
+
+BACKENDS = getBackends()
+
+def lookAt(eye, target, up):
+  '''
+  Column major view matrix, as pb.computeViewMatrix
+  '''
+  f = np.asarray(target, dtype=float) - eye
+  f /= np.linalg.norm(f)
+  s = np.cross(f, up)
+  s /= np.linalg.norm(s)
+  u = np.cross(s, f)
+  m = np.eye(4)
+  m[0, :3], m[1, :3], m[2, :3] = s, u, -f
+  m[:3, 3] = -m[:3, :3] @ eye
+  return tuple(m.flatten(order='F'))
+
+def perspective(fov, near, far):
+  '''
+  Column major projection matrix, as pb.computeProjectionMatrixFOV with aspect 1
+  '''
+  f = 1 / np.tan(np.radians(fov) / 2)
+  m = np.zeros((4, 4))
+  m[0, 0] = m[1, 1] = f
+  m[2, 2] = (far + near) / (near - far)
+  m[2, 3] = 2 * far * near / (near - far)
+  m[3, 2] = -1
+  return tuple(m.flatten(order='F'))
+
+VIEW = lookAt(np.array([0.5, 0., 10.]), [0.5, 0., 0.], [-1., 0., 0.])
+PROJ = perspective(2, 9, 11)
+
+def referencePointCloud(depth_img, size):
+  '''
+  Sensor.getPointCloud before the backends
+  '''
+  projection_matrix = np.asarray(PROJ).reshape([4, 4], order='F')
+  view_matrix = np.asarray(VIEW).reshape([4, 4], order='F')
+  tran_pix_world = np.linalg.inv(np.matmul(projection_matrix, view_matrix))
+  pixel_pos = np.mgrid[0:size, 0:size]
+  pixel_pos = pixel_pos / (size / 2) - 1
+  pixel_pos = np.moveaxis(pixel_pos, 1, 2)
+  pixel_pos[1] = -pixel_pos[1]
+  zs = 2 * np.asarray(depth_img).reshape(1, size, size) - 1
+  pixel_pos = np.concatenate((pixel_pos, zs)).reshape(3, -1)
+  pixel_pos = np.concatenate((pixel_pos, np.ones((1, pixel_pos.shape[1]))), axis=0)
+  position = np.matmul(tran_pix_world, pixel_pos)
+  pc = position / position[3]
+  return pc.T[:, :3]
+
+def getTranWorldPix(target_size):
+  view_matrix = np.asarray(VIEW).reshape([4, 4], order='F')
+  projection_matrix = np.array([[1 / (target_size / 2), 0, 0, 0],
+                                [0, 1 / (target_size / 2), 0, 0],
+                                [0, 0, -1, 0],
+                                [0, 0, 0, 1]])
+  return projection_matrix @ view_matrix
+
+def referenceHeightmap(points, size, target_size):
+  '''
+  Renderer.projectHeightmap before the backends
+  '''
+  pts = np.concatenate((points.T, np.ones((1, points.shape[0]))), axis=0)
+  pts = np.matmul(getTranWorldPix(target_size), pts)
+  pts[1] = -pts[1]
+  pts[0] = (pts[0] + 1) * size / 2
+  pts[1] = (pts[1] + 1) * size / 2
+  pts[0] = np.round(pts[0])
+  pts[1] = np.round(pts[1])
+  mask = (pts[0] >= 0) * (pts[0] < size) * (pts[1] > 0) * (pts[1] < size)
+  pts = pts[:, mask]
+  mix_xy = (pts[1].astype(int) * size + pts[0].astype(int))
+  ind = np.lexsort(np.stack((pts[2], mix_xy)))
+  bincount = np.bincount(mix_xy)
+  cumsum = np.cumsum(bincount)
+  cumsum = np.roll(cumsum, 1)
+  cumsum[0] = bincount[0]
+  cumsum = np.concatenate((cumsum, -1 * np.ones(size * size - cumsum.shape[0]))).astype(int)
+  depth = pts[2][ind][cumsum]
+  depth[cumsum == 0] = np.nan
+  depth = depth.reshape(size, size)
+  mask = np.isnan(depth)
+  depth[mask] = np.interp(np.flatnonzero(mask), np.flatnonzero(~mask), depth[~mask])
+  return np.abs(depth - np.max(depth))
+
+@pytest.mark.parametrize('backend', BACKENDS, ids=lambda b: b.name)
+@pytest.mark.parametrize('size', [90, 128])
+def testPointCloud(backend, size):
+  rng = np.random.default_rng(size)
+  depth = rng.uniform(0.3, 0.7, size * size)
+  projection_matrix = np.asarray(PROJ).reshape([4, 4], order='F')
+  view_matrix = np.asarray(VIEW).reshape([4, 4], order='F')
+  tran_pix_world = backend.inv(backend.asarray(projection_matrix @ view_matrix))
+  pixel_grid = projection.getPixelGrid(backend, tran_pix_world, size)
+  points = backend.asnumpy(projection.getPointCloud(backend, depth, pixel_grid))
+  np.testing.assert_allclose(points, referencePointCloud(depth, size), rtol=1e-9, atol=1e-12)
+
+@pytest.mark.parametrize('backend', BACKENDS, ids=lambda b: b.name)
+@pytest.mark.parametrize('size, target_size, num_points', [
+  (128, 0.6, 200000),  # dense, most pixels hold several points
+  (90, 0.4, 200000),   # part of the points fall out of the heightmap
+  (128, 3.0, 200000),  # the points only cover the center of the heightmap
+  (128, 0.6, 500),     # sparse, most pixels are interpolated
+])
+def testProjectHeightmap(backend, size, target_size, num_points):
+  rng = np.random.default_rng(num_points + size)
+  # rounded, so that several points of a pixel share the same z
+  points = np.round(rng.uniform([0.2, -0.3, 0.], [0.8, 0.3, 0.3], (num_points, 3)), 3)
+  heightmap = projection.projectHeightmap(backend, backend.asarray(points),
+                                          backend.asarray(getTranWorldPix(target_size)), size)
+  assert isinstance(heightmap, np.ndarray)
+  np.testing.assert_array_equal(heightmap, referenceHeightmap(points, size, target_size))
+
+@pytest.mark.parametrize('backend', BACKENDS, ids=lambda b: b.name)
+def testPointCloudRoundTrip(backend):
+  '''
+  A point cloud of a depth buffer projected back with its own camera
+  '''
+  size = 64
+  rng = np.random.default_rng(1)
+  depth = rng.uniform(0.3, 0.7, size * size)
+  projection_matrix = np.asarray(PROJ).reshape([4, 4], order='F')
+  view_matrix = np.asarray(VIEW).reshape([4, 4], order='F')
+  tran_pix_world = backend.inv(backend.asarray(projection_matrix @ view_matrix))
+  points = projection.getPointCloud(backend, depth, projection.getPixelGrid(backend, tran_pix_world, size))
+  heightmap = projection.projectHeightmap(backend, points, backend.asarray(getTranWorldPix(0.6)), size)
+  np.testing.assert_array_equal(heightmap, referenceHeightmap(backend.asnumpy(points), size, 0.6))
+
+def testGetBackend():
+  assert projection.getBackend('numpy').name == 'numpy'
+  assert projection.getBackend('torch', device='cpu').name == 'torch'
+  assert projection.getBackend().name in ('numpy', 'cupy')
+  with pytest.raises(ValueError):
+    projection.getBackend('jax')
@@ -3,8 +3,9 @@ from helping_hands_rl_envs import env_factory
 
 
 class EnvWrapper:
-    def __init__(self, num_processes, simulator, env, env_config, planner_config):
-        self.envs = env_factory.createEnvs(num_processes, simulator, env, env_config, planner_config)
+    def __init__(self, num_processes, simulator, env, env_config, planner_config, shared_obs_slots=0):
+        self.envs = env_factory.createEnvs(num_processes, simulator, env, env_config, planner_config,
+                                           shared_obs_slots=shared_obs_slots)
 
     def reset(self):
         (states, in_hands, obs) = self.envs.reset()
@@ -19,11 +20,12 @@ class EnvWrapper:
     def step(self, actions, auto_reset=False):
         actions = actions.cpu().numpy()
         (states_, in_hands_, obs_), rewards, dones = self.envs.step(actions, auto_reset)
-        states_ = torch.tensor(states_).float()
-        in_hands_ = torch.tensor(in_hands_).float()
-        obs_ = torch.tensor(obs_).float()
-        rewards = torch.tensor(rewards).float()
-        dones = torch.tensor(dones).float()
+        # zero-copy when the runner returns float32 arrays, e.g., views of its shared observation ring
+        states_ = torch.as_tensor(states_).float()
+        in_hands_ = torch.as_tensor(in_hands_).float()
+        obs_ = torch.as_tensor(obs_).float()
+        rewards = torch.as_tensor(rewards).float()
+        dones = torch.as_tensor(dones).float()
         return states_, in_hands_, obs_, rewards, dones
 
     def stepAsync(self, actions, auto_reset=False):
@@ -32,13 +34,32 @@ class EnvWrapper:
 
     def stepWait(self):
         (states_, in_hands_, obs_), rewards, dones = self.envs.stepWait()
-        states_ = torch.tensor(states_).float()
-        in_hands_ = torch.tensor(in_hands_).float()
-        obs_ = torch.tensor(obs_).float()
-        rewards = torch.tensor(rewards).float()
-        dones = torch.tensor(dones).float()
+        # zero-copy when the runner returns float32 arrays, e.g., views of its shared observation ring
+        states_ = torch.as_tensor(states_).float()
+        in_hands_ = torch.as_tensor(in_hands_).float()
+        obs_ = torch.as_tensor(obs_).float()
+        rewards = torch.as_tensor(rewards).float()
+        dones = torch.as_tensor(dones).float()
         return states_, in_hands_, obs_, rewards, dones
 
+    def stepAnyAsync(self, actions, env_ids, auto_reset=True):
+        actions = actions.cpu().numpy()
+        self.envs.stepAnyAsync(actions, torch.as_tensor(env_ids).numpy(), auto_reset)
+
+    def wait(self, min_ready=1, timeout=None):
+        env_ids, (states_, in_hands_, obs_), rewards, dones, steps_lefts = self.envs.wait(min_ready, timeout)
+        env_ids = torch.from_numpy(env_ids)
+        if env_ids.size(0) == 0:
+            return env_ids, None, None, None, None, None, None
+        states_ = torch.as_tensor(states_).float()
+        in_hands_ = torch.as_tensor(in_hands_).float()
+        obs_ = torch.as_tensor(obs_).float()
+        rewards = torch.as_tensor(rewards).float()
+        dones = torch.as_tensor(dones).float()
+        # None when the runner has no planners
+        steps_lefts = torch.as_tensor(steps_lefts).float() if steps_lefts is not None else None
+        return env_ids, states_, in_hands_, obs_, rewards, dones, steps_lefts
+
     def getStepLeft(self):
         return torch.tensor(self.envs.getStepsLeft()).float()
 
@@ -71,17 +71,22 @@ class Logger(object):
         # Buffer of transitions
         self.transitions = list()
 
-    def stepBookkeeping(self, rewards, step_lefts, done_masks):
-        self.episode_rewards += rewards.squeeze()
+    def stepBookkeeping(self, rewards, step_lefts, done_masks, env_ids=None):
+        '''
+        :param env_ids: ids of the envs the rewards belong to, when only some envs stepped. None for all envs
+        '''
+        if env_ids is None:
+            env_ids = np.arange(self.num_envs)
+        self.episode_rewards[env_ids] += rewards.reshape(-1)
         self.num_episodes += len(rewards)
         if env_config['reward_type'] == 'dense':
             self.rewards.extend(rewards)
-            self.reward_step.extend(self.num_steps + np.arange(1, num_processes + 1)[rewards.astype(bool)])
+            self.reward_step.extend(self.num_steps + np.arange(1, len(rewards) + 1)[rewards.astype(bool)])
         else:
-            self.rewards.extend(self.episode_rewards[done_masks.astype(bool)])
-            self.reward_step.extend(self.num_steps + np.arange(1, num_processes + 1)[done_masks.astype(bool)])
+            self.rewards.extend(self.episode_rewards[env_ids[done_masks.astype(bool)]])
+            self.reward_step.extend(self.num_steps + np.arange(1, len(rewards) + 1)[done_masks.astype(bool)])
         self.steps_left.extend(step_lefts[done_masks.astype(bool)])
-        self.episode_rewards[done_masks.astype(bool)] = 0.
+        self.episode_rewards[env_ids[done_masks.astype(bool)]] = 0.
 
     def trainingBookkeeping(self, loss, td_error):
         self.losses.append(loss)
@@ -1,4 +1,5 @@
 import threading
+import collections
 
 SENTINEL = object()
 
@@ -38,6 +39,73 @@ class Pipe:
         # print(" {}: thread {} getlock released".format(self.name, operator))
 
 
+class LatestValue:
+    """
+    Lock-free single slot handoff from one producer thread to one consumer thread. The producer overwrites the value,
+    the consumer gets the newest value once. Relies on the atomic attribute assignment of the GIL: the value and its
+    version are published together as one tuple.
+    """
+    def __init__(self):
+        self.item = (0, None)
+        self.consumed_version = 0
+
+    def set(self, value):
+        self.item = (self.item[0] + 1, value)
+
+    def get(self):
+        """
+        :return: the newest value, or None if there is no new value since the last get
+        """
+        version, value = self.item
+        if version == self.consumed_version:
+            return None
+        self.consumed_version = version
+        return value
+
+
+class TransitionQueue:
+    """
+    Lock-free handoff of transitions from an actor thread to the learner thread. Has the add interface of the replay
+    buffer, so augmentData2Buffer can be used on it. The queued transitions are added to the buffer by flush on the
+    learner thread, the only thread using the buffer.
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.defer_warp = getattr(buffer, 'defer_warp', False)
+        self.queue = collections.deque()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, *args, **kwargs):
+        self.queue.append((args, kwargs))
+
+    def flush(self):
+        """
+        add the queued transitions to the buffer
+        """
+        while len(self.queue) > 0:
+            args, kwargs = self.queue.popleft()
+            self.buffer.add(*args, **kwargs)
+
+
+class LockedLogger:
+    """
+    Logger of the actor thread, whose step bookkeeping holds the lock the learner thread holds while it uses the
+    logger. The other attributes are read from the logger.
+    """
+    def __init__(self, logger, lock):
+        self.logger = logger
+        self.lock = lock
+
+    def stepBookkeeping(self, *args, **kwargs):
+        with self.lock:
+            self.logger.stepBookkeeping(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.logger, name)
+
+
 State = Pipe('state')
 Action = Pipe('action')
 Reward = Pipe('reward')
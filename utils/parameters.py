@@ -31,9 +31,35 @@ env_group.add_argument('--simulate_grasp', type=strToBool, default=True)
 env_group.add_argument('--action_sequence', type=str, default='xyrp')
 env_group.add_argument('--random_orientation', type=strToBool, default=True)
 env_group.add_argument('--num_processes', type=int, default=1)
+env_group.add_argument('--shared_obs_slots', type=int, default=0,
+                       help='transfer the step observations of the env processes through a shared memory ring with '
+                            'this many slots instead of pipes, 0 to disable, otherwise at least 2. Requires a '
+                            'buffer_type which copies')
+env_group.add_argument('--step_min_ready', type=int, default=0,
+                       help='step the env processes asynchronously, acting on a rolling batch of at least this many '
+                            'envs which finished their step. 0 to step all envs synchronously')
 env_group.add_argument('--render', type=strToBool, default=False)
 env_group.add_argument('--workspace_size', type=float, default=0.3)
 env_group.add_argument('--heightmap_size', type=int, default=128)
+env_group.add_argument('--render_scale', type=float, default=1,
+                       help='render the heightmap at heightmap_size*render_scale. An integer > 1 supersamples, < 1 '
+                            'renders at a lower resolution and upsamples')
+env_group.add_argument('--incremental_heightmap', type=strToBool, default=False,
+                       help='only re-render the heightmap tiles of the objects which moved since the last step')
+env_group.add_argument('--adaptive_wait', type=strToBool, default=False,
+                       help='stop the physics simulation after an action once all objects are at rest')
+env_group.add_argument('--batch_spawn', type=strToBool, default=False,
+                       help='spawn all clutter objects at once at reset and settle them together')
+env_group.add_argument('--scene_pool_size', type=int, default=0,
+                       help='number of settled clutter scenes each env keeps and resets from, 0 to disable')
+env_group.add_argument('--scene_pool_max_reuse', type=int, default=4,
+                       help='number of resets from a pooled scene before it is replaced by a new one')
+env_group.add_argument('--scene_corpus', type=str, default=None,
+                       help='scene corpus file to reset from, written by scripts/generate_scenes.py')
+env_group.add_argument('--pick_motion', type=str, default='dynamic', choices=['dynamic', 'kinematic'],
+                       help='kinematic only simulates the descend, grasp and a short lift of the picks')
+env_group.add_argument('--num_scenes', type=int, default=1000,
+                       help='number of scenes scripts/generate_scenes.py generates')
 env_group.add_argument('--action_pixel_range', type=int, default=96)
 env_group.add_argument('--action_mask', type=str, default='square', choices=['square'])
 env_group.add_argument('--patch_size', type=int, default=32)
@@ -58,6 +84,12 @@ training_group.add_argument('--final_eps', type=float, default=0.)
 training_group.add_argument('--train_tau', type=float, default=0.01)
 training_group.add_argument('--test_tau', type=float, default=0.002)
 training_group.add_argument('--training_iters', type=int, default=1)
+training_group.add_argument('--actor_learner', type=strToBool, default=False,
+                            help='step the envs on an actor thread while the SGD steps run on the main thread')
+training_group.add_argument('--utd_ratio', type=float, default=0,
+                            help='SGD steps per env step in actor_learner mode, 0 for training_iters / num_processes')
+training_group.add_argument('--actor_sync_freq', type=int, default=10,
+                            help='copy the learner weights to the actor every this many SGD steps')
 training_group.add_argument('--training_offset', type=int, default=20)
 training_group.add_argument('--max_episode', type=int, default=1500)
 training_group.add_argument('--device_name', type=str, default='cuda')
@@ -96,6 +128,9 @@ buffer_group.add_argument('--success_to_expert', type=strToBool, default=False)
 buffer_group.add_argument('--batch_size', type=int, default=8)
 buffer_group.add_argument('--buffer_size', type=int, default=100000)
 buffer_group.add_argument('--fixed_buffer', action='store_true')
+buffer_group.add_argument('--buffer_type', type=str, default='tensor', choices=['list', 'tensor', 'dedup'])
+buffer_group.add_argument('--buffer_aug', type=str, default='insert', choices=['insert', 'sample'],
+                          help='augment transitions when adding them to the buffer or when sampling batches')
 
 logging_group = parser.add_argument_group('logging')
 logging_group.add_argument('--log_pre', type=str, default='/tmp')
@@ -117,12 +152,23 @@ fast_mode = args.fast_mode
 simulate_grasp = args.simulate_grasp
 action_sequence = args.action_sequence
 num_processes = args.num_processes
+shared_obs_slots = args.shared_obs_slots
+step_min_ready = args.step_min_ready
 render = args.render
 perfect_grasp = args.perfect_grasp
 perfect_place = args.perfect_place
 scale = 1.
 robot = args.robot
 heightmap_size = args.heightmap_size
+render_scale = args.render_scale
+incremental_heightmap = args.incremental_heightmap
+adaptive_wait = args.adaptive_wait
+batch_spawn = args.batch_spawn
+scene_pool_size = args.scene_pool_size
+scene_pool_max_reuse = args.scene_pool_max_reuse
+scene_corpus = args.scene_corpus
+num_scenes = args.num_scenes
+pick_motion = args.pick_motion
 action_mask = args.action_mask
 action_pixel_range = args.action_pixel_range
 patch_size = args.patch_size
@@ -194,6 +240,9 @@ final_eps = args.final_eps
 train_tau = args.train_tau
 test_tau = args.test_tau
 training_iters = args.training_iters
+actor_learner = args.actor_learner
+utd_ratio = args.utd_ratio
+actor_sync_freq = args.actor_sync_freq
 training_offset = args.training_offset
 max_episode = args.max_episode
 device = torch.device(args.device_name)
@@ -238,6 +287,8 @@ else:
     batch_size = sample_batch_size
 buffer_size = args.buffer_size
 fixed_buffer = args.fixed_buffer
+buffer_type = args.buffer_type
+buffer_aug = args.buffer_aug
 
 # logging
 log_pre = args.log_pre
@@ -259,7 +310,11 @@ env_config = {'workspace': workspace, 'max_steps': max_episode_steps, 'obs_size'
               'random_orientation': random_orientation, 'reward_type': reward_type, 'simulate_grasp': simulate_grasp,
               'perfect_grasp': perfect_grasp, 'perfect_place': perfect_place, 'scale': scale, 'robot': robot,
               'workspace_check': 'point', 'in_hand_mode': in_hand_mode, 'object_scale_range': (0.6, 0.6),
-              'hard_reset_freq': 1000, 'physics_mode': 'fast', 'z_heuristic': 'patch_center'}
+              'hard_reset_freq': 1000, 'physics_mode': 'fast', 'z_heuristic': 'patch_center',
+              'render_scale': render_scale, 'incremental_heightmap': incremental_heightmap,
+              'adaptive_wait': adaptive_wait, 'batch_spawn': batch_spawn,
+              'scene_pool_size': scene_pool_size, 'scene_pool_max_reuse': scene_pool_max_reuse,
+              'scene_corpus': scene_corpus, 'pick_motion': pick_motion}
 planner_config = {'pos_noise': 0., 'rot_noise': 0.,
                   'random_orientation': random_orientation, 'half_rotation': half_rotation}
 
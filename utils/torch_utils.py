@@ -131,19 +131,20 @@ def argSoftmax1d(tensor, temperature):
     return m.long()
 
 
-def argSoftmax2d(tensor, temperature, num_samples=1, return_1d_idx=False):
+def argSoftmax2d(tensor, temperature, num_samples=1, return_1d_idx=False, replacement=False):
     """
   Find the index of the Softmax value in a 2d tensor. Prob is proportional to q/temperature
 
   Args:
     - tensor: PyTorch tensor of size (n x 1 x d x d)
+    - replacement: draw the num_samples samples with replacement
 
   Returns: n x num_samples x 2 PyTorch tensor containing indexes of max values
   """
     n = tensor.size(0)
     d = tensor.size(2)
     probs = (tensor / temperature).view(n, -1).softmax(dim=-1)
-    m = torch.multinomial(probs, num_samples)
+    m = torch.multinomial(probs, num_samples, replacement=replacement)
     if not return_1d_idx:
         return torch.cat(((m // d).view(-1, 1), (m % d).view(-1, 1)), dim=1).long()
     else:
@@ -248,6 +249,18 @@ class Dilation:
         else:
             return True
 
+    def check_in_hand_not_empty_dilation_batch(self, in_hand, in_hand_size, threshold):
+        """
+        Batched chech_in_hand_not_emtpy_dilation
+        :return: bool tensor with one entry per in_hand image
+        """
+        assert self.n == in_hand_size
+        if self.diameter != 0:
+            patch = (in_hand > threshold).float() * self.cf2.to(in_hand.device)
+            return patch.reshape(patch.size(0), -1).sum(1) > 1
+        else:
+            return torch.ones(in_hand.size(0), dtype=torch.bool, device=in_hand.device)
+
 
 def check_in_hand_not_empty(in_hand, in_hand_size, threshold):
     patch = in_hand[0, 0, int(3 * in_hand_size / 8):int(5 * in_hand_size / 8),
@@ -329,9 +342,14 @@ def get_random_image_transform_params(image_size, theta_dis_n=32, trans_sigma=-1
     return theta, trans, pivot
 
 
-def perturbBoundingAction(current_image, next_image, pixels, set_theta_zero=False, theta_dis_n=32):
-    """Data augmentation on images."""
-    image_size = current_image.shape[:2]
+def getBoundingTransform(image_size, pixels, theta_dis_n=32):
+    """
+    Sample a random rigid transform that keeps the action pixel and the bounding box around it inside the action space
+    :param image_size: (H, W) of the image
+    :param pixels: list with one action pixel in action space. The offset to the image is added in place
+    :param theta_dis_n: number of discrete rotations in 2pi
+    :return: transform, transform_params, new_pixels, new_rounded_pixels
+    """
     pixels[0] += np.array((action2obs_offset, action2obs_offset))
     nppixels = np.array(pixels)
     bbox_current = [np.maximum(nppixels[:, 0] - 5, action2obs_offset)[0],
@@ -393,6 +411,14 @@ def perturbBoundingAction(current_image, next_image, pixels, set_theta_zero=Fals
 
     new_pixels = new_pixels[:-4]
     new_rounded_pixels = new_rounded_pixels[:-4]
+    return transform, transform_params, new_pixels, new_rounded_pixels
+
+
+def perturbBoundingAction(current_image, next_image, pixels, set_theta_zero=False, theta_dis_n=32):
+    """Data augmentation on images."""
+    image_size = current_image.shape[:2]
+    transform, transform_params, new_pixels, new_rounded_pixels = \
+        getBoundingTransform(image_size, pixels, theta_dis_n)
 
     # Apply rigid transform to image and pixel labels.
     if is_real_world:
@@ -422,9 +448,33 @@ def perturbBoundingAction(current_image, next_image, pixels, set_theta_zero=Fals
     return current_image, next_image, new_pixels, new_rounded_pixels, transform_params
 
 
-def augmentData2Buffer(buffer, d, rzs, aug_n, rotate, flip):
+def warpImages(images, transforms):
+    """
+    Batched equivalent of cv2.warpAffine(image, transform, flags=cv2.INTER_NEAREST), with zero border
+    :param images: BxHxW tensor, or BxCxHxW tensor with one transform for all channels of an image
+    :param transforms: Bx2x3 affine transforms in pixel coordinates, mapping source pixel (x, y) to destination pixel
+    :return: tensor of warped images with the same shape as images
     """
-    Augment transition data to buffer
+    b, h, w = images.size(0), images.size(-2), images.size(-1)
+    transforms = torch.as_tensor(transforms, dtype=torch.float64).reshape(b, 2, 3)
+    full_transforms = torch.zeros(b, 3, 3, dtype=torch.float64)
+    full_transforms[:, :2] = transforms
+    full_transforms[:, 2, 2] = 1
+    # affine_grid maps normalized destination coordinates to normalized source coordinates
+    normalize = torch.tensor([[2 / (w - 1), 0, -1],
+                              [0, 2 / (h - 1), -1],
+                              [0, 0, 1]], dtype=torch.float64)
+    theta = normalize.matmul(torch.inverse(full_transforms)).matmul(torch.inverse(normalize))[:, :2]
+    grid = F.affine_grid(theta.float().to(images.device), [b, 1, h, w], align_corners=True)
+    warped = F.grid_sample(images.reshape(b, -1, h, w).float(), grid, mode='nearest', padding_mode='zeros',
+                           align_corners=True)
+    return warped.reshape(images.shape).to(images.dtype)
+
+
+def augmentData2BufferSequential(buffer, d, rzs, aug_n, rotate, flip):
+    """
+    Augment transition data to buffer, sampling and warping one augmentation at a time. Reference implementation of
+    augmentData2Buffer
     :param buffer: buffer
     :param d: transition data
     :param rzs: a list of all a_theta value
@@ -438,14 +488,23 @@ def augmentData2Buffer(buffer, d, rzs, aug_n, rotate, flip):
     theta_dis_n = int(2 * np.pi / dtheta)
     primative_idx, x_idx, y_idx, z_idx, rot_idx = map(lambda a: action_sequence.find(a),
                                                       ['p', 'x', 'y', 'z', 'r'])
+    # buffers with defer_warp store the transform and flip with the raw obs, and warp the obs when sampling
+    defer_warp = getattr(buffer, 'defer_warp', False)
+    transforms = []
+    flips = []
 
     for _ in range(aug_n):
-        obs, next_obs, _, (trans_pixel,), transform_params = \
-            perturbBoundingAction(d.obs[0].clone(),
-                                  d.next_obs[0].clone(),
-                                  [d.action[:2].clone().numpy()],
-                                  set_theta_zero=not rotate,
-                                  theta_dis_n=theta_dis_n)
+        if defer_warp:
+            transform, transform_params, _, (trans_pixel,) = \
+                getBoundingTransform(d.obs[0].shape[:2], [d.action[:2].clone().numpy()], theta_dis_n=theta_dis_n)
+            transforms.append(transform[:2, :])
+        else:
+            obs, next_obs, _, (trans_pixel,), transform_params = \
+                perturbBoundingAction(d.obs[0].clone(),
+                                      d.next_obs[0].clone(),
+                                      [d.action[:2].clone().numpy()],
+                                      set_theta_zero=not rotate,
+                                      theta_dis_n=theta_dis_n)
         action_theta = d.action[rot_idx].clone()
         trans_theta, _, _ = transform_params
         action_theta -= (trans_theta / dtheta).round().long()
@@ -461,8 +520,7 @@ def augmentData2Buffer(buffer, d, rzs, aug_n, rotate, flip):
             trans_action[rot_idx] = action_theta.item()
 
         if flip and np.random.random() > 0.5:
-            flipped_obs = np.flip(obs, 0)
-            flipped_next_obs = np.flip(next_obs, 0)
+            flips.append(True)
             flipped_xy = trans_pixel.copy()
             flipped_xy[0] = action_pixel_range - 1 - flipped_xy[0]
             flipped_theta = action_theta.clone()
@@ -476,11 +534,20 @@ def augmentData2Buffer(buffer, d, rzs, aug_n, rotate, flip):
                 flipped_action[y_idx] = flipped_xy[1].item()
                 flipped_action[z_idx] = d.action[z_idx].clone().item()
                 flipped_action[rot_idx] = flipped_theta.item()
+            if defer_warp:
+                aug_list.append(d._replace(action=flipped_action))
+                continue
+            flipped_obs = np.flip(obs, 0)
+            flipped_next_obs = np.flip(next_obs, 0)
             aug_list.append(
                 ExpertTransition(d.state, (torch.tensor(flipped_obs.copy()), d.obs[1]), flipped_action, d.reward,
                                  d.next_state,
                                  (torch.tensor(flipped_next_obs.copy()), d.next_obs[1]), d.done, d.step_left, d.expert))
+        elif defer_warp:
+            flips.append(False)
+            aug_list.append(d._replace(action=trans_action))
         else:
+            flips.append(False)
             aug_list.append(
                 ExpertTransition(d.state, (torch.tensor(obs), d.obs[1]), trans_action, d.reward, d.next_state,
                                  (torch.tensor(next_obs), d.next_obs[1]), d.done, d.step_left, d.expert))
@@ -488,8 +555,148 @@ def augmentData2Buffer(buffer, d, rzs, aug_n, rotate, flip):
     # augDataSanityCheck([d], num_rz)
     # augDataSanityCheck(aug_list, num_rz)
 
-    for aug_d in aug_list:
-        buffer.add(aug_d)
+    if defer_warp:
+        for aug_d, transform, is_flipped in zip(aug_list, transforms, flips):
+            buffer.add(aug_d, transform=transform, flip=is_flipped)
+    else:
+        for aug_d in aug_list:
+            buffer.add(aug_d)
+
+
+def getBoundingTransforms(image_size, pixels, k, theta_dis_n=32, block=4):
+    """
+    Vectorized getBoundingTransform. Samples k random rigid transforms for each of the B action pixels at once, by
+    rejection sampling blocks of block * k candidates and checking the action pixel and the corners of its bounding box
+    for all candidates together
+    :param image_size: (H, W) of the image
+    :param pixels: Bx2 array of action pixels in action space
+    :param k: number of transforms per pixel
+    :param theta_dis_n: number of discrete rotations in 2pi
+    :param block: number of candidates drawn per missing transform in each rejection round
+    :return: Bxkx3x3 transforms, Bxk thetas, Bxkx2 transformed action pixels (rounded) in action space
+    """
+    lo = action2obs_offset
+    hi = image_size[0] - action2obs_offset
+    pivot = np.array((image_size[1] / 2, image_size[0] / 2))
+    pixels = np.asarray(pixels).reshape(-1, 2) + lo
+    b = pixels.shape[0]
+    bbox = np.stack((np.maximum(pixels[:, 0] - 5, lo), np.minimum(pixels[:, 0] + 5, hi - 1),
+                     np.maximum(pixels[:, 1] - 5, lo), np.minimum(pixels[:, 1] + 5, hi - 1)), axis=1)
+    set_theta_zero = np.any((bbox > hi - 5) | (bbox < lo + 5), axis=1)
+    small_range = ~set_theta_zero & np.any((bbox > hi - 10) | (bbox < lo + 10), axis=1)
+    # (x, y) of the action pixel and of the bounding box corners, Bx5x2
+    points = np.stack((pixels[:, [1, 0]], bbox[:, [2, 0]], bbox[:, [3, 0]], bbox[:, [2, 1]], bbox[:, [3, 1]]),
+                      axis=1).astype(np.float64)
+
+    theta_size = 2 * np.pi / theta_dis_n
+    # same theta distributions as get_random_image_transform_params
+    small_theta = np.linspace(-((np.pi / 6) // theta_size), (np.pi / 6) // theta_size, 1, False)[0] * theta_size
+    trans_sigma = action_pixel_range / 20
+
+    transforms = np.zeros((b, k, 3, 3))
+    thetas = np.zeros((b, k))
+    new_pixels = np.zeros((b, k, 2), dtype=np.int64)
+    n_valid = np.zeros(b, dtype=np.int64)
+    while np.any(n_valid < k):
+        rows = np.nonzero(n_valid < k)[0]
+        n_candidates = block * k
+        theta = np.random.randint(theta_dis_n, size=(rows.shape[0], n_candidates)) * theta_size
+        theta[small_range[rows]] = small_theta
+        theta[set_theta_zero[rows]] = 0.
+        if aug_continuous_theta:
+            theta += np.random.normal(0, 2 * np.pi / (6 * theta_dis_n), size=theta.shape)
+        trans = np.random.normal(0, trans_sigma, size=theta.shape + (2,))
+
+        cos, sin = np.cos(theta), np.sin(theta)
+        candidates = np.zeros(theta.shape + (3, 3))
+        candidates[..., 0, 0] = cos
+        candidates[..., 0, 1] = -sin
+        candidates[..., 1, 0] = sin
+        candidates[..., 1, 1] = cos
+        candidates[..., 0, 2] = trans[..., 0] + pivot[0] - (cos * pivot[0] - sin * pivot[1])
+        candidates[..., 1, 2] = trans[..., 1] + pivot[1] - (sin * pivot[0] + cos * pivot[1])
+        candidates[..., 2, 2] = 1.
+
+        # RxCx5x2 transformed points
+        transformed = np.einsum('rcij,rpj->rcpi', candidates[..., :2, :2], points[rows]) + \
+                      candidates[..., None, :2, 2]
+        rounded = np.round(transformed)
+        valid = np.all((transformed >= lo) & (transformed < hi) & (rounded >= lo) & (rounded < hi), axis=(2, 3))
+
+        # keep the first valid candidates of each row, up to k in total
+        slot = np.cumsum(valid, axis=1) - 1 + n_valid[rows, None]
+        take = valid & (slot < k)
+        r_idx, c_idx = np.nonzero(take)
+        transforms[rows[r_idx], slot[r_idx, c_idx]] = candidates[r_idx, c_idx]
+        thetas[rows[r_idx], slot[r_idx, c_idx]] = theta[r_idx, c_idx]
+        new_pixels[rows[r_idx], slot[r_idx, c_idx]] = rounded[r_idx, c_idx, 0, ::-1].astype(np.int64) - lo
+        n_valid[rows] = np.minimum(n_valid[rows] + valid.sum(1), k)
+
+    return transforms, thetas, new_pixels
+
+
+def augmentActions(actions, thetas, pixels, flips, num_rz, dtheta):
+    """
+    Remap actions to their augmented version, the same way as augmentData2Buffer
+    :param actions: NxA action tensor
+    :param thetas: N array of the rotation of the augmentation
+    :param pixels: Nx2 array of the transformed action pixels in action space
+    :param flips: N bool array, flip the augmentation along the first image axis or not
+    :param num_rz: number of discrete a_theta
+    :param dtheta: the interval of a_theta
+    :return: NxA augmented action tensor
+    """
+    primative_idx, x_idx, y_idx, z_idx, rot_idx = map(lambda a: action_sequence.find(a),
+                                                      ['p', 'x', 'y', 'z', 'r'])
+    actions = actions.clone()
+    flips = torch.as_tensor(flips, dtype=torch.bool)
+    x = torch.as_tensor(pixels[:, 0]).to(actions.dtype)
+    action_theta = actions[:, rot_idx] - (torch.as_tensor(thetas) / dtheta).round().long()
+    action_theta %= num_rz
+    actions[:, x_idx] = torch.where(flips, action_pixel_range - 1 - x, x)
+    actions[:, y_idx] = torch.as_tensor(pixels[:, 1]).to(actions.dtype)
+    actions[:, rot_idx] = torch.where(flips, (-action_theta) % num_rz, action_theta)
+    return actions
+
+
+def augmentData2Buffer(buffer, d, rzs, aug_n, rotate, flip):
+    """
+    Augment transition data to buffer. All aug_n transforms are sampled with getBoundingTransforms and obs, next_obs are
+    warped in a single warpImages call
+    :param buffer: buffer
+    :param d: transition data
+    :param rzs: a list of all a_theta value
+    :param aug_n: augmentation times
+    :param rotate: bool, rotate the transition or not
+    :param flip: bool, flip the transition or not
+    """
+    num_rz = len(rzs)
+    dtheta = rzs[1] - rzs[0]
+    theta_dis_n = int(2 * np.pi / dtheta)
+    image_size = d.obs[0].shape[-2:]
+
+    transforms, thetas, trans_pixels = getBoundingTransforms(image_size, d.action[:2].numpy(), aug_n,
+                                                             theta_dis_n=theta_dis_n)
+    transforms, thetas, trans_pixels = transforms[0, :, :2], thetas[0], trans_pixels[0]
+    flips = np.random.random(aug_n) > 0.5 if flip else np.zeros(aug_n, dtype=bool)
+    actions = augmentActions(d.action.reshape(1, -1).expand(aug_n, -1), thetas, trans_pixels, flips, num_rz, dtheta)
+
+    # buffers with defer_warp store the transform and flip with the raw obs, and warp the obs when sampling
+    if getattr(buffer, 'defer_warp', False):
+        for i in range(aug_n):
+            buffer.add(d._replace(action=actions[i]), transform=transforms[i], flip=flips[i])
+        return
+
+    # obs and next_obs are warped as two channels of one image
+    images = torch.stack((d.obs[0].reshape(image_size), d.next_obs[0].reshape(image_size))).expand(aug_n, -1, -1, -1)
+    warped = warpImages(images, transforms)
+    flip_mask = torch.from_numpy(flips)
+    warped[flip_mask] = warped[flip_mask].flip(2)
+    obs, next_obs = warped[:, 0], warped[:, 1]
+
+    for i in range(aug_n):
+        buffer.add(ExpertTransition(d.state, (obs[i], d.obs[1]), actions[i], d.reward, d.next_state,
+                                    (next_obs[i], d.next_obs[1]), d.done, d.step_left, d.expert))
 
 
 def augDataSanityCheck(aug_list, num_rz):